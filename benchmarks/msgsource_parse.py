@@ -0,0 +1,108 @@
+"""
+群消息`extrainfo`解析耗时测试
+
+$ python benchmarks/msgsource_parse.py -n 5000 -r 20
+"""
+import argparse
+import re
+import timeit
+
+from whochat.messages.msgsource import parse_msgsource
+
+CORPUS = {
+    "windows": (
+        "<msgsource><atuserlist><![CDATA[,wxid_enuyja8axoz92,wxid_enuyjaxoz922,"
+        "wxid_ctg8dfsen122]]></atuserlist><silence>0</silence>"
+        "<membercount>12</membercount><signature>v1_6XIdCSDF</signature>"
+        "<tmp_node><publisher-id>&lt;![CDATA[]]&gt;</publisher-id></tmp_node>"
+        "</msgsource>"
+    ),
+    "mac": (
+        "<msgsource><atuserlist>wxid_enuyja8axoz92</atuserlist>"
+        "<alnode><fr>1</fr></alnode><silence>0</silence>"
+        "<membercount>12</membercount><signature>v1_JVxT4Vi9</signature>"
+        "<tmp_node><publisher-id>&lt;![CDATA[]]&gt;</publisher-id></tmp_node>"
+        "</msgsource>"
+    ),
+    "android": (
+        "<msgsource><atuserlist><![CDATA[wxid_enuyja8axoz92]]></atuserlist>"
+        "<silence>0</silence><membercount>12</membercount>"
+        "<signature>v1_VQrQyKdq</signature><tmp_node>"
+        "<publisher-id>&lt;![CDATA[]]&gt;</publisher-id></tmp_node></msgsource>"
+    ),
+    "no_at": (
+        "<msgsource><silence>1</silence><membercount>500</membercount>"
+        "<signature>v1_VQrQyKdq</signature><tmp_node>"
+        "<publisher-id>&lt;![CDATA[]]&gt;</publisher-id></tmp_node></msgsource>"
+    ),
+    # 含未知节点，不符合固定的节点顺序，逐个字段查找
+    "unknown": (
+        "<msgsource>\n\t<atuserlist><![CDATA[wxid_enuyja8axoz92]]></atuserlist>\n"
+        "\t<pua>1</pua>\n\t<silence>0</silence>\n\t<membercount>12</membercount>\n"
+        "\t<signature>v1_VQrQyKdq</signature>\n</msgsource>\n"
+    ),
+}
+
+
+def parse_extrainfo_v135(extrainfo):
+    """v1.3.5的实现，作为对照"""
+    extra = {"is_at_msg": False}
+    android_windows_at_pattern = r"<atuserlist><!\[CDATA\[(.*?)\]\]></atuserlist>"
+    m = re.search(android_windows_at_pattern, extrainfo)
+    if not m:
+        mac_at_pattern = r"<atuserlist>(.*?)</atuserlist>"
+        m = re.search(mac_at_pattern, extrainfo)
+    if m:
+        extra["is_at_msg"] = True
+        extra["at_user_list"] = [
+            wxid.strip() for wxid in m.group(1).split(",") if wxid.strip()
+        ]
+    m = re.search(r"<membercount>(\d+)</membercount>", extrainfo)
+    if m:
+        extra["member_count"] = int(m.group(1))
+    return extra
+
+
+def parse_hot_fields(extrainfo):
+    """每条群消息都会用到的字段，与v1.3.5的结果对应"""
+    msgsource = parse_msgsource(extrainfo)
+    return msgsource.is_at_msg, msgsource.at_user_list, msgsource.member_count
+
+
+def main(number, repeat):
+    def best(extrainfo, *funcs):
+        # 交替运行各实现，减少机器负载变化对比值的影响
+        times = [float("inf")] * len(funcs)
+        for _ in range(repeat):
+            for i, func in enumerate(funcs):
+                t = timeit.timeit(lambda: func(extrainfo), number=number)
+                times[i] = min(times[i], t)
+        return [t / number * 1e6 for t in times]
+
+    for name, extrainfo in CORPUS.items():
+        old = parse_extrainfo_v135(extrainfo)
+        is_at_msg, at_user_list, member_count = parse_hot_fields(extrainfo)
+        assert old["is_at_msg"] == is_at_msg, name
+        assert old.get("at_user_list", []) == at_user_list, name
+        assert old["member_count"] == member_count, name
+
+        # 序列化时提取全部6个字段，v1.3.5只有3个
+        t_old, t_new, t_dict = best(
+            extrainfo,
+            parse_extrainfo_v135,
+            parse_hot_fields,
+            lambda x: parse_msgsource(x).as_dict(),
+        )
+        print(
+            f"{name:<8} v1.3.5: {t_old:.2f}us  "
+            f"hot fields: {t_new:.2f}us ({t_old / t_new:.2f}x)  "
+            f"as_dict: {t_dict:.2f}us ({t_old / t_dict:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=5000)
+    parser.add_argument("-r", "--repeat", type=int, default=20)
+    args = parser.parse_args()
+    main(args.number, args.repeat)
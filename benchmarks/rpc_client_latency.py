@@ -0,0 +1,68 @@
+"""
+BotWebsocketRPCClient调用延迟测试，使用本地模拟的JSON-RPC websocket服务
+
+$ python benchmarks/rpc_client_latency.py -n 2000 -c 50
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import websockets.server
+
+from whochat.rpc.clients.websocket import BotWebsocketRPCClient
+
+
+async def fake_handler(websocket):
+    async for message in websocket:
+        request = json.loads(message)
+        await websocket.send(
+            json.dumps({"jsonrpc": "2.0", "result": 0, "id": request["id"]})
+        )
+
+
+def percentile(data, p):
+    data = sorted(data)
+    k = min(len(data) - 1, int(round(p / 100 * (len(data) - 1))))
+    return data[k]
+
+
+async def main(total, concurrency, port, send_window):
+    async with websockets.server.serve(fake_handler, "localhost", port):
+        client = BotWebsocketRPCClient(
+            f"ws://localhost:{port}", send_window=send_window
+        )
+        client.consume_in_background()
+        await client.send_text(0, "filehelper", "warm up", timeout=5)
+
+        latencies = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call(i):
+            async with semaphore:
+                start = time.perf_counter()
+                await client.send_text(0, "filehelper", f"msg {i}", timeout=10)
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(call(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+        stats = client.stats()
+
+    print(f"calls: {total}, concurrency: {concurrency}, total: {elapsed:.3f}s")
+    print(f"throughput: {total / elapsed:.0f} calls/s")
+    print(f"mean: {statistics.mean(latencies) * 1000:.3f}ms")
+    print(f"p50:  {percentile(latencies, 50) * 1000:.3f}ms")
+    print(f"p99:  {percentile(latencies, 99) * 1000:.3f}ms")
+    print(f"client stats: {stats}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--total", type=int, default=1000)
+    parser.add_argument("-c", "--concurrency", type=int, default=1)
+    parser.add_argument("-p", "--port", type=int, default=9102)
+    parser.add_argument("-w", "--send-window", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(main(args.total, args.concurrency, args.port, args.send_window))
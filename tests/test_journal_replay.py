@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+from whochat.messages.journal import MessageJournal
+from whochat.messages.record import MessageRecord
+from whochat.messages.subscription import Subscription
+from whochat.messages.websocket import WechatMessageWebsocketServer
+
+CHATROOM = "20813132945@chatroom"
+AT_EXTRAINFO = (
+    "<msgsource><atuserlist><![CDATA[,wxid_enuyja8axoz92]]></atuserlist>"
+    "<silence>0</silence><membercount>12</membercount>"
+    "<signature>v1_6XIdCSDF</signature></msgsource>"
+)
+NO_AT_EXTRAINFO = (
+    "<msgsource><silence>0</silence><membercount>12</membercount></msgsource>"
+)
+
+
+def make_record(msgid, sender=CHATROOM, extrainfo=NO_AT_EXTRAINFO):
+    return MessageRecord(
+        pid=1,
+        type=1,
+        is_send_msg=0,
+        msgid=msgid,
+        sender=sender,
+        wxid="wxid_enuyja8axoz92",
+        message=f"message {msgid}",
+        filepath="",
+        time="2022-10-01 12:00:00",
+        extrainfo=extrainfo,
+    )
+
+
+class FakeSender:
+    async def wait_idle(self):
+        pass
+
+
+class FakeWebsocket:
+    remote_address = ("127.0.0.1", 0)
+
+
+def replay(journal, subscription):
+    server = WechatMessageWebsocketServer([1], journal=journal)
+    websocket = FakeWebsocket()
+    server.clients[websocket] = FakeSender()
+    server.subscriptions.add(websocket, subscription)
+    sent = []
+    server.broadcast = lambda data, targets: sent.append(json.loads(data))
+    asyncio.run(server.replay(websocket, 0))
+    return sent
+
+
+def test_replay_journaled_chatroom_messages(tmp_path):
+    journal = MessageJournal(tmp_path)
+    journal.append_many(
+        [
+            make_record(1, extrainfo=AT_EXTRAINFO),
+            make_record(2),
+            make_record(3, sender="wxid_friend", extrainfo=None),
+        ]
+    )
+    try:
+        sent = replay(journal, Subscription())
+        assert [msg["msgid"] for msg in sent] == [1, 2, 3]
+        assert sent[0]["extrainfo"]["at_user_list"] == ["wxid_enuyja8axoz92"]
+
+        sent = replay(journal, Subscription(is_at_msg=True))
+        assert [msg["msgid"] for msg in sent] == [1]
+        assert sent[0]["offset"] == 0
+
+        sent = replay(journal, Subscription(is_at_msg=False))
+        assert [msg["msgid"] for msg in sent] == [2, 3]
+
+        sent = replay(
+            journal, Subscription(senders=frozenset([CHATROOM]), types=frozenset([1]))
+        )
+        assert [msg["msgid"] for msg in sent] == [1, 2]
+    finally:
+        journal.close()
@@ -1,22 +1,29 @@
+import enum
 import functools
 import json
 import os
 import pathlib
-import re
 import shutil
 import tempfile
 import threading
 import time
-from datetime import datetime
 from typing import Dict, List, Union, overload
-from urllib import request
 
 import psutil
 
 from ._comtypes import client as com_client
 from .abc import CWechatRobotABC, RobotEventABC, RobotEventSinkABC
+from .chatrooms import ChatRoomMemberCache
+from .contacts import ContactCache
+from .errors import (
+    ComCallError,
+    RobotServiceError,
+    WechatNotFoundError,
+    WhochatError,
+)
 from .logger import logger
-from .utils import guess_wechat_base_directory, guess_wechat_user_by_paths
+from .processes import wechat_process_registry
+from .wechat_version import fetch_latest_wechat_version, wechat_version_resolver
 
 _robot_local = threading.local()
 
@@ -34,14 +41,24 @@ def get_robot_event(com_id) -> RobotEventABC:
     return getattr(_robot_local, "robot_event")
 
 
+class ServiceState(str, enum.Enum):
+    STOPPED = "stopped"
+    INJECTING = "injecting"
+    STARTED = "started"
+    FAILED = "failed"
+
+
 def auto_start(func):
     @functools.wraps(func)
     def wrapper(self: "WechatBot", *args, **kwargs):
-        self.start_robot_service()
+        if self.state is not ServiceState.STARTED:
+            self.ensure_started()
         try:
             return func(self, *args, **kwargs)
+        except WhochatError:
+            raise
         except Exception as e:
-            logger.exception(e)
+            raise ComCallError(f"{func.__name__}: {e!r}", self.wx_pid) from e
 
     return wrapper
 
@@ -57,7 +74,15 @@ class WechatBot:
         self.wx_pid = int(wx_pid)
         self._robot_object_id = robot_object_id
         self._robot_event_id = robot_event_id
-        self.started = False
+        self.state = ServiceState.STOPPED
+        self.last_error = None
+        # 启动失败后在此之前不再重试，直接抛出上次的错误
+        self._retry_at = 0.0
+        self.retry_interval = 5
+        self._state_lock = threading.RLock()
+        # 后台探测的登录状态，None为未探测
+        self.logged_in = None
+        self.checked_at = None
         self.user_info = {}
         self.event_connection = None
 
@@ -65,6 +90,8 @@ class WechatBot:
         self.image_hook_path = None
         self.voice_hook_path = None
         self.wechat_version = wechat_version
+        self._contacts = None
+        self._chat_rooms = None
 
     @property
     def robot(self):
@@ -81,29 +108,93 @@ class WechatBot:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop_robot_service()
 
+    @property
+    def started(self) -> bool:
+        return self.state is ServiceState.STARTED
+
+    def _set_state(self, state: ServiceState, error: str = None):
+        if state is not self.state:
+            logger.info(f"微信进程{self.wx_pid}机器人服务: {self.state.value} -> {state.value}")
+        self.state = state
+        self.last_error = error
+
     def start_robot_service(self):
-        if self.started:
+        if self.state is ServiceState.STARTED:
             return True
-        result = self.robot.CStartRobotService(
-            self.wx_pid,
-        )
-        if result == 0:
-            self.started = True
-            if self.wechat_version:
+        with self._state_lock:
+            if self.state is ServiceState.STARTED:
+                return True
+            self._set_state(ServiceState.INJECTING)
+            try:
+                result = self.robot.CStartRobotService(
+                    self.wx_pid,
+                )
+            except Exception as e:
+                result = repr(e)
+            if result != 0:
+                self._set_state(ServiceState.FAILED, f"CStartRobotService: {result}")
+                self._retry_at = time.monotonic() + self.retry_interval
+                return False
+            self._set_state(ServiceState.STARTED)
+        if self.wechat_version:
+            try:
                 self.change_wechat_ver(self.wechat_version)
                 logger.info(f"更改微信版本号为: {self.wechat_version}")
-        return not result
+            except WhochatError as e:
+                logger.warning(f"更改微信版本号失败: {e}")
+        return True
+
+    def ensure_started(self):
+        """启动机器人服务，失败时抛出`RobotServiceError`"""
+        if self.state is ServiceState.STARTED:
+            return
+        if self.state is ServiceState.FAILED and time.monotonic() < self._retry_at:
+            raise RobotServiceError(self.last_error, self.wx_pid)
+        if not self.start_robot_service():
+            raise RobotServiceError(self.last_error, self.wx_pid)
 
     def stop_robot_service(self):
-        if not self.started:
+        if self.state is ServiceState.STOPPED:
             return True
-        result = self.robot.CStopRobotService(
-            self.wx_pid,
-        )
-        if result == 0:
-            self.started = False
+        with self._state_lock:
+            result = self.robot.CStopRobotService(
+                self.wx_pid,
+            )
+            if result == 0:
+                self._set_state(ServiceState.STOPPED)
         return not result
 
+    def probe(self):
+        """
+        通过`is_wx_login`检查已启动的机器人服务是否可用，不可用时标记为失败，下次调用时重新启动
+        在该微信进程的COM线程中调用
+        """
+        if self.state is not ServiceState.STARTED:
+            return self.state
+        try:
+            self.logged_in = bool(self.robot.CIsWxLogin(self.wx_pid))
+        except Exception as e:
+            logger.warning(f"微信进程{self.wx_pid}健康检查失败: {e!r}")
+            with self._state_lock:
+                self._set_state(ServiceState.FAILED, f"CIsWxLogin: {e!r}")
+        self.checked_at = time.time()
+        return self.state
+
+    @overload
+    def get_service_state(self) -> Dict:
+        ...
+
+    def get_service_state(self):
+        """
+        机器人服务状态: stopped, injecting, started, failed，以及最近一次健康检查的登录状态
+        """
+        return {
+            "state": self.state.value,
+            "last_error": self.last_error,
+            "logged_in": self.logged_in,
+            "checked_at": self.checked_at,
+        }
+
     @property
     def base_directory(self):
         if not self._base_directory:
@@ -111,13 +202,13 @@ class WechatBot:
         return self._base_directory
 
     def get_base_directory(self):
-        p = psutil.Process(pid=self.wx_pid)
-        base_directory = guess_wechat_base_directory([f.path for f in p.open_files()])
+        process = wechat_process_registry.get(self.wx_pid)
+        base_directory = process.base_directory if process is not None else ""
         self._base_directory = base_directory
         return base_directory
 
     @overload
-    def send_image(self, wx_id, img_path) -> int:
+    def send_image(self, wx_id: str, img_path: str) -> int:
         ...
 
     @auto_start
@@ -137,7 +228,7 @@ class WechatBot:
         return self.robot.CSendImage(self.wx_pid, wx_id, str(path))
 
     @overload
-    def send_text(self, wx_id, text) -> int:
+    def send_text(self, wx_id: str, text: str) -> int:
         ...
 
     @auto_start
@@ -145,7 +236,7 @@ class WechatBot:
         return self.robot.CSendText(self.wx_pid, wx_id, text)
 
     @overload
-    def send_file(self, wx_id, filepath) -> int:
+    def send_file(self, wx_id: str, filepath: str) -> int:
         ...
 
     @auto_start
@@ -222,6 +313,49 @@ class WechatBot:
     def get_wx_user_info(self, wxid: str):
         return json.loads(self.robot.CGetWxUserInfo(self.wx_pid, wxid))
 
+    @property
+    def contacts(self) -> ContactCache:
+        if self._contacts is None:
+            self._contacts = ContactCache(self)
+        return self._contacts
+
+    @overload
+    def get_contact(self, wxid: str) -> Dict:
+        ...
+
+    def get_contact(self, wxid: str):
+        """
+        从缓存中按wxid查找联系人，不在好友列表中时获取该用户信息
+        """
+        return self.contacts.get(wxid)
+
+    @overload
+    def search_contacts(self, nickname_prefix: str, limit: int = 20) -> List[Dict]:
+        ...
+
+    def search_contacts(self, nickname_prefix: str, limit: int = 20):
+        """
+        从缓存中按昵称或备注前缀查找联系人，不区分大小写
+        """
+        return self.contacts.search(nickname_prefix, limit)
+
+    @overload
+    def invalidate_contacts(self, wxid: str = None) -> int:
+        ...
+
+    def invalidate_contacts(self, wxid: str = None):
+        """
+        使联系人缓存失效，wxid为空时下次查询重新获取好友列表
+        """
+        self.contacts.invalidate(wxid)
+        return 0
+
+    @property
+    def chat_rooms(self) -> ChatRoomMemberCache:
+        if self._chat_rooms is None:
+            self._chat_rooms = ChatRoomMemberCache(self)
+        return self._chat_rooms
+
     @property
     def wxid(self):
         return self.get_self_info()["wxId"]
@@ -304,7 +438,7 @@ class WechatBot:
 
     def get_chat_room_members(self, chatroom_id: str) -> List[dict]:
         """
-        获取群成员id及昵称信息
+        获取群成员id及昵称信息，成员列表缓存60秒，过期后只查询新成员的昵称
 
         [
             {
@@ -313,15 +447,18 @@ class WechatBot:
             }
         ]
         """
-        results = []
-        for wx_id in self.get_chat_room_member_ids(chatroom_id):
-            results.append(
-                {
-                    "wx_id": wx_id,
-                    "nickname": self.get_chat_room_member_nickname(chatroom_id, wx_id),
-                }
-            )
-        return results
+        return self.chat_rooms.get_members(chatroom_id)
+
+    @overload
+    def invalidate_chat_room_members(self, chatroom_id: str = None) -> int:
+        ...
+
+    def invalidate_chat_room_members(self, chatroom_id: str = None):
+        """
+        使群成员缓存失效，chatroom_id为空时使所有群失效
+        """
+        self.chat_rooms.invalidate(chatroom_id)
+        return 0
 
     @overload
     def add_friend_by_wxid(self, wxid: str, message: str) -> int:
@@ -688,10 +825,13 @@ class WechatBotFactory(metaclass=WechatBotFactoryMetaclass):
 
     @classmethod
     def get(cls, wx_pid) -> "WechatBot":
+        wx_pid = int(wx_pid)
         if wx_pid not in cls._instances:
-            wechat_version = os.environ.get(
-                "WHOCHAT_WECHAT_VERSION"
-            ) or cls.get_latest_wechat_version(fill=".99")
+            # 不为不存在的pid创建bot，否则不会有进程退出通知将其移除
+            if wechat_process_registry.get(wx_pid) is None:
+                raise WechatNotFoundError(f"微信进程{wx_pid}不存在", wx_pid)
+            # 不访问网络，最新版本号在后台获取
+            wechat_version = wechat_version_resolver.resolve()
             bot = WechatBot(
                 wx_pid,
                 cls._robot_object_id,
@@ -701,6 +841,10 @@ class WechatBotFactory(metaclass=WechatBotFactoryMetaclass):
             cls._instances[wx_pid] = bot
         return cls._instances[wx_pid]
 
+    @classmethod
+    def bots(cls) -> List["WechatBot"]:
+        return list(cls._instances.values())
+
     @classmethod
     def exit(cls):
         logger.info("卸载注入的dll...")
@@ -717,22 +861,7 @@ class WechatBotFactory(metaclass=WechatBotFactoryMetaclass):
 
     @classmethod
     def list_wechat(cls) -> List[dict]:
-        results = []
-        for process in psutil.process_iter():
-            if process.name().lower() == "wechat.exe":
-                files = [f.path for f in process.open_files()]
-                results.append(
-                    {
-                        "pid": process.pid,
-                        "started": datetime.fromtimestamp(
-                            process.create_time()
-                        ).isoformat(),
-                        "status": process.status(),
-                        "wechat_user": guess_wechat_user_by_paths(files),
-                        "base_directory": guess_wechat_base_directory(files),
-                    }
-                )
-        return results
+        return [process.as_dict() for process in wechat_process_registry.list()]
 
     @classmethod
     def get_robot_pid(cls):
@@ -761,22 +890,26 @@ class WechatBotFactory(metaclass=WechatBotFactoryMetaclass):
     @classmethod
     def get_latest_wechat_version(cls, fill: str = None):
         logger.info("获取微信最新版本号...")
-        with request.urlopen(
-            request.Request(
-                "https://pc.weixin.qq.com/?lang=zh_CN",
-                headers={
-                    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36"
-                },
-                method="GET",
-            )
-        ) as fp:
-            html = fp.read().decode()
-        m = re.search(r"download-version\">(.*?)</span>", html)
-        if not m:
-            logger.warning("获取微信最新版本号异常")
-            return
-        version = m.group(1)
-        if fill:
+        version = fetch_latest_wechat_version(wechat_version_resolver.timeout)
+        if version and fill:
             version = version + fill
         logger.info(f"微信最新版本号：{version}")
         return version
+
+    @classmethod
+    def _on_wechat_version_refresh(cls, version: str):
+        # 已注入的bot在下次启动时使用新版本号
+        for bot in list(cls._instances.values()):
+            bot.wechat_version = version
+
+    @classmethod
+    def _on_wechat_processes_change(cls, started, exited):
+        # pid可能被新的微信进程复用，丢弃已退出进程的bot及其缓存
+        for process in exited:
+            bot = cls._instances.pop(process.pid, None)
+            if bot is not None:
+                logger.info(f"微信进程{process.pid}已退出，移除bot")
+
+
+wechat_version_resolver.on_refresh(WechatBotFactory._on_wechat_version_refresh)
+wechat_process_registry.on_change(WechatBotFactory._on_wechat_processes_change)
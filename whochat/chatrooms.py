@@ -0,0 +1,161 @@
+"""
+群成员缓存
+
+每个微信进程一个`ChatRoomMemberCache`，按群id缓存成员wxid及群昵称。
+消息接收服务与RPC服务运行在不同进程中，无法根据收到的群消息使缓存失效，
+因此成员列表只缓存`ttl`(默认60秒)，过期后重新获取成员wxid(一次COM调用)，只查询新成员的昵称；
+需要立即刷新时调用`invalidate`(RPC接口`invalidate_chat_room_members`)。
+新成员的昵称在该微信进程的COM线程(`bot_executors`)中查询，
+`BotExecutors.max_workers_per_bot`大于1时由多个COM线程同时查询
+"""
+import dataclasses
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from whochat.errors import WhochatError
+from whochat.logger import logger
+
+if TYPE_CHECKING:
+    from whochat.bot import WechatBot
+
+
+@dataclasses.dataclass
+class ChatRoom:
+    member_ids: List[str]
+    nicknames: Dict[str, str]
+    expires_at: float
+    stale: bool = False
+
+    def as_members(self) -> List[dict]:
+        return [
+            {"wx_id": wx_id, "nickname": self.nicknames.get(wx_id, "")}
+            for wx_id in self.member_ids
+        ]
+
+
+class ChatRoomMemberCache:
+    def __init__(self, bot: "WechatBot", ttl: float = 60):
+        """
+        :param ttl: 群成员列表缓存时间，秒。已知成员的昵称在刷新时保留
+        """
+        self.bot = bot
+        self.ttl = ttl
+        self._rooms: Dict[str, ChatRoom] = {}
+        self._lock = threading.Lock()
+        # chatroom_id -> 锁，同一个群同时只刷新一次
+        self._room_locks: Dict[str, threading.Lock] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.resolved = 0
+
+    def _room_lock(self, chatroom_id: str) -> threading.Lock:
+        with self._lock:
+            return self._room_locks.setdefault(chatroom_id, threading.Lock())
+
+    def invalidate(self, chatroom_id: str = None):
+        """
+        :param chatroom_id: 群id，为空时使所有群失效。失效后保留已知的昵称，只重新查询新成员
+        """
+        with self._lock:
+            rooms = (
+                self._rooms.values()
+                if chatroom_id is None
+                else filter(None, [self._rooms.get(chatroom_id)])
+            )
+            for room in rooms:
+                room.stale = True
+
+    def _resolve_nicknames(self, chatroom_id: str, wx_ids: List[str]) -> Dict[str, str]:
+        from whochat.rpc.handlers import bot_executors
+
+        nicknames = {}
+        pending = iter(wx_ids)
+        pending_lock = threading.Lock()
+
+        def resolve():
+            while True:
+                with pending_lock:
+                    wx_id = next(pending, None)
+                if wx_id is None:
+                    return
+                try:
+                    nickname = self.bot.get_chat_room_member_nickname(
+                        chatroom_id, wx_id
+                    )
+                except WhochatError as e:
+                    # 未获取到的昵称在下次刷新时重新获取
+                    logger.warning(f"获取群{chatroom_id}成员{wx_id}的昵称失败: {e}")
+                    continue
+                nicknames[wx_id] = nickname or ""
+
+        # 当前线程也参与查询，其他COM线程繁忙时不等待它们
+        futures = []
+        for _ in range(min(bot_executors.max_workers_per_bot, len(wx_ids)) - 1):
+            try:
+                futures.append(bot_executors.submit(self.bot.wx_pid, resolve))
+            except WhochatError:
+                break
+        resolve()
+        for future in futures:
+            # 未开始执行的任务已无成员可查，取消以免所有COM线程互相等待
+            if not future.cancel():
+                future.result()
+        self.resolved += len(wx_ids)
+        return nicknames
+
+    def _load(
+        self, chatroom_id: str, previous: Optional[ChatRoom]
+    ) -> Optional[ChatRoom]:
+        member_ids = self.bot.get_chat_room_member_ids(chatroom_id)
+        if member_ids is None:
+            return None
+        member_ids = [wx_id for wx_id in member_ids if wx_id]
+        known = previous.nicknames if previous is not None else {}
+        nicknames = {wx_id: known[wx_id] for wx_id in member_ids if wx_id in known}
+        nicknames.update(
+            self._resolve_nicknames(
+                chatroom_id, [wx_id for wx_id in member_ids if wx_id not in nicknames]
+            )
+        )
+        return ChatRoom(
+            member_ids=member_ids,
+            nicknames=nicknames,
+            expires_at=time.monotonic() + self.ttl,
+        )
+
+    def get(self, chatroom_id: str) -> ChatRoom:
+        room = self._rooms.get(chatroom_id)
+        if room is not None and not room.stale and time.monotonic() < room.expires_at:
+            self.hits += 1
+            return room
+        with self._room_lock(chatroom_id):
+            # 等待锁期间可能已被其他线程刷新
+            current = self._rooms.get(chatroom_id)
+            if current is not room and current is not None and not current.stale:
+                self.hits += 1
+                return current
+            self.misses += 1
+            room = self._load(chatroom_id, current)
+            if room is None:
+                # 调用失败时不缓存，返回原有的成员
+                return current or ChatRoom([], {}, 0.0)
+            with self._lock:
+                self._rooms[chatroom_id] = room
+            return room
+
+    def get_members(self, chatroom_id: str) -> List[dict]:
+        return self.get(chatroom_id).as_members()
+
+    def get_nickname(self, chatroom_id: str, wx_id: str) -> Optional[str]:
+        return self.get(chatroom_id).nicknames.get(wx_id)
+
+    def stats(self):
+        return {
+            "chatrooms": len(self._rooms),
+            "members": sum(len(room.member_ids) for room in self._rooms.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "resolved": self.resolved,
+        }
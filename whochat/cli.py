@@ -102,8 +102,63 @@ def list_wechat():
     show_default=True,
     help="Respond 'hello' on client connect",
 )
+@click.option(
+    "--buffer-size",
+    default=1000,
+    show_default=True,
+    help="待广播消息缓冲区大小，满时丢弃最旧的消息",
+)
+@click.option(
+    "--client-buffer-size",
+    default=1024 * 1024,
+    show_default=True,
+    help="每个客户端的发送缓冲区大小(字节)",
+)
+@click.option(
+    "--slow-client-policy",
+    default="drop_oldest",
+    show_default=True,
+    type=click.Choice(["drop_oldest", "disconnect", "pause"]),
+    help="客户端发送缓冲区满时的处理策略",
+)
+@click.option(
+    "--journal-dir",
+    default=None,
+    type=click.Path(file_okay=False),
+    help="消息日志目录，设置后客户端可以从指定offset继续接收消息",
+)
+@click.option(
+    "--journal-segment-size",
+    default=64 * 1024 * 1024,
+    show_default=True,
+    help="消息日志单个文件的最大字节数",
+)
+@click.option(
+    "--journal-max-segments",
+    default=16,
+    show_default=True,
+    help="最多保留的消息日志文件数",
+)
+@click.option(
+    "--dedup-window",
+    default=300.0,
+    show_default=True,
+    help="按msgid去除重复消息的时间窗口(秒)，0表示不去重",
+)
 @click.argument("wx_pids", nargs=-1, type=int)
-def serve_message_ws(host, port, welcome, wx_pids):
+def serve_message_ws(
+    host,
+    port,
+    welcome,
+    buffer_size,
+    client_buffer_size,
+    slow_client_policy,
+    journal_dir,
+    journal_segment_size,
+    journal_max_segments,
+    dedup_window,
+    wx_pids,
+):
     """
     运行接收微信消息的Websocket服务
 
@@ -113,14 +168,31 @@ def serve_message_ws(host, port, welcome, wx_pids):
 
     import asyncio
 
+    from whochat.messages.journal import MessageJournal
     from whochat.messages.websocket import WechatMessageWebsocketServer
 
     if not wx_pids:
         raise click.BadArgumentUsage("请指定至少一个微信进程PID")
 
+    journal = None
+    if journal_dir:
+        journal = MessageJournal(
+            journal_dir,
+            segment_bytes=journal_segment_size,
+            max_segments=journal_max_segments,
+        )
+
     async def main():
         server = WechatMessageWebsocketServer(
-            wx_pids=wx_pids, ws_host=host, ws_port=port, welcome=welcome
+            wx_pids=wx_pids,
+            ws_host=host,
+            ws_port=port,
+            welcome=welcome,
+            buffer_size=buffer_size,
+            client_buffer_size=client_buffer_size,
+            slow_client_policy=slow_client_policy,
+            journal=journal,
+            dedup_window=dedup_window or None,
         )
         await server.serve()
 
@@ -0,0 +1,178 @@
+"""
+好友列表缓存
+
+每个微信进程一个`ContactCache`，按wxid和昵称(含备注)索引，查询时不再跨进程调用COM接口。
+缓存过期(`ttl`)后在下次查询时整体刷新；查询不在好友列表中的wxid时才单独获取该联系人，
+获取不到的wxid(公众号、文件传输助手等)在`miss_ttl`内不再获取。
+消息接收服务与RPC服务运行在不同进程中，缓存只在查询时(RPC进程的COM线程中)更新，不由收到的消息驱动
+"""
+import bisect
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from whochat.bot import WechatBot
+
+# 好友列表与用户信息中wxid、昵称和备注的字段名不同
+WXID_KEYS = ("wxid", "wxId")
+NAME_KEYS = ("wxNickName", "wxRemark")
+
+
+def _get_wxid(contact: dict) -> Optional[str]:
+    for key in WXID_KEYS:
+        wxid = contact.get(key)
+        if wxid:
+            return wxid
+    return None
+
+
+def _get_names(contact: dict) -> Iterable[str]:
+    for key in NAME_KEYS:
+        name = contact.get(key)
+        if name and name != "null":
+            yield name.lower()
+
+
+class ContactCache:
+    def __init__(self, bot: "WechatBot", ttl: float = 600, miss_ttl: float = 600):
+        """
+        :param ttl: 好友列表缓存时间，秒
+        :param miss_ttl: 获取不到的联系人的缓存时间，秒
+        """
+        self.bot = bot
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self._contacts: Dict[str, dict] = {}
+        # [(小写昵称或备注, wxid)]，用于前缀查找
+        self._names: List[Tuple[str, str]] = []
+        # wxid -> expire_at，获取不到的联系人
+        self._not_found: Dict[str, float] = {}
+        self._expires_at = 0.0
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.fetches = 0
+
+    def __len__(self):
+        return len(self._contacts)
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.monotonic() < self._expires_at
+
+    def refresh(self):
+        """重新获取好友列表"""
+        friends = self.bot.get_friend_list()
+        contacts = {}
+        for friend in friends:
+            wxid = _get_wxid(friend)
+            if wxid:
+                contacts[wxid] = friend
+        names = sorted(
+            (name, wxid)
+            for wxid, contact in contacts.items()
+            for name in _get_names(contact)
+        )
+        with self._lock:
+            self._contacts = contacts
+            self._names = names
+            for wxid in contacts:
+                self._not_found.pop(wxid, None)
+            self._expires_at = time.monotonic() + self.ttl
+            self.refreshes += 1
+
+    def invalidate(self, wxid: str = None):
+        """
+        :param wxid: 只使该联系人失效，下次查询时重新获取；为空时下次查询刷新整个好友列表
+        """
+        with self._lock:
+            if wxid is None:
+                self._expires_at = 0.0
+                self._not_found.clear()
+                return
+            self._not_found.pop(wxid, None)
+            self._remove(wxid)
+
+    def _is_not_found(self, wxid: str) -> bool:
+        expire_at = self._not_found.get(wxid)
+        return expire_at is not None and expire_at > time.monotonic()
+
+    def _remove(self, wxid: str) -> Optional[dict]:
+        contact = self._contacts.pop(wxid, None)
+        if contact is not None:
+            for name in _get_names(contact):
+                i = bisect.bisect_left(self._names, (name, wxid))
+                if i < len(self._names) and self._names[i] == (name, wxid):
+                    del self._names[i]
+        return contact
+
+    def _put(self, wxid: str, contact: dict):
+        self._remove(wxid)
+        self._contacts[wxid] = contact
+        for name in _get_names(contact):
+            bisect.insort(self._names, (name, wxid))
+
+    def _purge_not_found(self):
+        now = time.monotonic()
+        with self._lock:
+            for wxid in [k for k, v in self._not_found.items() if v <= now]:
+                del self._not_found[wxid]
+
+    def _fetch(self, wxid: str) -> Optional[dict]:
+        self.fetches += 1
+        contact = self.bot.get_wx_user_info(wxid)
+        with self._lock:
+            if not contact or not _get_wxid(contact):
+                self._not_found[wxid] = time.monotonic() + self.miss_ttl
+                return None
+            self._put(wxid, contact)
+        return contact
+
+    def _ensure_fresh(self):
+        if not self.is_fresh:
+            self.refresh()
+
+    def get(self, wxid: str) -> Optional[dict]:
+        """按wxid查找联系人，不在好友列表中时获取该用户信息并缓存"""
+        self._ensure_fresh()
+        contact = self._contacts.get(wxid)
+        if contact is not None:
+            self.hits += 1
+            return contact
+        self.misses += 1
+        if self._is_not_found(wxid):
+            return None
+        self._purge_not_found()
+        return self._fetch(wxid)
+
+    def search(self, prefix: str, limit: int = 20) -> List[dict]:
+        """按昵称或备注前缀查找联系人，不区分大小写"""
+        self._ensure_fresh()
+        prefix = prefix.lower()
+        results = []
+        seen = set()
+        with self._lock:
+            i = bisect.bisect_left(self._names, (prefix, ""))
+            while i < len(self._names) and len(results) < limit:
+                name, wxid = self._names[i]
+                if not name.startswith(prefix):
+                    break
+                if wxid not in seen:
+                    seen.add(wxid)
+                    results.append(self._contacts[wxid])
+                i += 1
+        return results
+
+    def stats(self):
+        return {
+            "contacts": len(self._contacts),
+            "not_found": len(self._not_found),
+            "fetches": self.fetches,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "fresh": self.is_fresh,
+        }
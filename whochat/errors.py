@@ -0,0 +1,41 @@
+"""
+微信机器人错误
+
+每种错误对应一个JSON-RPC错误码(-32000至-32099为服务端自定义错误)，
+RPC调用出现这些错误时返回对应的错误码，而不是`null`结果
+"""
+
+
+class WhochatError(Exception):
+    code = -32000
+    message = "微信机器人错误"
+
+    def __init__(self, detail: str = None, wx_pid: int = None):
+        self.detail = detail
+        self.wx_pid = wx_pid
+        super().__init__(detail or self.message)
+
+    @property
+    def data(self):
+        return {"wx_pid": self.wx_pid, "detail": self.detail}
+
+
+class RobotServiceError(WhochatError):
+    """注入dll(CStartRobotService)失败"""
+
+    code = -32001
+    message = "启动机器人服务失败"
+
+
+class ComCallError(WhochatError):
+    """调用COM接口出错"""
+
+    code = -32002
+    message = "调用COM接口失败"
+
+
+class WechatNotFoundError(WhochatError):
+    """微信进程不存在或已退出"""
+
+    code = -32003
+    message = "微信进程不存在"
@@ -0,0 +1,305 @@
+"""
+基于asyncio的TCP消息接收及转发服务，协议与`whochat.messages.tcp`相同:
+
+1. Robot DLL连接后发送`ReceiveMsgStruct`，服务端回复"200 OK"
+2. 客户端连接后先发送`redirect_key`，之后每条消息以一行JSON转发给该客户端
+
+所有连接在同一事件循环中处理，COM调用在单独的线程中执行
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import sizeof
+from typing import Dict, Optional
+
+from whochat import _comtypes as comtypes
+from whochat.bot import WechatBotFactory
+from whochat.logger import logger
+from whochat.messages.dedup import MessageDeduplicator
+from whochat.messages.journal import MessageJournal, parse_resume_command
+from whochat.messages.record import REDIRECT_FORMATS, MessageRecord
+from whochat.messages.tcp import ReceiveMsgStruct
+from whochat.processes import wechat_process_registry
+from whochat.signals import Signal
+
+
+class RedirectSubscriber:
+    """
+    接收转发消息的客户端，写缓冲区超过`max_buffer`字节时丢弃新消息
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, max_buffer: int = 1024 * 1024):
+        self.writer = writer
+        self.max_buffer = max_buffer
+        self.sent = 0
+        self.dropped = 0
+        # 正在从消息日志补发时不接收新消息
+        self.replaying = False
+
+    @property
+    def peername(self):
+        return self.writer.get_extra_info("peername")
+
+    @property
+    def buffered_amount(self) -> int:
+        return self.writer.transport.get_write_buffer_size()
+
+    def write(self, data: bytes) -> bool:
+        """
+        :return: False表示连接已关闭
+        """
+        if self.writer.is_closing():
+            return False
+        if self.buffered_amount + len(data) > self.max_buffer:
+            self.dropped += 1
+            return True
+        self.writer.write(data)
+        self.sent += 1
+        return True
+
+    def stats(self):
+        return {
+            "peername": str(self.peername),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "buffered_amount": self.buffered_amount,
+            "replaying": self.replaying,
+        }
+
+
+class AsyncWechatReceiveMsgServer:
+    """
+    Com接口不支持指定IP
+    """
+
+    bot_factory = WechatBotFactory
+    msg_struct_cls = ReceiveMsgStruct
+
+    def __init__(
+        self,
+        wx_pid: int,
+        port: int,
+        redirect_key: bytes = b"",
+        subscriber_buffer_size: int = 1024 * 1024,
+        read_timeout: Optional[float] = 3,
+        journal: Optional[MessageJournal] = None,
+        resume_timeout: float = 0.2,
+        replay_batch_size: int = 500,
+        dedup_size: int = 10000,
+        dedup_window: Optional[float] = 300,
+        deduplicator: Optional[MessageDeduplicator] = None,
+        redirect_format: str = "struct",
+    ):
+        """
+        :param redirect_key: 转发Key，为空则不转发
+        :param subscriber_buffer_size: 每个转发客户端的写缓冲区大小，字节
+        :param read_timeout: 读取一条消息的超时时间，秒
+        :param journal: 消息日志，设置后客户端可以在转发Key后发送`RESUME <offset>\\n`
+            从指定offset继续接收消息
+        :param resume_timeout: 等待客户端发送`RESUME`的时间，秒
+        :param replay_batch_size: 补发消息时每次从日志读取的消息数
+        :param dedup_size: 去重时最多记录的msgid数量
+        :param dedup_window: 去重时间窗口，秒，None表示不去重
+        :param deduplicator: 去重实例，默认使用进程内共用的`MessageDeduplicator.shared`，
+            同一进程中的多个接收服务才能去除彼此收到的重复消息
+        :param redirect_format: 转发的消息格式，默认`struct`与之前的版本相同；
+            `event`与Websocket相同，包含`extrainfo`及`offset`(补发后继续接收需要offset)
+        """
+        assert len(redirect_key) <= 16
+        assert (
+            redirect_format in REDIRECT_FORMATS
+        ), f"redirect_format必须为{REDIRECT_FORMATS}之一"
+        self.redirect_format = redirect_format
+        self.wx_pid = wx_pid
+        self.port = port
+        self.redirect_key = redirect_key
+        self.subscriber_buffer_size = subscriber_buffer_size
+        self.read_timeout = read_timeout
+        self.journal = journal
+        self.resume_timeout = resume_timeout
+        self.replay_batch_size = replay_batch_size
+        if deduplicator is None:
+            deduplicator = MessageDeduplicator.shared(dedup_size, dedup_window)
+        self.deduplicator = deduplicator
+        self.bot = self.bot_factory.get(wx_pid)
+        self.subscribers: Dict[asyncio.StreamWriter, RedirectSubscriber] = {}
+        self.received = 0
+
+        self._com_executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix=f"receive-msg-{wx_pid}",
+            initializer=comtypes.CoInitializeEx,
+            initargs=(comtypes.COINIT_APARTMENTTHREADED,),
+        )
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped: Optional[asyncio.Event] = None
+
+    async def run_in_com(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._com_executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        initial_data = b""
+        try:
+            if self.redirect_key:
+                initial_data = await asyncio.wait_for(
+                    reader.readexactly(len(self.redirect_key)), self.read_timeout
+                )
+                if initial_data == self.redirect_key:
+                    await self.serve_subscriber(reader, writer)
+                    return
+            await self.receive_messages(reader, writer, initial_data)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                logger.warning(f"连接已关闭，丢弃不完整的数据: {len(e.partial)}字节")
+        except (asyncio.TimeoutError, OSError) as e:
+            logger.warning(f"接收消息错误: {e!r}")
+        finally:
+            writer.close()
+
+    async def receive_messages(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        initial_data: bytes = b"",
+    ):
+        struct_size = sizeof(self.msg_struct_cls)
+        while True:
+            data = await asyncio.wait_for(
+                reader.readexactly(struct_size - len(initial_data)),
+                self.read_timeout,
+            )
+            if initial_data:
+                data, initial_data = initial_data + data, b""
+            record = self.msg_struct_cls.from_buffer_copy(data).to_record()
+            if self.deduplicator is None or not self.deduplicator.is_duplicate(record):
+                await self.on_message(record)
+            writer.write(b"200 OK")
+            await writer.drain()
+
+    async def on_message(self, record: MessageRecord):
+        """可在子类中处理消息，需要调用COM接口时使用`run_in_com`"""
+        self.received += 1
+        logger.info(record)
+        if self.journal is not None:
+            self.journal.append(record)
+        if self.subscribers:
+            self.redirect(record.to_redirect_bytes(self.redirect_format))
+
+    def redirect(self, data: bytes):
+        for writer, subscriber in list(self.subscribers.items()):
+            if subscriber.replaying:
+                continue
+            if not subscriber.write(data):
+                self.subscribers.pop(writer, None)
+                logger.info("已移除一个接受消息转发的客户端")
+
+    async def serve_subscriber(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        subscriber = RedirectSubscriber(writer, self.subscriber_buffer_size)
+        offset = await self._read_resume_offset(reader)
+        subscriber.replaying = offset is not None
+        self.subscribers[writer] = subscriber
+        logger.info(f"已添加一个接受消息转发的客户端：{subscriber.peername}")
+        try:
+            if offset is not None:
+                await self.replay(subscriber, offset)
+            # 客户端不再发送数据，读到EOF即连接关闭
+            while await reader.read(1024):
+                pass
+        finally:
+            self.subscribers.pop(writer, None)
+            logger.info(f"接受消息转发的客户端已断开：{subscriber.peername}")
+
+    async def _read_resume_offset(self, reader: asyncio.StreamReader) -> Optional[int]:
+        if self.journal is None:
+            return None
+        try:
+            data = await asyncio.wait_for(reader.readuntil(b"\n"), self.resume_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            # 未发送RESUME的客户端只接收新消息
+            return None
+        offset = parse_resume_command(data)
+        if offset is not None:
+            offset = max(offset, self.journal.first_offset)
+            logger.info(f"客户端从offset {offset}开始补发消息")
+        return offset
+
+    async def replay(self, subscriber: RedirectSubscriber, offset: int):
+        """
+        分批从日志读取消息发送给客户端，等待写出后再读取下一批。
+        读到日志末尾后直接转为接收新消息，期间没有等待，不会遗漏或重复消息
+        """
+        writer = subscriber.writer
+        while True:
+            entries = self.journal.read(offset, self.replay_batch_size)
+            if not entries:
+                break
+            for _, data in entries:
+                writer.write(
+                    MessageRecord.journal_entry_to_redirect_bytes(
+                        data, self.redirect_format
+                    )
+                )
+            subscriber.sent += len(entries)
+            offset = entries[-1][0] + 1
+            await writer.drain()
+        subscriber.replaying = False
+        logger.info(f"客户端{subscriber.peername}补发完成")
+
+    def _start_receive_message(self):
+        self.bot.start_robot_service()
+        return self.bot.start_receive_message(self.port)
+
+    def _stop_receive_message(self):
+        self.bot.stop_receive_message()
+        return self.bot.stop_robot_service()
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "journal": self.journal.stats() if self.journal is not None else None,
+            "dedup": (
+                self.deduplicator.stats() if self.deduplicator is not None else None
+            ),
+            "subscribers": [s.stats() for s in self.subscribers.values()],
+        }
+
+    def shutdown(self):
+        """可在其他线程或信号处理程序中调用"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._server = await asyncio.start_server(
+            self.handle_connection,
+            "127.0.0.1",
+            self.port,
+            limit=sizeof(self.msg_struct_cls),
+        )
+        Signal.register_sigint(self.shutdown)
+        wechat_process_registry.watch()
+        logger.info(f"开始运行微信消息接收服务，地址为：('127.0.0.1', {self.port})")
+        if self.redirect_key:
+            logger.info(f"转发Key为: {self.redirect_key}")
+        async with self._server:
+            await self.run_in_com(self._start_receive_message)
+            try:
+                await self._stopped.wait()
+            finally:
+                for writer in list(self.subscribers):
+                    writer.close()
+                await self.run_in_com(self._stop_receive_message)
+                self._com_executor.shutdown(wait=False)
+                wechat_process_registry.stop_watching()
+                if self.journal is not None:
+                    self.journal.close()
+        logger.info("微信消息接收服务已停止")
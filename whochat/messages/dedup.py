@@ -0,0 +1,94 @@
+"""
+按`(pid, msgid)`去除重复的消息
+
+重连、同时使用Com Event和TCP接收，或一个微信进程上运行多个接收服务时，同一条消息可能被推送多次。
+同一进程中的接收服务默认共用`MessageDeduplicator.shared`返回的实例，才能识别不同服务收到的同一条消息
+"""
+import threading
+import time
+from collections import deque
+from typing import ClassVar, Deque, Dict, Hashable, Iterable, List, Optional, Tuple
+
+from whochat.messages.record import MessageRecord
+
+
+class MessageDeduplicator:
+    """
+    记录最近`window`秒内、最多`maxlen`条消息的msgid，哈希表用于查找，
+    环形队列按时间顺序记录，用于淘汰过期的msgid
+    """
+
+    _shared: ClassVar[Dict[Tuple[int, float], "MessageDeduplicator"]] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, maxlen: int = 10000, window: float = 300):
+        """
+        :param maxlen: 最多记录的msgid数量
+        :param window: msgid的有效时间，秒
+        """
+        assert maxlen > 0
+        self.maxlen = maxlen
+        self.window = window
+        self._seen: Dict[Hashable, float] = {}
+        self._ring: Deque[Tuple[float, Hashable]] = deque()
+        self._lock = threading.Lock()
+
+        self.checked = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+    @classmethod
+    def shared(
+        cls, maxlen: int = 10000, window: Optional[float] = 300
+    ) -> Optional["MessageDeduplicator"]:
+        """进程内参数相同的接收服务共用一个实例，`window`为None时不去重"""
+        if window is None:
+            return None
+        with cls._shared_lock:
+            deduplicator = cls._shared.get((maxlen, window))
+            if deduplicator is None:
+                deduplicator = cls._shared[(maxlen, window)] = cls(maxlen, window)
+            return deduplicator
+
+    def __len__(self):
+        return len(self._seen)
+
+    @staticmethod
+    def key(msg: MessageRecord) -> Hashable:
+        return msg.pid, msg.msgid
+
+    def _evict(self, now: float):
+        ring = self._ring
+        deadline = now - self.window
+        while ring and (len(ring) >= self.maxlen or ring[0][0] <= deadline):
+            _, key = ring.popleft()
+            del self._seen[key]
+            self.evicted += 1
+
+    def is_duplicate(self, msg: MessageRecord) -> bool:
+        """返回消息是否已出现过，未出现过时记录该消息。msgid为空的消息不去重"""
+        if not msg.msgid:
+            return False
+        key = self.key(msg)
+        now = time.monotonic()
+        with self._lock:
+            self.checked += 1
+            self._evict(now)
+            if key in self._seen:
+                self.duplicates += 1
+                return True
+            self._seen[key] = now
+            self._ring.append((now, key))
+            return False
+
+    def filter(self, msgs: Iterable[MessageRecord]) -> List[MessageRecord]:
+        return [msg for msg in msgs if not self.is_duplicate(msg)]
+
+    def stats(self):
+        return {
+            "checked": self.checked,
+            "duplicates": self.duplicates,
+            "hit_rate": self.duplicates / self.checked if self.checked else 0.0,
+            "size": len(self._seen),
+            "evicted": self.evicted,
+        }
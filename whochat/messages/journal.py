@@ -0,0 +1,237 @@
+"""
+接收到的消息的本地日志，断线重连的客户端可以从指定offset继续接收消息
+
+日志按段(segment)存储在目录中，文件名为该段第一条消息的offset，例如`00000000000000000000.log`，
+每条消息一行: `<offset>\\t<JSON>\\n`。offset从0开始单调递增，
+段的大小或时长超过限制时写入新的段，段数量超过`max_segments`时删除最旧的段
+"""
+import bisect
+import os
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple, Union
+
+from whochat.logger import logger
+from whochat.messages.record import MessageRecord
+
+SEGMENT_SUFFIX = ".log"
+# TCP转发客户端在转发Key后发送`RESUME <offset>\n`从指定offset继续接收消息
+RESUME_COMMAND = b"RESUME "
+
+
+def parse_resume_command(data: bytes) -> Optional[int]:
+    """解析`RESUME <offset>\n`，格式错误时返回None"""
+    if not data.startswith(RESUME_COMMAND) or not data.endswith(b"\n"):
+        return None
+    value = data[len(RESUME_COMMAND) : -1].strip()
+    return int(value) if value.isdigit() else None
+
+
+class _Segment:
+    def __init__(self, path: Path, base_offset: int):
+        self.path = path
+        self.base_offset = base_offset
+        # 稀疏索引: [(offset, 文件位置)]
+        self.index: List[Tuple[int, int]] = []
+        self.next_offset = base_offset
+        self.size = 0
+
+    def load(self, index_interval: int, truncate=False):
+        """扫描段文件建立索引，`truncate`为True时截断末尾不完整的行"""
+        self.index.clear()
+        self.next_offset = self.base_offset
+        position = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                offset = int(line[: line.index(b"\t")])
+                if (offset - self.base_offset) % index_interval == 0:
+                    self.index.append((offset, position))
+                self.next_offset = offset + 1
+                position += len(line)
+        if truncate and position != self.path.stat().st_size:
+            logger.warning(f"消息日志{self.path.name}末尾不完整，已截断")
+            with open(self.path, "r+b") as f:
+                f.truncate(position)
+        self.size = position
+
+    def seek_position(self, offset: int) -> int:
+        i = bisect.bisect_right(self.index, (offset, float("inf"))) - 1
+        return self.index[i][1] if i >= 0 else 0
+
+
+class MessageJournal:
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        segment_bytes: int = 64 * 1024 * 1024,
+        segment_seconds: Optional[float] = 24 * 3600,
+        max_segments: int = 16,
+        index_interval: int = 256,
+        fsync: bool = False,
+    ):
+        """
+        :param directory: 日志目录，不存在时自动创建
+        :param segment_bytes: 单个段的最大字节数
+        :param segment_seconds: 单个段的最长写入时间，秒，None表示不限制
+        :param max_segments: 最多保留的段数量
+        :param index_interval: 每隔多少条消息记录一次索引
+        :param fsync: 每次写入后是否调用`os.fsync`
+        """
+        assert max_segments > 0
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.max_segments = max_segments
+        self.index_interval = index_interval
+        self.fsync = fsync
+
+        self._lock = threading.RLock()
+        self._segments: List[_Segment] = []
+        self._file: Optional[BinaryIO] = None
+        self._segment_started = 0.0
+        self.appended = 0
+        self.deleted_segments = 0
+        self._open()
+
+    def _segment_path(self, base_offset: int) -> Path:
+        return self.directory.joinpath(f"{base_offset:020d}{SEGMENT_SUFFIX}")
+
+    def _open(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for path in sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}")):
+            try:
+                base_offset = int(path.stem)
+            except ValueError:
+                continue
+            self._segments.append(_Segment(path, base_offset))
+        if not self._segments:
+            self._new_segment(0)
+            return
+        self._apply_retention()
+        for segment in self._segments[:-1]:
+            segment.load(self.index_interval)
+        active = self._segments[-1]
+        active.load(self.index_interval, truncate=True)
+        self._file = open(active.path, "ab")
+        self._segment_started = time.time()
+        logger.info(
+            f"已加载消息日志: {self.directory}, offset: {self.first_offset}~{self.next_offset}"
+        )
+
+    def _new_segment(self, base_offset: int):
+        if self._file is not None:
+            self._file.close()
+        segment = _Segment(self._segment_path(base_offset), base_offset)
+        self._segments.append(segment)
+        self._file = open(segment.path, "ab")
+        self._segment_started = time.time()
+        self._apply_retention()
+
+    def _apply_retention(self):
+        while len(self._segments) > self.max_segments:
+            oldest = self._segments.pop(0)
+            try:
+                oldest.path.unlink()
+            except OSError as e:
+                logger.warning(f"删除消息日志失败: {e!r}")
+            self.deleted_segments += 1
+
+    def _should_rotate(self) -> bool:
+        active = self._segments[-1]
+        if active.next_offset == active.base_offset:
+            return False
+        if active.size >= self.segment_bytes:
+            return True
+        return (
+            self.segment_seconds is not None
+            and time.time() - self._segment_started >= self.segment_seconds
+        )
+
+    @property
+    def first_offset(self) -> int:
+        return self._segments[0].base_offset
+
+    @property
+    def next_offset(self) -> int:
+        """下一条消息的offset"""
+        return self._segments[-1].next_offset
+
+    def append(self, record: MessageRecord) -> int:
+        return self.append_many((record,))
+
+    def append_many(self, records: Iterable[MessageRecord]) -> int:
+        """
+        写入消息并设置每条消息的`offset`，所有消息写入后flush一次
+
+        :return: 最后一条消息的offset，没有消息时为`next_offset - 1`
+        """
+        with self._lock:
+            for record in records:
+                if self._should_rotate():
+                    self._file.flush()
+                    self._new_segment(self.next_offset)
+                active = self._segments[-1]
+                offset = active.next_offset
+                record.offset = offset
+                line = b"%d\t%s\n" % (offset, record.to_json_bytes())
+                if (offset - active.base_offset) % self.index_interval == 0:
+                    active.index.append((offset, active.size))
+                self._file.write(line)
+                active.size += len(line)
+                active.next_offset = offset + 1
+                self.appended += 1
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            return self.next_offset - 1
+
+    def read(self, offset: int, limit: int = 500) -> List[Tuple[int, bytes]]:
+        """
+        读取从`offset`开始的最多`limit`条消息，`offset`早于最旧的消息时从最旧的消息开始
+
+        :return: [(offset, JSON)]
+        """
+        with self._lock:
+            offset = max(offset, self.first_offset)
+            if offset >= self.next_offset:
+                return []
+            bases = [segment.base_offset for segment in self._segments]
+            i = bisect.bisect_right(bases, offset) - 1
+            entries = []
+            for segment in self._segments[i:]:
+                if len(entries) >= limit:
+                    break
+                if segment.next_offset <= offset:
+                    continue
+                with open(segment.path, "rb") as f:
+                    f.seek(segment.seek_position(offset))
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            break
+                        sep = line.index(b"\t")
+                        line_offset = int(line[:sep])
+                        if line_offset < offset:
+                            continue
+                        entries.append((line_offset, line[sep + 1 : -1]))
+                        if len(entries) >= limit:
+                            break
+            return entries
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "first_offset": self.first_offset,
+            "next_offset": self.next_offset,
+            "segments": len(self._segments),
+            "size": sum(segment.size for segment in self._segments),
+            "appended": self.appended,
+            "deleted_segments": self.deleted_segments,
+        }
@@ -0,0 +1,183 @@
+"""
+解析群消息的`extrainfo`(msgsource)
+
+Windows 3.9.2.26:
+<msgsource>
+    <atuserlist><![CDATA[,wxid_enuyja8axoz92,wxid_enuyjaxoz922,wxid_ctg8dfsen122]]></atuserlist>
+    <silence>0</silence>
+    <membercount>12</membercount>
+    <signature>v1_6XIdCSDF</signature>
+    <tmp_node>
+        <publisher-id>&lt;![CDATA[]]&gt;</publisher-id>
+    </tmp_node>
+</msgsource>
+
+Mac 3.7.0:
+<msgsource>
+    <atuserlist>wxid_enuyja8axoz92</atuserlist>
+    <alnode>
+        <fr>1</fr>
+    </alnode>
+    <silence>0</silence>
+    <membercount>12</membercount>
+    <signature>v1_JVxT4Vi9</signature>
+    <tmp_node>
+        <publisher-id>&lt;![CDATA[]]&gt;</publisher-id>
+    </tmp_node>
+</msgsource>
+
+Android 8.0.35:
+<msgsource>
+    <atuserlist><![CDATA[wxid_enuyja8axoz92]]></atuserlist>
+    <silence>0</silence>
+    <membercount>12</membercount>
+    <signature>v1_VQrQyKdq</signature>
+    <tmp_node>
+        <publisher-id>&lt;![CDATA[]]&gt;</publisher-id>
+    </tmp_node>
+</msgsource>
+"""
+import re
+from typing import List, Optional, Tuple
+
+# 三个平台的msgsource节点顺序相同，一次`match`提取全部字段；不符合时(有未知节点等)逐个字段查找。
+# CDATA与不带CDATA的内容分别用两个分组匹配，节点内容尽量用`[^<]*`，比字符集更快
+_match_layout = re.compile(
+    r"\s*<msgsource>\s*"
+    r"(?:<atuserlist>(?:<!\[CDATA\[,?([^\]]*)\]\]>|([^<]*))</atuserlist>\s*)?"
+    r"(?:<alnode>.*?</alnode>\s*)?"
+    r"(?:<silence>([^<]*)</silence>\s*)?"
+    r"(?:<membercount>(\d*)</membercount>\s*)?"
+    r"(?:<signature>([^<]*)</signature>\s*)?"
+    r"(?:<tmp_node>\s*<publisher-id>"
+    r"(?:&lt;!\[CDATA\[([^\]]*)\]\]&gt;|([^<]*))"
+    r"</publisher-id>\s*</tmp_node>\s*)?"
+    r"</msgsource>\s*$",
+    re.S,
+).match
+
+
+def _between(raw: str, open_tag: str, close_tag: str) -> Optional[str]:
+    """返回第一个`open_tag`与其后`close_tag`之间的文本，没有该节点或节点不完整时返回None"""
+    start = raw.find(open_tag)
+    if start < 0:
+        return None
+    start += len(open_tag)
+    end = raw.find(close_tag, start)
+    if end < 0:
+        return None
+    return raw[start:end]
+
+
+def _unwrap(value: Optional[str], prefix: str, suffix: str) -> Optional[str]:
+    if value and value.startswith(prefix) and value.endswith(suffix):
+        return value[len(prefix) : -len(suffix)]
+    return value
+
+
+def _scan(raw: str) -> Tuple[Optional[str], ...]:
+    """不符合固定节点顺序时逐个查找，返回与`_match_layout`相同的分组"""
+    member_count = _between(raw, "<membercount>", "</membercount>")
+    return (
+        _unwrap(_between(raw, "<atuserlist>", "</atuserlist>"), "<![CDATA[", "]]>"),
+        None,
+        _between(raw, "<silence>", "</silence>"),
+        member_count if member_count and member_count.isdigit() else None,
+        _between(raw, "<signature>", "</signature>"),
+        # publisher-id中的CDATA被转义
+        _unwrap(
+            _between(raw, "<publisher-id>", "</publisher-id>"), "&lt;![CDATA[", "]]&gt;"
+        ),
+        None,
+    )
+
+
+def _parse(raw: str) -> dict:
+    m = _match_layout(raw)
+    (
+        at_user_list,
+        at_user_list_text,
+        silence,
+        member_count,
+        signature,
+        publisher_id,
+        publisher_id_text,
+    ) = (
+        m.groups() if m is not None else _scan(raw)
+    )
+    at_user_list = at_user_list or at_user_list_text
+    if at_user_list:
+        # Windows以逗号开头: ",wxid_a,wxid_b"
+        if (
+            at_user_list[0] == ","
+            or at_user_list[-1] == ","
+            or " " in at_user_list
+            or ",," in at_user_list
+        ):
+            at_user_list = [
+                wxid for wxid in map(str.strip, at_user_list.split(",")) if wxid
+            ]
+        else:
+            at_user_list = at_user_list.split(",")
+    else:
+        at_user_list = []
+    return {
+        "is_at_msg": bool(at_user_list),
+        "at_user_list": at_user_list,
+        "member_count": int(member_count) if member_count else None,
+        "silence": silence == "1",
+        "signature": signature,
+        "publisher_id": publisher_id or publisher_id_text or None,
+    }
+
+
+class MsgSource:
+    """
+    创建时一次提取全部字段，`as_dict`返回同一个字典，
+    广播、日志及转发多次序列化同一条消息时不再重复解析。
+    `MessageRecord.msgsource`在首次访问时才创建
+    """
+
+    __slots__ = ("raw", "_fields")
+
+    def __init__(self, raw: str = ""):
+        self.raw = raw or ""
+        self._fields = _parse(self.raw)
+
+    @property
+    def at_user_list(self) -> List[str]:
+        return self._fields["at_user_list"]
+
+    @property
+    def is_at_msg(self) -> bool:
+        return self._fields["is_at_msg"]
+
+    @property
+    def member_count(self) -> Optional[int]:
+        return self._fields["member_count"]
+
+    @property
+    def silence(self) -> bool:
+        return self._fields["silence"]
+
+    @property
+    def signature(self) -> Optional[str]:
+        return self._fields["signature"]
+
+    @property
+    def publisher_id(self) -> Optional[str]:
+        return self._fields["publisher_id"]
+
+    def as_dict(self, include_raw=False) -> dict:
+        """返回缓存的字典，调用方不应修改"""
+        if include_raw:
+            return {**self._fields, "raw": self.raw}
+        return self._fields
+
+    def __repr__(self):
+        return f"<MsgSource {self._fields}>"
+
+
+def parse_msgsource(extrainfo: str) -> MsgSource:
+    """不依赖XML解析器，结果应只创建一次并共享"""
+    return MsgSource(extrainfo)
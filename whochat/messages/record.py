@@ -0,0 +1,210 @@
+import json
+from typing import Optional
+
+from whochat.messages.msgsource import MsgSource, parse_msgsource
+
+# TCP转发的消息格式: struct为`ReceiveMsgStruct`的字段(默认，与之前的版本相同)，
+# event与Websocket相同，包含`extrainfo`及`offset`
+REDIRECT_FORMATS = ("struct", "event")
+
+
+class MessageRecord:
+    """
+    接收到的微信消息，Com Event和TCP两种接收方式共用。
+    群消息的`extrainfo`在首次访问时解析，JSON在首次序列化后缓存
+    """
+
+    __slots__ = (
+        "pid",
+        "type",
+        "is_send_msg",
+        "msgid",
+        "sender",
+        "wxid",
+        "message",
+        "filepath",
+        "time",
+        "_offset",
+        "_raw_extrainfo",
+        "_msgsource",
+        "_extra",
+        "_json",
+        "_struct_json",
+    )
+
+    _event_keys = frozenset(
+        (
+            "pid",
+            "type",
+            "isSendMsg",
+            "msgid",
+            "sender",
+            "wxid",
+            "message",
+            "filepath",
+            "time",
+            "extrainfo",
+            "offset",
+        )
+    )
+
+    def __init__(
+        self,
+        pid: int,
+        type: int,
+        is_send_msg: int,
+        msgid: int,
+        sender: str,
+        wxid: str,
+        message: str,
+        filepath: str,
+        time: str,
+        extrainfo: Optional[str] = None,
+        extra: Optional[dict] = None,
+        offset: Optional[int] = None,
+    ):
+        self.pid = pid
+        self.type = type
+        self.is_send_msg = is_send_msg
+        self.msgid = msgid
+        self.sender = sender
+        self.wxid = wxid
+        self.message = message
+        self.filepath = filepath
+        self.time = time
+        # 写入消息日志后的offset，参见`whochat.messages.journal`
+        self._offset = offset
+        # 仅群消息有extrainfo
+        self._raw_extrainfo = extrainfo if self.is_chatroom_msg else None
+        self._msgsource: Optional[MsgSource] = None
+        # 未知字段
+        self._extra = extra
+        self._json: Optional[bytes] = None
+        self._struct_json: Optional[bytes] = None
+
+    @classmethod
+    def from_event_dict(cls, data: dict) -> "MessageRecord":
+        """Com Event推送的JSON消息"""
+        extra = None
+        if not cls._event_keys.issuperset(data):
+            extra = {k: v for k, v in data.items() if k not in cls._event_keys}
+        return cls(
+            data["pid"],
+            data["type"],
+            data["isSendMsg"],
+            data["msgid"],
+            data["sender"],
+            data["wxid"],
+            data["message"],
+            data["filepath"],
+            data["time"],
+            extrainfo=data.get("extrainfo"),
+            extra=extra,
+            offset=data.get("offset"),
+        )
+
+    @classmethod
+    def from_json_bytes(cls, data: bytes) -> "MessageRecord":
+        """`to_json_bytes`的结果，如消息日志中的消息"""
+        return cls.from_event_dict(json.loads(data))
+
+    @classmethod
+    def from_struct(cls, struct) -> "MessageRecord":
+        """参见`whochat.messages.tcp.ReceiveMsgStruct`"""
+        return cls(
+            struct.pid,
+            struct.type,
+            struct.is_send_msg,
+            struct.msgid,
+            struct.sender,
+            struct.wxid,
+            struct.message,
+            struct.filepath,
+            struct.time,
+        )
+
+    @property
+    def offset(self) -> Optional[int]:
+        return self._offset
+
+    @offset.setter
+    def offset(self, value: int):
+        self._offset = value
+        self._json = None
+
+    @property
+    def is_chatroom_msg(self) -> bool:
+        return "@chatroom" in self.sender
+
+    @property
+    def msgsource(self) -> Optional[MsgSource]:
+        if self._msgsource is None and self._raw_extrainfo is not None:
+            self._msgsource = parse_msgsource(self._raw_extrainfo)
+        return self._msgsource
+
+    @property
+    def is_at_msg(self) -> bool:
+        msgsource = self.msgsource
+        return msgsource is not None and msgsource.is_at_msg
+
+    def to_dict(self) -> dict:
+        msgsource = self.msgsource
+        d = {
+            "pid": self.pid,
+            "type": self.type,
+            "isSendMsg": self.is_send_msg,
+            "msgid": self.msgid,
+            "sender": self.sender,
+            "wxid": self.wxid,
+            "message": self.message,
+            "filepath": self.filepath,
+            "time": self.time,
+            "extrainfo": msgsource.as_dict() if msgsource is not None else None,
+        }
+        if self._offset is not None:
+            d["offset"] = self._offset
+        if self._extra:
+            d.update(self._extra)
+        return d
+
+    def to_json_bytes(self) -> bytes:
+        if self._json is None:
+            self._json = json.dumps(self.to_dict()).encode("utf-8")
+        return self._json
+
+    def to_struct_dict(self) -> dict:
+        """与`ReceiveMsgStruct`字段相同的格式，TCP转发默认使用"""
+        return {
+            "pid": self.pid,
+            "type": self.type,
+            "is_send_msg": self.is_send_msg,
+            "msgid": self.msgid,
+            "sender": self.sender,
+            "wxid": self.wxid,
+            "message": self.message,
+            "filepath": self.filepath,
+            "time": self.time,
+        }
+
+    def to_struct_json_bytes(self) -> bytes:
+        if self._struct_json is None:
+            self._struct_json = json.dumps(self.to_struct_dict()).encode("utf-8")
+        return self._struct_json
+
+    def to_redirect_bytes(self, redirect_format: str = "struct") -> bytes:
+        """TCP转发的一行消息，参见`REDIRECT_FORMATS`"""
+        if redirect_format == "event":
+            return self.to_json_bytes() + b"\n"
+        return self.to_struct_json_bytes() + b"\n"
+
+    @classmethod
+    def journal_entry_to_redirect_bytes(
+        cls, data: bytes, redirect_format: str = "struct"
+    ) -> bytes:
+        """将消息日志中的消息转为TCP转发的格式"""
+        if redirect_format == "event":
+            return data + b"\n"
+        return cls.from_json_bytes(data).to_struct_json_bytes() + b"\n"
+
+    def __repr__(self):
+        return f"<MessageRecord {self.to_dict()}>"
@@ -0,0 +1,155 @@
+"""
+消息订阅过滤
+
+客户端发送订阅消息后只接收匹配的微信消息，未订阅的客户端接收所有消息:
+
+{
+    "subscribe": {
+        "wx_pids": [12345],
+        "senders": ["20813132945@chatroom"],
+        "types": [1, 3],
+        "is_at_msg": true,
+        "is_send_msg": false
+    }
+}
+
+各字段均可省略，省略表示不过滤；`{"subscribe": {}}`恢复接收所有消息
+"""
+import dataclasses
+from collections import defaultdict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set
+
+from whochat.messages.record import MessageRecord
+
+
+@dataclasses.dataclass(frozen=True)
+class Subscription:
+    wx_pids: Optional[frozenset] = None
+    senders: Optional[frozenset] = None
+    types: Optional[frozenset] = None
+    is_at_msg: Optional[bool] = None
+    is_send_msg: Optional[bool] = None
+
+    @classmethod
+    def from_dict(cls, filters: Dict[str, Any]) -> "Subscription":
+        if not isinstance(filters, dict):
+            raise ValueError("订阅条件必须为JSON对象")
+        unknown = set(filters) - {f.name for f in dataclasses.fields(cls)}
+        if unknown:
+            raise ValueError(f"未知的订阅条件: {', '.join(sorted(unknown))}")
+
+        def to_set(name, type_):
+            value = filters.get(name)
+            if value is None:
+                return None
+            if not isinstance(value, list):
+                raise ValueError(f"'{name}'必须为列表")
+            try:
+                return frozenset(type_(v) for v in value)
+            except (TypeError, ValueError):
+                raise ValueError(f"'{name}'的元素类型错误")
+
+        def to_bool(name):
+            value = filters.get(name)
+            if value is not None and not isinstance(value, bool):
+                raise ValueError(f"'{name}'必须为布尔值")
+            return value
+
+        return cls(
+            wx_pids=to_set("wx_pids", int),
+            senders=to_set("senders", str),
+            types=to_set("types", int),
+            is_at_msg=to_bool("is_at_msg"),
+            is_send_msg=to_bool("is_send_msg"),
+        )
+
+    def as_dict(self):
+        return {
+            name: sorted(value) if isinstance(value, frozenset) else value
+            for name, value in dataclasses.asdict(self).items()
+        }
+
+    def match(self, msg: MessageRecord) -> bool:
+        """`senders`由`SubscriptionIndex`预先过滤，此处不再检查"""
+        if self.wx_pids is not None and msg.pid not in self.wx_pids:
+            return False
+        if self.types is not None and msg.type not in self.types:
+            return False
+        if self.is_at_msg is not None and msg.is_at_msg != self.is_at_msg:
+            return False
+        if self.is_send_msg is not None and bool(msg.is_send_msg) != self.is_send_msg:
+            return False
+        return True
+
+    def match_event_dict(self, data: Dict[str, Any]) -> bool:
+        """
+        匹配已序列化的消息(`MessageRecord.to_dict`，如消息日志中的消息)，包括`senders`。
+        其中`extrainfo`已是解析后的字典，不再构造`MessageRecord`
+        """
+        if self.senders is not None and data.get("sender") not in self.senders:
+            return False
+        if self.wx_pids is not None and data.get("pid") not in self.wx_pids:
+            return False
+        if self.types is not None and data.get("type") not in self.types:
+            return False
+        if self.is_at_msg is not None:
+            extrainfo = data.get("extrainfo")
+            is_at_msg = isinstance(extrainfo, dict) and bool(extrainfo.get("is_at_msg"))
+            if is_at_msg != self.is_at_msg:
+                return False
+        if (
+            self.is_send_msg is not None
+            and bool(data.get("isSendMsg")) != self.is_send_msg
+        ):
+            return False
+        return True
+
+
+class SubscriptionIndex:
+    """
+    按`sender`索引订阅，每条消息只需检查订阅了该`sender`或未限制`sender`的客户端
+    """
+
+    def __init__(self):
+        self._subscriptions: Dict[Hashable, Subscription] = {}
+        self._by_sender: Dict[str, Set[Hashable]] = defaultdict(set)
+        self._any_sender: Set[Hashable] = set()
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def get(self, client) -> Optional[Subscription]:
+        return self._subscriptions.get(client)
+
+    def add(self, client, subscription: Subscription = None):
+        self.remove(client)
+        subscription = subscription or Subscription()
+        self._subscriptions[client] = subscription
+        if subscription.senders is None:
+            self._any_sender.add(client)
+        else:
+            for sender in subscription.senders:
+                self._by_sender[sender].add(client)
+
+    def remove(self, client):
+        subscription = self._subscriptions.pop(client, None)
+        if subscription is None:
+            return
+        if subscription.senders is None:
+            self._any_sender.discard(client)
+        else:
+            for sender in subscription.senders:
+                clients = self._by_sender[sender]
+                clients.discard(client)
+                if not clients:
+                    del self._by_sender[sender]
+
+    def match(self, msg: MessageRecord) -> Iterable[Hashable]:
+        candidates = self._by_sender.get(msg.sender)
+        for client in self._any_sender:
+            if self._subscriptions[client].match(msg):
+                yield client
+        if candidates:
+            for client in candidates:
+                if self._subscriptions[client].match(msg):
+                    yield client
@@ -1,17 +1,19 @@
 """不推荐：使用Com Event"""
-import json
+import selectors
 import socket
 import socketserver
 import threading
-import time
 import typing
 from collections import deque
 from ctypes import Structure, c_ulonglong, c_wchar, sizeof, wintypes
 
-import comtypes
-
+from whochat import _comtypes as comtypes
 from whochat.bot import WechatBot, WechatBotFactory
 from whochat.logger import logger
+from whochat.messages.dedup import MessageDeduplicator
+from whochat.messages.journal import MessageJournal, parse_resume_command
+from whochat.messages.record import REDIRECT_FORMATS, MessageRecord
+from whochat.processes import wechat_process_registry
 from whochat.signals import Signal
 
 
@@ -35,6 +37,47 @@ class ReceiveMsgStruct(Structure):
     def to_dict(self):
         return {attname: getattr(self, attname) for attname, _ in self._fields_}
 
+    def to_record(self) -> MessageRecord:
+        return MessageRecord.from_struct(self)
+
+
+class StructReader:
+    """
+    从socket读取定长的结构体，使用`recv_into`写入预分配的缓冲区，
+    结构体直接映射该缓冲区，不会复制数据，也不会读取超出一个结构体的数据
+    """
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        struct_cls: typing.Type[Structure] = ReceiveMsgStruct,
+        initial_data: bytes = b"",
+    ):
+        self.sock = sock
+        self.struct_cls = struct_cls
+        self.size = sizeof(struct_cls)
+        assert len(initial_data) <= self.size
+        self._buffer = bytearray(self.size)
+        self._view = memoryview(self._buffer)
+        self._buffer[: len(initial_data)] = initial_data
+        self._filled = len(initial_data)
+
+    def read(self) -> typing.Optional[Structure]:
+        """
+        读取一个完整的结构体，连接关闭时返回None。
+        返回的结构体与缓冲区共享内存，仅在下一次`read`之前有效
+        """
+        while self._filled < self.size:
+            n = self.sock.recv_into(self._view[self._filled :])
+            if n == 0:
+                if self._filled:
+                    logger.warning(f"连接已关闭，丢弃不完整的数据: {self._filled}字节")
+                    self._filled = 0
+                return None
+            self._filled += n
+        self._filled = 0
+        return self.struct_cls.from_buffer(self._buffer)
+
 
 class ReceiveMsgHandler(socketserver.BaseRequestHandler):
     timeout = 3
@@ -48,12 +91,9 @@ class ReceiveMsgHandler(socketserver.BaseRequestHandler):
     def handle(self) -> None:
         comtypes.CoInitialize()
         try:
-            data = self.request.recv(1024)
-            struct_size = sizeof(ReceiveMsgStruct)
-            while len(data) < struct_size:
-                data += self.request.recv(1024)
-
-            msg = self.msg_struct_cls.from_bytes(data)
+            msg = StructReader(self.request, self.msg_struct_cls).read()
+            if msg is None:
+                return
             self._handle(msg, self.server.bot)
             self.request.sendall(b"200 OK")
         except OSError as e:
@@ -87,34 +127,37 @@ class WechatReceiveMsgTCPServer(socketserver.ThreadingTCPServer):
 
     def serve_forever(self, poll_interval=0.5) -> None:
         logger.info(f"开始运行微信消息接收服务，地址为：{self.server_address}")
-        with self.bot:
-            self.bot.start_receive_message(self.port)
-            super().serve_forever(poll_interval)
+        wechat_process_registry.watch()
+        try:
+            with self.bot:
+                self.bot.start_receive_message(self.port)
+                super().serve_forever(poll_interval)
+        finally:
+            wechat_process_registry.stop_watching()
 
 
 class StoreReceiveMsgHandler(ReceiveMsgHandler):
     def __init__(
-        self, request, client_address, server, queue: deque[dict], initial_data=b""
+        self,
+        request,
+        client_address,
+        server,
+        queue: "RedirectQueue",
+        initial_data=b"",
     ):
         self.dqueue = queue
         self.initial_data = initial_data
         super(StoreReceiveMsgHandler, self).__init__(request, client_address, server)
 
     def handle(self) -> None:
-        data = self.initial_data
+        reader = StructReader(self.request, self.msg_struct_cls, self.initial_data)
         comtypes.CoInitialize()
         try:
             while True:
-                data += self.request.recv(1024)
-                struct_size = sizeof(ReceiveMsgStruct)
-                while len(data) < struct_size:
-                    buf = self.request.recv(1024)
-                    if not buf:
-                        return
-                    data += buf
-                msg = self.msg_struct_cls.from_bytes(data)
+                msg = reader.read()
+                if msg is None:
+                    return
                 self._handle(msg, self.server.bot)
-                data = b""
                 self.request.sendall(b"200 OK")
         except OSError as e:
             logger.exception(e)
@@ -122,14 +165,139 @@ class StoreReceiveMsgHandler(ReceiveMsgHandler):
             comtypes.CoUninitialize()
 
     def _handle(self, msg: ReceiveMsgStruct, bot: typing.Optional[WechatBot] = None):
-        msg_dict = msg.to_dict()
-        logger.info(msg_dict)
-        self.dqueue.append(msg_dict)
+        record = msg.to_record()
+        logger.info(record)
+        self.dqueue.append(record)
+
+
+class RedirectQueue:
+    """
+    接收线程写入、转发线程批量取出的消息队列。
+    写入时通过socketpair唤醒转发线程的selector，队列满时丢弃最旧的消息并计数
+    """
+
+    def __init__(self, maxlen: int = 1000):
+        self.maxlen = maxlen
+        self.dropped = 0
+        self._deque: "deque[MessageRecord]" = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self._signalled = False
+        self.wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+
+    def __len__(self):
+        return len(self._deque)
+
+    def append(self, msg: MessageRecord):
+        with self._lock:
+            if len(self._deque) == self.maxlen:
+                self.dropped += 1
+            self._deque.append(msg)
+        self.wakeup()
+
+    def wakeup(self):
+        with self._lock:
+            if self._signalled:
+                return
+            self._signalled = True
+        try:
+            self._wakeup_writer.send(b"\0")
+        except OSError:
+            pass
+
+    def clear_wakeup(self):
+        with self._lock:
+            self._signalled = False
+        try:
+            while self.wakeup_reader.recv(1024):
+                pass
+        except OSError:
+            pass
+
+    def drain(self) -> typing.List[MessageRecord]:
+        with self._lock:
+            batch = list(self._deque)
+            self._deque.clear()
+        return batch
+
+    def close(self):
+        self.wakeup_reader.close()
+        self._wakeup_writer.close()
+
+
+class RedirectClient:
+    """
+    接受消息转发的客户端，使用非阻塞socket和独立的发送缓冲区，
+    缓冲区超过`max_buffer`字节时丢弃新消息
+    """
+
+    def __init__(
+        self,
+        sock: socket.socket,
+        address,
+        max_buffer: int = 1024 * 1024,
+        replay_offset: typing.Optional[int] = None,
+    ):
+        """
+        :param replay_offset: 从消息日志中补发消息的下一个offset，补发完成后为None
+        """
+        self.sock = sock
+        self.address = address
+        self.max_buffer = max_buffer
+        self.replay_offset = replay_offset
+        self.sent = 0
+        self.dropped = 0
+        self._buffer = bytearray()
+        sock.setblocking(False)
+
+    @property
+    def pending(self) -> int:
+        return len(self._buffer)
+
+    def put(self, data: bytes):
+        if len(self._buffer) + len(data) > self.max_buffer:
+            self.dropped += 1
+            return
+        self._buffer += data
+        self.sent += 1
+
+    def flush(self) -> bool:
+        """
+        :return: False表示连接已断开
+        """
+        while self._buffer:
+            try:
+                n = self.sock.send(self._buffer)
+            except (BlockingIOError, InterruptedError):
+                return True
+            except OSError:
+                return False
+            del self._buffer[:n]
+        return True
+
+    def is_alive(self) -> bool:
+        """客户端不应发送数据，可读时读到EOF即连接已关闭"""
+        try:
+            return bool(self.sock.recv(1024))
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+
+    def stats(self):
+        return {
+            "address": str(self.address),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "pending": self.pending,
+            "replay_offset": self.replay_offset,
+        }
 
 
 class WechatReceiveMsgRedirectTCPServer(WechatReceiveMsgTCPServer):
     RequestHandlerClass: typing.Callable[..., StoreReceiveMsgHandler]
-    dqueue: deque[dict]
+    dqueue: RedirectQueue
 
     def __init__(
         self,
@@ -139,12 +307,47 @@ class WechatReceiveMsgRedirectTCPServer(WechatReceiveMsgTCPServer):
         RequestHandlerClass: typing.Callable[
             ..., StoreReceiveMsgHandler
         ] = StoreReceiveMsgHandler,
+        queue_size: int = 1000,
+        redirect_buffer_size: int = 1024 * 1024,
+        journal: typing.Optional[MessageJournal] = None,
+        resume_timeout: float = 0.2,
+        replay_batch_size: int = 500,
+        dedup_size: int = 10000,
+        dedup_window: typing.Optional[float] = 300,
+        deduplicator: typing.Optional[MessageDeduplicator] = None,
+        redirect_format: str = "struct",
         **kwargs,
     ):
+        """
+        :param queue_size: 待转发消息队列大小
+        :param redirect_buffer_size: 每个转发客户端的发送缓冲区大小，字节
+        :param journal: 消息日志，设置后客户端可以在转发Key后发送`RESUME <offset>\\n`
+            从指定offset继续接收消息
+        :param resume_timeout: 等待客户端发送`RESUME`的时间，秒
+        :param replay_batch_size: 补发消息时每次从日志读取的消息数
+        :param dedup_size: 去重时最多记录的msgid数量
+        :param dedup_window: 去重时间窗口，秒，None表示不去重
+        :param deduplicator: 去重实例，默认使用进程内共用的`MessageDeduplicator.shared`，
+            同一进程中的多个接收服务才能去除彼此收到的重复消息
+        :param redirect_format: 转发的消息格式，默认`struct`与之前的版本相同；
+            `event`与Websocket相同，包含`extrainfo`及`offset`(补发后继续接收需要offset)
+        """
+        assert (
+            redirect_format in REDIRECT_FORMATS
+        ), f"redirect_format必须为{REDIRECT_FORMATS}之一"
+        self.redirect_format = redirect_format
         self.port = port
-        self.dqueue = deque(maxlen=100)
-        # addr tuple -> socket client which need to redirect message
-        self.redirects: set[socket.socket] = set()
+        self.dqueue = RedirectQueue(maxlen=queue_size)
+        self.redirect_buffer_size = redirect_buffer_size
+        self.journal = journal
+        self.resume_timeout = resume_timeout
+        self.replay_batch_size = replay_batch_size
+        if deduplicator is None:
+            deduplicator = MessageDeduplicator.shared(dedup_size, dedup_window)
+        self.deduplicator = deduplicator
+        # socket -> client which need to redirect message
+        self.redirects: typing.Dict[socket.socket, RedirectClient] = {}
+        self._new_redirects: "deque[RedirectClient]" = deque()
         self.redirect_key = redirect_key
         self.stop_redirect = False
         assert len(self.redirect_key) <= 16
@@ -156,7 +359,16 @@ class WechatReceiveMsgRedirectTCPServer(WechatReceiveMsgTCPServer):
         if self.redirect_key:
             flag = request.recv(len(self.redirect_key))
             if flag == self.redirect_key:
-                self.redirects.add(request)
+                client = RedirectClient(
+                    request,
+                    client_address,
+                    self.redirect_buffer_size,
+                    replay_offset=self._read_resume_offset(request),
+                )
+                self.redirects[request] = client
+                # 由转发线程注册到selector
+                self._new_redirects.append(client)
+                self.dqueue.wakeup()
                 logger.info(f"已添加一个接受消息转发的客户端：{client_address}")
             else:
                 self.RequestHandlerClass(
@@ -165,6 +377,26 @@ class WechatReceiveMsgRedirectTCPServer(WechatReceiveMsgTCPServer):
         else:
             self.RequestHandlerClass(request, client_address, self, self.dqueue)
 
+    def _read_resume_offset(self, request: socket.socket) -> typing.Optional[int]:
+        if self.journal is None:
+            return None
+        data = b""
+        request.settimeout(self.resume_timeout)
+        try:
+            while not data.endswith(b"\n") and len(data) < 32:
+                chunk = request.recv(32 - len(data))
+                if not chunk:
+                    break
+                data += chunk
+        except OSError:
+            # 未发送RESUME的客户端只接收新消息
+            return None
+        offset = parse_resume_command(data)
+        if offset is not None:
+            offset = max(offset, self.journal.first_offset)
+            logger.info(f"客户端从offset {offset}开始补发消息")
+        return offset
+
     def shutdown_request(self, request) -> None:
         if request in self.redirects:
             return
@@ -173,6 +405,7 @@ class WechatReceiveMsgRedirectTCPServer(WechatReceiveMsgTCPServer):
     def shutdown(self) -> None:
         super().shutdown()
         self.stop_redirect = True
+        self.dqueue.wakeup()
         self.bot_factory.kill_robot()
 
     def serve_forever_in_thread(self, poll_interval=0.5, daemon=True):
@@ -186,25 +419,133 @@ class WechatReceiveMsgRedirectTCPServer(WechatReceiveMsgTCPServer):
         t.start()
         return t
 
+    def remove_redirect(self, client: RedirectClient, selector=None):
+        if self.redirects.pop(client.sock, None) is None:
+            return
+        if selector is not None and client.sock in selector.get_map():
+            selector.unregister(client.sock)
+        super().shutdown_request(client.sock)
+        logger.info(f"已移除一个接受消息转发的客户端：{client.address}")
+
+    def _register_new_redirects(self, selector: selectors.BaseSelector):
+        while self._new_redirects:
+            client = self._new_redirects.popleft()
+            if client.sock in self.redirects:
+                selector.register(client.sock, selectors.EVENT_READ, client)
+
+    def _replay(self, client: RedirectClient) -> bool:
+        """
+        从日志读取一批消息写入客户端的发送缓冲区，读到日志末尾后转为接收新消息。
+        补发和写入日志都在转发线程中进行，不会遗漏或重复消息
+
+        :return: False表示连接已断开
+        """
+        if client.pending >= client.max_buffer // 2:
+            return True
+        entries = self.journal.read(client.replay_offset, self.replay_batch_size)
+        if not entries:
+            client.replay_offset = None
+            logger.info(f"客户端{client.address}补发完成")
+            return True
+        for offset, data in entries:
+            data = MessageRecord.journal_entry_to_redirect_bytes(
+                data, self.redirect_format
+            )
+            if client.pending and client.pending + len(data) > client.max_buffer:
+                break
+            client.put(data)
+            client.replay_offset = offset + 1
+        return client.flush()
+
     def keep_redirect(self):
+        """
+        在一个线程中通过selector转发消息：有新消息时被唤醒，每次取出所有待转发的消息，
+        每条消息只序列化一次，客户端socket可写时才发送，不会被单个客户端阻塞
+        """
         logger.info("开启转发服务")
-        while not self.stop_redirect:
-            if len(self.dqueue) != 0:
-                msg = self.dqueue.popleft()
-                data = json.dumps(msg).encode("utf-8") + b"\n"
-                bad_requests = set()
-                for redirect in self.redirects:
-                    try:
-                        redirect.sendall(data)
-                    except Exception:
-                        bad_requests.add(redirect)
-                for bad_request in bad_requests:
-                    self.redirects.remove(bad_request)
-                    self.shutdown_request(bad_request)
-                    logger.info("已移除一个接受消息转发的客户端")
-            time.sleep(0.1)
+        selector = selectors.DefaultSelector()
+        selector.register(self.dqueue.wakeup_reader, selectors.EVENT_READ)
+        timeout = 1
+        try:
+            while not self.stop_redirect:
+                bad_clients = set()
+                for key, events in selector.select(timeout=timeout):
+                    client: typing.Optional[RedirectClient] = key.data
+                    if client is None:
+                        self.dqueue.clear_wakeup()
+                        continue
+                    if events & selectors.EVENT_READ and not client.is_alive():
+                        bad_clients.add(client)
+                    elif events & selectors.EVENT_WRITE and not client.flush():
+                        bad_clients.add(client)
+                self._register_new_redirects(selector)
+                clients = [
+                    key.data
+                    for key in selector.get_map().values()
+                    if key.data is not None and key.data not in bad_clients
+                ]
+
+                batch = self.dqueue.drain()
+                if batch and self.deduplicator is not None:
+                    batch = self.deduplicator.filter(batch)
+                if batch and self.journal is not None:
+                    self.journal.append_many(batch)
+                # 补发中的客户端从日志读取这些消息
+                live_clients = [c for c in clients if c.replay_offset is None]
+                if batch and live_clients:
+                    for msg in batch:
+                        data = msg.to_redirect_bytes(self.redirect_format)
+                        for client in live_clients:
+                            client.put(data)
+                    for client in live_clients:
+                        if not client.flush():
+                            bad_clients.add(client)
+
+                timeout = 1
+                for client in clients:
+                    if client.replay_offset is None or client in bad_clients:
+                        continue
+                    if not self._replay(client):
+                        bad_clients.add(client)
+                    elif (
+                        client.replay_offset is not None
+                        and client.pending < client.max_buffer // 2
+                    ):
+                        # 缓冲区仍有空间，不等待直接继续补发
+                        timeout = 0
+
+                for client in bad_clients:
+                    self.remove_redirect(client, selector)
+                # 只在有未发送完的数据时关注可写事件
+                for key in list(selector.get_map().values()):
+                    client = key.data
+                    if client is None:
+                        continue
+                    events = selectors.EVENT_READ
+                    if client.pending:
+                        events |= selectors.EVENT_WRITE
+                    if key.events != events:
+                        selector.modify(client.sock, events, client)
+        finally:
+            selector.close()
+            for client in list(self.redirects.values()):
+                self.remove_redirect(client)
+            self.dqueue.close()
+            if self.journal is not None:
+                self.journal.close()
         logger.info("转发服务已关闭")
 
+    def stats(self):
+        return {
+            "queued": len(self.dqueue),
+            "dropped": self.dqueue.dropped,
+            "journal": self.journal.stats() if self.journal is not None else None,
+            "dedup": (
+                self.deduplicator.stats() if self.deduplicator is not None else None
+            ),
+            "redirects": [client.stats() for client in self.redirects.values()],
+        }
+
     def serve(self):
         self.serve_forever_in_thread()
         self.keep_redirect()
@@ -1,20 +1,26 @@
 import asyncio
 import json
 import logging
-import re
+import threading
 import warnings
 from collections import deque
 from functools import partial
-from typing import Awaitable, Callable, List
+from typing import Awaitable, Callable, Dict, List, Optional, Union
 
 import websockets
 import websockets.client
 import websockets.server
+from websockets.frames import Opcode
 from websockets.typing import Data
 
 from whochat import _comtypes as comtypes
 from whochat.abc import RobotEventSinkABC
 from whochat.bot import WechatBotFactory
+from whochat.messages.dedup import MessageDeduplicator
+from whochat.messages.journal import MessageJournal
+from whochat.messages.record import MessageRecord
+from whochat.messages.subscription import Subscription, SubscriptionIndex
+from whochat.processes import wechat_process_registry
 from whochat.signals import Signal
 from whochat.utils import EventWaiter
 
@@ -22,80 +28,186 @@ logger = logging.getLogger("whochat")
 
 
 class MessageEventStoreSink(RobotEventSinkABC):
-    def __init__(self, deque_: deque):
+    def __init__(self, deque_: "Union[deque, MessageBridge]"):
         self.deque_ = deque_
 
-    @staticmethod
-    def _parse_extrainfo(extrainfo):
-        """
-        Windows 3.9.2.26:
-        <msgsource>
-            <atuserlist><![CDATA[,wxid_enuyja8axoz92,wxid_enuyjaxoz922,wxid_ctg8dfsen122]]></atuserlist>
-            <silence>0</silence>
-            <membercount>12</membercount>
-            <signature>v1_6XIdCSDF</signature>
-            <tmp_node>
-                <publisher-id>&lt;![CDATA[]]&gt;</publisher-id>
-            </tmp_node>
-        </msgsource>
-
-        Mac 3.7.0:
-        <msgsource>
-            <atuserlist>wxid_enuyja8axoz92</atuserlist>
-            <alnode>
-                <fr>1</fr>
-            </alnode>
-            <silence>0</silence>
-            <membercount>12</membercount>
-            <signature>v1_JVxT4Vi9</signature>
-            <tmp_node>
-                <publisher-id>&lt;![CDATA[]]&gt;</publisher-id>
-            </tmp_node>
-        </msgsource>
-
-        Android 8.0.35:
-        <msgsource>
-            <atuserlist><![CDATA[wxid_enuyja8axoz92]]></atuserlist>
-            <silence>0</silence>
-            <membercount>12</membercount>
-            <signature>v1_VQrQyKdq</signature>
-            <tmp_node>
-                <publisher-id>&lt;![CDATA[]]&gt;</publisher-id>
-            </tmp_node>
-        </msgsource>
-        """
-        extra = {"is_at_msg": False}
-        android_windows_at_pattern = r"<atuserlist><!\[CDATA\[(.*?)\]\]></atuserlist>"
-        m = re.search(android_windows_at_pattern, extrainfo)
-        if not m:
-            mac_at_pattern = r"<atuserlist>(.*?)</atuserlist>"
-            m = re.search(mac_at_pattern, extrainfo)
-        if m:
-            extra["is_at_msg"] = True
-            extra["at_user_list"] = [
-                wxid.strip() for wxid in m.group(1).split(",") if wxid.strip()
-            ]
-        m = re.search(r"<membercount>(\d+)</membercount>", extrainfo)
-        if m:
-            extra["member_count"] = int(m.group(1))
-        return extra
-
     def OnGetMessageEvent(self, msg):
         logger.debug(f"Raw message: {msg}")
         if isinstance(msg, (list, tuple)):
             msg = msg[0]
         try:
-            data = json.loads(msg)
-            if "@chatroom" not in data["sender"]:
-                data["extrainfo"] = None
-            else:
-                data["extrainfo"] = self._parse_extrainfo(data["extrainfo"])
-        except (json.JSONDecodeError, TypeError) as e:
+            record = MessageRecord.from_event_dict(json.loads(msg))
+        except (json.JSONDecodeError, TypeError, KeyError) as e:
             logger.warning("接收消息错误: ")
             logger.exception(e)
             return
-        logger.debug(f"收到消息: {data}")
-        self.deque_.append(data)
+        logger.debug(f"收到消息: {record}")
+        self.deque_.append(record)
+
+
+class MessageBridge:
+    """
+    将COM事件线程收到的消息交给事件循环，缓冲区满时丢弃最旧的消息。
+    仅在缓冲区由空变为非空时唤醒事件循环，突发消息会被批量取出
+    """
+
+    def __init__(self, maxlen: int = 1000):
+        assert maxlen > 0
+        self.maxlen = maxlen
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._waiter: Optional[asyncio.Future] = None
+        self._wakeup_scheduled = False
+        self._closed = False
+
+        self.received = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def append(self, msg):
+        """可在任意线程调用"""
+        with self._lock:
+            if len(self._buffer) >= self.maxlen:
+                self._buffer.popleft()
+                self.dropped += 1
+            self._buffer.append(msg)
+            self.received += 1
+            self.high_water = max(self.high_water, len(self._buffer))
+            wakeup = self._loop is not None and not self._wakeup_scheduled
+            self._wakeup_scheduled = self._wakeup_scheduled or wakeup
+        if wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup)
+
+    def _wakeup(self):
+        with self._lock:
+            self._wakeup_scheduled = False
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def close(self):
+        self._closed = True
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup)
+
+    async def get_batch(self) -> list:
+        """等待并取出缓冲区中的所有消息，关闭后返回空列表"""
+        self._loop = asyncio.get_running_loop()
+        while not self._closed:
+            with self._lock:
+                if self._buffer:
+                    items = list(self._buffer)
+                    self._buffer.clear()
+                    return items
+            self._waiter = self._loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return []
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "dropped": self.dropped,
+            "buffered": len(self._buffer),
+            "high_water": self.high_water,
+            "maxlen": self.maxlen,
+        }
+
+
+class ClientSender:
+    """
+    单个客户端的发送缓冲区，缓冲数据(含传输层未写出的数据)超过`max_buffer`字节时按策略处理:
+
+    drop_oldest: 丢弃最旧的消息
+    disconnect: 断开客户端
+    pause: 暂停向该客户端发送新消息，直到缓冲数据降至一半以下
+    """
+
+    POLICIES = ("drop_oldest", "disconnect", "pause")
+
+    def __init__(
+        self,
+        websocket: "websockets.server.WebSocketServerProtocol",
+        max_buffer: int = 1024 * 1024,
+        policy: str = "drop_oldest",
+    ):
+        assert policy in self.POLICIES, f"policy必须为{self.POLICIES}之一"
+        self.websocket = websocket
+        self.max_buffer = max_buffer
+        self.policy = policy
+        self._queue: deque = deque()
+        self._queued_bytes = 0
+        self._event = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        self.paused = False
+        self.sent = 0
+        self.dropped = 0
+
+    @property
+    def buffered_amount(self) -> int:
+        transport = self.websocket.transport
+        transport_buffered = transport.get_write_buffer_size() if transport else 0
+        return self._queued_bytes + transport_buffered
+
+    def put(self, data: bytes) -> bool:
+        """
+        :return: False表示应断开该客户端
+        """
+        if self.paused:
+            if self.buffered_amount > self.max_buffer // 2:
+                self.dropped += 1
+                return True
+            self.paused = False
+
+        if self.buffered_amount + len(data) > self.max_buffer:
+            if self.policy == "disconnect":
+                return False
+            if self.policy == "pause":
+                self.paused = True
+                self.dropped += 1
+                return True
+            while self._queue and self.buffered_amount + len(data) > self.max_buffer:
+                self._queued_bytes -= len(self._queue.popleft())
+                self.dropped += 1
+
+        self._queue.append(data)
+        self._queued_bytes += len(data)
+        self._idle.clear()
+        self._event.set()
+        return True
+
+    async def wait_idle(self):
+        """等待缓冲的消息全部写入传输层"""
+        await self._idle.wait()
+
+    async def run(self):
+        while True:
+            while not self._queue:
+                self._idle.set()
+                self._event.clear()
+                await self._event.wait()
+            data = self._queue.popleft()
+            self._queued_bytes -= len(data)
+            # 数据已是UTF-8编码的JSON，直接作为文本帧发送，避免为每个客户端重复编码
+            try:
+                await self.websocket.write_frame(True, Opcode.TEXT, data)
+            except websockets.ConnectionClosed:
+                return
+            self.sent += 1
+
+    def stats(self):
+        return {
+            "remote_address": str(self.websocket.remote_address),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "queued": len(self._queue),
+            "buffered_amount": self.buffered_amount,
+            "paused": self.paused,
+        }
 
 
 class WechatMessageWebsocketServer:
@@ -106,18 +218,56 @@ class WechatMessageWebsocketServer:
         ws_port: int = 9001,
         queue: asyncio.Queue = None,
         welcome: bool = True,
+        buffer_size: int = 1000,
+        client_buffer_size: int = 1024 * 1024,
+        slow_client_policy: str = "drop_oldest",
+        journal: Optional[MessageJournal] = None,
+        replay_batch_size: int = 500,
+        dedup_size: int = 10000,
+        dedup_window: Optional[float] = 300,
+        deduplicator: Optional[MessageDeduplicator] = None,
         **kwargs,
     ):
+        """
+        :param buffer_size: 待广播消息的缓冲区大小，满时丢弃最旧的消息
+        :param client_buffer_size: 每个客户端的发送缓冲区大小，字节
+        :param slow_client_policy: 客户端发送缓冲区满时的处理策略，参见`ClientSender`
+        :param journal: 消息日志，设置后客户端可以从指定offset继续接收消息
+        :param replay_batch_size: 补发消息时每次从日志读取的消息数
+        :param dedup_size: 去重时最多记录的msgid数量
+        :param dedup_window: 去重时间窗口，秒，None表示不去重
+        :param deduplicator: 去重实例，默认使用进程内共用的`MessageDeduplicator.shared`，
+            同一进程中的多个接收服务才能去除彼此收到的重复消息
+        """
+        assert slow_client_policy in ClientSender.POLICIES
         self.wx_pids = wx_pids
         self.ws_host = ws_host
         self.ws_port = ws_port
         self.extra_kwargs = kwargs
-        self.queue = queue or asyncio.Queue(maxsize=10)
+        if queue is not None:
+            warnings.warn("参数 'queue' 已弃用，请使用 'buffer_size'")
+            buffer_size = queue.maxsize or buffer_size
         self.welcome = welcome
 
+        self.client_buffer_size = client_buffer_size
+        self.slow_client_policy = slow_client_policy
+        self.journal = journal
+        self.replay_batch_size = replay_batch_size
+        if deduplicator is None:
+            deduplicator = MessageDeduplicator.shared(dedup_size, dedup_window)
+        self.deduplicator = deduplicator
+
         self.ws_server = None
-        self.clients = set()
-        self._deque = deque(maxlen=self.queue.maxsize)
+        self.clients: Dict[
+            "websockets.server.WebSocketServerProtocol", ClientSender
+        ] = {}
+        self.subscriptions = SubscriptionIndex()
+        self.evicted_clients = 0
+        # 正在补发日志中消息的客户端，补发完成前不接收广播
+        self._replaying: Dict[
+            "websockets.server.WebSocketServerProtocol", asyncio.Task
+        ] = {}
+        self._bridge = MessageBridge(buffer_size)
         self._event_waiter = EventWaiter(2)
 
         self._stop_broadcast = False
@@ -128,13 +278,105 @@ class WechatMessageWebsocketServer:
     async def handler(self, websocket):
         if websocket not in self.clients:
             logger.info(f"Accept connection from {websocket.remote_address}")
-            self.clients.add(websocket)
-            if self.welcome:
-                await websocket.send("hello")
-            await websocket.wait_closed()
-            self.clients.remove(websocket)
+            sender = ClientSender(
+                websocket, self.client_buffer_size, self.slow_client_policy
+            )
+            self.clients[websocket] = sender
+            self.subscriptions.add(websocket)
+            send_task = None
+            try:
+                if self.welcome:
+                    await websocket.send("hello")
+                send_task = asyncio.create_task(sender.run())
+                async for message in websocket:
+                    await self.handle_client_message(websocket, message)
+            except websockets.ConnectionClosed:
+                pass
+            finally:
+                if send_task is not None:
+                    send_task.cancel()
+                replay_task = self._replaying.pop(websocket, None)
+                if replay_task is not None:
+                    replay_task.cancel()
+                self.clients.pop(websocket, None)
+                self.subscriptions.remove(websocket)
             logger.info(f"Connection from {websocket.remote_address} was closed")
 
+    async def handle_client_message(self, websocket, message: Data):
+        """
+        处理客户端发送的订阅消息(参见`whochat.messages.subscription`)和补发请求:
+
+        {"resume": {"offset": 1024}}
+
+        服务端回复`{"resume": {"offset": <开始补发的offset>, "next_offset": <当前最新的offset>}}`，
+        先补发日志中从该offset开始的消息，再接收新消息。消息中的`offset`字段为该消息在日志中的offset
+        """
+        try:
+            data = json.loads(message)
+            if "resume" in data:
+                await self.handle_resume(websocket, data["resume"])
+                return
+            filters = data["subscribe"]
+            subscription = Subscription.from_dict(filters)
+        except (json.JSONDecodeError, TypeError, KeyError):
+            await websocket.send(json.dumps({"error": "无法识别的消息"}, ensure_ascii=False))
+            return
+        except ValueError as e:
+            await websocket.send(json.dumps({"error": str(e)}, ensure_ascii=False))
+            return
+        self.subscriptions.add(websocket, subscription)
+        logger.info(f"客户端{websocket.remote_address}订阅: {subscription.as_dict()}")
+        await websocket.send(json.dumps({"subscription": subscription.as_dict()}))
+
+    async def handle_resume(self, websocket, params):
+        if self.journal is None:
+            raise ValueError("未开启消息日志，无法补发消息")
+        offset = params["offset"]
+        if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+            raise ValueError("'offset'必须为非负整数")
+        offset = max(offset, self.journal.first_offset)
+        previous = self._replaying.pop(websocket, None)
+        if previous is not None:
+            previous.cancel()
+        # 回复与补发的消息经同一发送缓冲区，客户端在回复之后收到的消息均从该offset开始
+        ack = {"resume": {"offset": offset, "next_offset": self.journal.next_offset}}
+        self.broadcast(json.dumps(ack), [websocket])
+        logger.info(f"客户端{websocket.remote_address}从offset {offset}开始补发消息")
+        self._replaying[websocket] = asyncio.create_task(self.replay(websocket, offset))
+
+    async def replay(self, websocket, offset: int):
+        """
+        分批从日志读取消息发送给客户端，每批发送完后再读取下一批。
+        读到日志末尾后直接转为接收广播，期间没有等待，不会遗漏或重复消息
+        """
+        sender = self.clients.get(websocket)
+        try:
+            while sender is not None and self.clients.get(websocket) is sender:
+                entries = self.journal.read(offset, self.replay_batch_size)
+                if not entries:
+                    break
+                subscription = self.subscriptions.get(websocket)
+                targets = [websocket]
+                for entry_offset, data in entries:
+                    if subscription is None or self._match_entry(subscription, data):
+                        self.broadcast(data, targets)
+                offset = entries[-1][0] + 1
+                await sender.wait_idle()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"向客户端{websocket.remote_address}补发消息失败")
+            logger.exception(e)
+        finally:
+            if self._replaying.get(websocket) is asyncio.current_task():
+                del self._replaying[websocket]
+
+    @staticmethod
+    def _match_entry(subscription: Subscription, data: bytes) -> bool:
+        if subscription == Subscription():
+            return True
+        return subscription.match_event_dict(json.loads(data))
+
     async def serve_websocket(self):
         async with websockets.server.serve(
             self.handler, self.ws_host, self.ws_port, **self.extra_kwargs
@@ -148,7 +390,7 @@ class WechatMessageWebsocketServer:
     def _start_receive_msg(self, wx_pids):
         comtypes.CoInitialize()
         try:
-            sink = MessageEventStoreSink(self._deque)
+            sink = MessageEventStoreSink(self._bridge)
             for wx_pid in wx_pids:
                 bot = WechatBotFactory.get(wx_pid)
                 bot.start_robot_service()
@@ -161,18 +403,9 @@ class WechatMessageWebsocketServer:
         finally:
             comtypes.CoUninitialize()
 
-    async def deque_to_queue(self):
-        while not self._stop_receive_msg:
-            try:
-                e = self._deque.popleft()
-                await self.queue.put(e)
-            except IndexError:
-                await asyncio.sleep(0.1)
-
     async def start_receive_msg(self):
         logger.info("开始运行微信消息接收服务")
         loop = asyncio.get_event_loop()
-        loop.create_task(self.deque_to_queue())
         await loop.run_in_executor(None, partial(self._start_receive_msg, self.wx_pids))
         logger.info("微信消息接收服务已停止")
 
@@ -189,30 +422,76 @@ class WechatMessageWebsocketServer:
 
     def stop_broadcast(self):
         self._stop_broadcast = True
-        try:
-            self.queue.put_nowait("bye")
-        except asyncio.QueueFull:
-            pass
+        self._bridge.close()
+        if self.journal is not None:
+            self.journal.close()
 
     async def broadcast_received_msg(self):
         logger.info("开始向客户端广播接收到的微信消息")
         while not self._stop_broadcast:
-            data = await self.queue.get()
-            if not self._stop_broadcast:
-                self.broadcast(json.dumps(data))
+            batch = await self._bridge.get_batch()
+            if self.deduplicator is not None:
+                batch = self.deduplicator.filter(batch)
+            if self.journal is not None and batch:
+                self.journal.append_many(batch)
+            for msg in batch:
+                targets = [
+                    websocket
+                    for websocket in self.subscriptions.match(msg)
+                    if websocket not in self._replaying
+                ]
+                # 没有客户端订阅时不序列化
+                if targets:
+                    self.broadcast(msg.to_json_bytes(), targets)
         logger.info("广播已停止")
 
-    def broadcast(self, data):
+    def stats(self):
+        return {
+            "messages": self._bridge.stats(),
+            "evicted_clients": self.evicted_clients,
+            "journal": self.journal.stats() if self.journal is not None else None,
+            "dedup": (
+                self.deduplicator.stats() if self.deduplicator is not None else None
+            ),
+            "clients": [
+                {
+                    **sender.stats(),
+                    "subscription": self.subscriptions.get(websocket).as_dict(),
+                    "replaying": websocket in self._replaying,
+                }
+                for websocket, sender in self.clients.items()
+            ],
+        }
+
+    def broadcast(self, data: Union[str, bytes], websockets_=None):
+        """
+        :param websockets_: 接收的客户端，默认为所有客户端
+        """
         logger.debug(f"广播消息：{data}")
-        websockets.broadcast(self.clients, data)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if websockets_ is None:
+            websockets_ = list(self.clients)
+        for websocket in websockets_:
+            sender = self.clients.get(websocket)
+            if sender is None:
+                continue
+            if not sender.put(data):
+                logger.warning(f"客户端{websocket.remote_address}接收过慢，断开连接")
+                self.clients.pop(websocket, None)
+                self.subscriptions.remove(websocket)
+                self.evicted_clients += 1
+                asyncio.create_task(websocket.close(1008, "slow consumer"))
 
     def shutdown(self):
         logger.info("停止服务中...")
+        wechat_process_registry.stop_watching()
         self.stop_websocket()
         self.stop_broadcast()
         self.stop_receive_msg()
 
     async def serve(self):
+        wechat_process_registry.watch()
         try:
             websocket_task = asyncio.create_task(self.serve_websocket())
             receive_msg_task = asyncio.create_task(self.start_receive_msg())
@@ -0,0 +1,189 @@
+"""
+微信进程缓存
+
+`WechatProcessRegistry`按pid缓存微信进程的用户名、数据目录及启动时间。
+刷新时只按进程名筛选(`process_iter(attrs=...)`一次取出所需属性)，
+只对新出现的微信进程调用`open_files()`解析用户名和数据目录，
+pid相同但启动时间不同时视为新进程。进程启动或退出时通知`on_change`注册的回调
+"""
+import dataclasses
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import psutil
+
+from whochat.logger import logger
+from whochat.utils import guess_wechat_base_directory, guess_wechat_user_by_paths
+
+WECHAT_PROCESS_NAME = "wechat.exe"
+PROCESS_ATTRS = ["pid", "name", "create_time", "status"]
+
+
+@dataclasses.dataclass
+class WechatProcess:
+    pid: int
+    create_time: float
+    status: str = ""
+    wechat_user: str = ""
+    base_directory: str = ""
+
+    @property
+    def resolved(self) -> bool:
+        """未登录时微信尚未打开数据目录中的文件，用户名和数据目录为空"""
+        return bool(self.wechat_user and self.base_directory)
+
+    def resolve(self, process: psutil.Process):
+        try:
+            files = [f.path for f in process.open_files()]
+        except psutil.Error as e:
+            logger.debug(f"获取微信进程{self.pid}打开的文件失败: {e!r}")
+            return
+        self.wechat_user = guess_wechat_user_by_paths(files)
+        self.base_directory = guess_wechat_base_directory(files)
+
+    def as_dict(self):
+        return {
+            "pid": self.pid,
+            "started": datetime.fromtimestamp(self.create_time).isoformat(),
+            "status": self.status,
+            "wechat_user": self.wechat_user,
+            "base_directory": self.base_directory,
+        }
+
+
+ChangeCallback = Callable[[List[WechatProcess], List[WechatProcess]], None]
+
+
+class WechatProcessRegistry:
+    def __init__(self, name: str = WECHAT_PROCESS_NAME, max_age: float = 5):
+        """
+        :param name: 进程名，不区分大小写
+        :param max_age: 缓存有效时间，秒，`list`超过该时间后重新扫描进程
+        """
+        self.name = name.lower()
+        self.max_age = max_age
+        self._processes: Dict[int, WechatProcess] = {}
+        self._scanned_at = 0.0
+        self._lock = threading.RLock()
+        self._callbacks: List[ChangeCallback] = []
+        self._watcher: Optional[threading.Thread] = None
+        self._stop_watching = threading.Event()
+
+        self.scans = 0
+        self.resolves = 0
+
+    def __len__(self):
+        return len(self._processes)
+
+    def on_change(self, callback: ChangeCallback):
+        """注册进程变化的回调: `callback(started, exited)`"""
+        self._callbacks.append(callback)
+
+    def _notify(self, started: List[WechatProcess], exited: List[WechatProcess]):
+        for process in started:
+            logger.info(f"微信进程启动: {process.pid}")
+        for process in exited:
+            logger.info(f"微信进程退出: {process.pid}")
+        for callback in self._callbacks:
+            try:
+                callback(started, exited)
+            except Exception as e:
+                logger.exception(e)
+
+    def _update(self, process: psutil.Process) -> Optional[WechatProcess]:
+        info = process.info
+        if (info.get("name") or "").lower() != self.name:
+            return None
+        pid = info["pid"]
+        create_time = info.get("create_time") or 0.0
+        current = self._processes.get(pid)
+        if current is None or current.create_time != create_time:
+            current = WechatProcess(pid, create_time)
+        current.status = info.get("status") or ""
+        if not current.resolved:
+            current.resolve(process)
+            self.resolves += 1
+        return current
+
+    def refresh(self) -> List[WechatProcess]:
+        """重新扫描进程，只解析新进程及尚未登录的进程"""
+        with self._lock:
+            processes = {}
+            for process in psutil.process_iter(attrs=PROCESS_ATTRS):
+                wechat_process = self._update(process)
+                if wechat_process is not None:
+                    processes[wechat_process.pid] = wechat_process
+            previous = self._processes
+            self._processes = processes
+            self._scanned_at = time.monotonic()
+            self.scans += 1
+        started = [p for pid, p in processes.items() if previous.get(pid) is not p]
+        exited = [p for pid, p in previous.items() if processes.get(pid) is not p]
+        if started or exited:
+            self._notify(started, exited)
+        return list(processes.values())
+
+    @property
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self._scanned_at < self.max_age
+
+    def list(self, refresh: bool = False) -> List[WechatProcess]:
+        if refresh or not self.is_fresh:
+            return self.refresh()
+        return list(self._processes.values())
+
+    def get(self, pid: int) -> Optional[WechatProcess]:
+        """按pid获取微信进程，不扫描其他进程"""
+        pid = int(pid)
+        current = self._processes.get(pid)
+        if current is not None and current.resolved:
+            return current
+        try:
+            process = psutil.Process(pid)
+            with process.oneshot():
+                process.info = process.as_dict(attrs=PROCESS_ATTRS)
+        except psutil.Error:
+            return None
+        with self._lock:
+            wechat_process = self._update(process)
+            if wechat_process is None:
+                return None
+            self._processes[pid] = wechat_process
+        if current is not wechat_process:
+            self._notify([wechat_process], [current] if current is not None else [])
+        return wechat_process
+
+    def watch(self, interval: float = 2):
+        """在后台线程中每`interval`秒扫描一次，用于及时通知进程变化"""
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+        self._stop_watching.clear()
+
+        def run():
+            while not self._stop_watching.wait(interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logger.exception(e)
+
+        self._watcher = threading.Thread(
+            target=run, name="wechat-processes", daemon=True
+        )
+        self._watcher.start()
+
+    def stop_watching(self):
+        self._stop_watching.set()
+
+    def stats(self):
+        return {
+            "processes": len(self._processes),
+            "scans": self.scans,
+            "resolves": self.resolves,
+            "fresh": self.is_fresh,
+            "watching": self._watcher is not None and self._watcher.is_alive(),
+        }
+
+
+wechat_process_registry = WechatProcessRegistry()
@@ -0,0 +1,349 @@
+"""
+批量发送
+
+一次RPC调用创建批量发送任务(接收人 × 同一消息)，服务端按`wx_pid`限速依次发送，
+不再需要客户端为每个接收人发起一次调用。
+
+* 同一`wx_pid`的所有任务共用一个令牌桶，避免发送过快触发微信风控
+* 每个接收人的发送结果按顺序记录，`get_bulk_send_job`可从指定位置增量获取；
+  通过Websocket创建任务时，结果还会以JSON-RPC通知`bulk_send_progress`推送给该连接
+* `cancel_bulk_send`取消任务，未发送的接收人结果为`cancelled`
+"""
+import asyncio
+import contextvars
+import dataclasses
+import functools
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import websockets
+from jsonrpcserver import InvalidParams, Success
+
+from whochat.bot import WechatBot, WechatBotFactory
+from whochat.rpc.handlers import bot_executors
+from whochat.rpc.registry import rpc_registry
+
+logger = logging.getLogger("whochat")
+
+# 当前RPC请求所在的Websocket连接，由Websocket RPC服务设置
+current_websocket: contextvars.ContextVar = contextvars.ContextVar(
+    "current_websocket", default=None
+)
+
+PROGRESS_NOTIFICATION = "bulk_send_progress"
+CANCELLED = "cancelled"
+
+# 第一个参数为接收人的发送方法
+SEND_METHODS = {
+    method.__name__: method
+    for method in [
+        WechatBot.forward_message,
+        WechatBot.send_app_msg,
+        WechatBot.send_article,
+        WechatBot.send_card,
+        WechatBot.send_emotion,
+        WechatBot.send_file,
+        WechatBot.send_image,
+        WechatBot.send_text,
+        WechatBot.send_xml_msg,
+    ]
+}
+
+
+class TokenBucket:
+    """令牌桶，每秒补充`rate`个令牌，最多积累`burst`个"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        assert rate > 0 and burst > 0
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+        self.waited = 0.0
+
+    def reserve(self) -> float:
+        """预定一个令牌，返回需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.waited += delay
+            return delay
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        return {"rate": self.rate, "burst": self.burst, "waited": self.waited}
+
+
+# 正在推送的任务，保留引用以免被回收
+_push_tasks: Set[asyncio.Future] = set()
+
+
+def _on_push_done(task: asyncio.Future):
+    _push_tasks.discard(task)
+    if task.cancelled():
+        return
+    e = task.exception()
+    # 连接已断开时下次推送前会移除该连接
+    if e is not None and not isinstance(e, websockets.ConnectionClosed):
+        logger.warning(f"推送批量发送进度失败: {e!r}")
+
+
+def _push(websocket, message: str):
+    if websocket.closed:
+        raise ConnectionError("连接已关闭")
+    task = asyncio.ensure_future(websocket.send(message))
+    _push_tasks.add(task)
+    task.add_done_callback(_on_push_done)
+
+
+@dataclasses.dataclass
+class BulkSendJob:
+    job_id: str
+    wx_pid: int
+    method: str
+    recipients: List[str]
+    args: List[Any]
+    status: str = "pending"
+    # 与recipients一一对应: {"recipient", "result", "error"}
+    results: List[dict] = dataclasses.field(default_factory=list)
+    created_at: float = dataclasses.field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    _task: Optional[asyncio.Task] = dataclasses.field(default=None, repr=False)
+    _listeners: List[Callable] = dataclasses.field(default_factory=list, repr=False)
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("finished", "cancelled")
+
+    def progress(self):
+        errors = [result["error"] for result in self.results]
+        cancelled = errors.count(CANCELLED)
+        failed = len(errors) - errors.count(None) - cancelled
+        return {
+            "job_id": self.job_id,
+            "wx_pid": self.wx_pid,
+            "method": self.method,
+            "status": self.status,
+            "total": len(self.recipients),
+            "sent": errors.count(None),
+            "failed": failed,
+            "cancelled": cancelled,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+    def as_dict(self, offset: int = 0):
+        data = self.progress()
+        data["offset"] = offset
+        data["results"] = self.results[offset:]
+        return data
+
+
+class BulkSender:
+    def __init__(self, rate: float = 1, burst: int = 1, max_jobs: int = 100):
+        """
+        :param rate: 每个微信进程每秒发送的消息数
+        :param burst: 每个微信进程最多连续发送的消息数，默认1即严格按`rate`发送
+        :param max_jobs: 最多保留的任务数，超出时删除最早完成的任务
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_jobs = max_jobs
+        self.jobs: "OrderedDict[str, BulkSendJob]" = OrderedDict()
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._ids = itertools.count(1)
+
+    def get_bucket(self, wx_pid: int) -> TokenBucket:
+        bucket = self._buckets.get(wx_pid)
+        if bucket is None:
+            bucket = self._buckets[wx_pid] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _purge(self):
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.done]:
+            if len(self.jobs) <= self.max_jobs:
+                break
+            del self.jobs[job_id]
+
+    def _notify(self, job: BulkSendJob, results: List[dict]):
+        if not job._listeners:
+            return
+        message = json.dumps(
+            {
+                "jsonrpc": "2.0",
+                "method": PROGRESS_NOTIFICATION,
+                "params": {**job.progress(), "results": results},
+            }
+        )
+        for listener in list(job._listeners):
+            try:
+                listener(message)
+            except Exception as e:
+                logger.warning(f"推送批量发送进度失败: {e!r}")
+                job._listeners.remove(listener)
+
+    @staticmethod
+    async def _send(job: BulkSendJob, func, recipient) -> dict:
+        result = {"recipient": recipient, "result": None, "error": None}
+        try:
+            # 微信进程已退出时每个接收人的结果为错误，不中断任务
+            bot = WechatBotFactory.get(job.wx_pid)
+            result["result"] = await bot_executors.run(
+                job.wx_pid, functools.partial(func, bot, recipient, *job.args)
+            )
+        except Exception as e:
+            logger.exception(e)
+            result["error"] = str(e)
+        return result
+
+    async def _run(self, job: BulkSendJob):
+        job.status = "running"
+        func = SEND_METHODS[job.method]
+        bucket = self.get_bucket(job.wx_pid)
+        try:
+            for recipient in job.recipients:
+                await bucket.acquire()
+                sending = asyncio.ensure_future(self._send(job, func, recipient))
+                try:
+                    await asyncio.shield(sending)
+                finally:
+                    # 任务被取消时也等待正在发送的消息完成并记录结果
+                    result = await sending
+                    job.results.append(result)
+                    self._notify(job, [result])
+            job.status = "finished"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            cancelled = [
+                {"recipient": recipient, "result": None, "error": CANCELLED}
+                for recipient in job.recipients[len(job.results) :]
+            ]
+            job.results.extend(cancelled)
+            self._notify(job, cancelled)
+        finally:
+            job.finished_at = time.time()
+            job._listeners.clear()
+        logger.info(f"批量发送任务{job.job_id}: {job.progress()}")
+
+    async def bulk_send(
+        self, wx_pid: int, method: str, recipients: List[str], args: List = None
+    ):
+        """
+        批量发送，每个接收人依次调用`method(wx_pid, recipient, *args)`，同一微信进程按限速发送
+        {
+            "wx_pid": 12345,
+            "method": "send_text",
+            "recipients": ["wxid_foo", "wxid_bar"],
+            "args": ["Hello!"]
+        }
+        通过Websocket调用时，每个接收人的结果以通知`bulk_send_progress`推送
+        :param method: 发送方法: forward_message, send_app_msg, send_article, send_card,
+                       send_emotion, send_file, send_image, send_text, send_xml_msg
+        :param recipients: 接收人wxid或群id列表
+        :param args: 接收人之后的参数
+        :return: 任务进度，包含job_id
+        """
+        if method not in SEND_METHODS:
+            return InvalidParams(f"不支持的发送方法: {method}")
+        if not isinstance(recipients, list) or not recipients:
+            return InvalidParams("recipients不能为空")
+        if args is not None and not isinstance(args, list):
+            return InvalidParams("args必须为列表")
+        # 创建任务时检查参数，而不是每个接收人发送时才出错
+        error = rpc_registry.validate(
+            method, [wx_pid, str(recipients[0]), *(args or [])], {}
+        )
+        if error is not None:
+            return InvalidParams(error)
+        job = BulkSendJob(
+            job_id=str(next(self._ids)),
+            wx_pid=int(wx_pid),
+            method=method,
+            recipients=[str(recipient) for recipient in recipients],
+            args=list(args or []),
+        )
+        websocket = current_websocket.get()
+        if websocket is not None:
+            job._listeners.append(functools.partial(_push, websocket))
+        self.jobs[job.job_id] = job
+        self._purge()
+        job._task = asyncio.create_task(self._run(job))
+        return Success(job.progress())
+
+    async def get_bulk_send_job(self, job_id: str, offset: int = 0):
+        """
+        获取批量发送任务进度及结果
+        :param offset: 从第几个接收人的结果开始返回，用于增量获取
+        """
+        job = self.jobs.get(str(job_id))
+        if job is None:
+            return InvalidParams(f"任务<{job_id}>不存在")
+        return Success(job.as_dict(offset))
+
+    async def cancel_bulk_send(self, job_id: str):
+        """取消批量发送任务，正在发送的消息会发送完成"""
+        job = self.jobs.get(str(job_id))
+        if job is None:
+            return InvalidParams(f"任务<{job_id}>不存在")
+        if job._task is not None and not job.done:
+            job._task.cancel()
+            try:
+                await job._task
+            except asyncio.CancelledError:
+                pass
+        return Success(job.progress())
+
+    async def list_bulk_send_jobs(self):
+        """列出所有批量发送任务的进度"""
+        return Success([job.progress() for job in self.jobs.values()])
+
+    async def set_send_rate(self, wx_pid: int, rate: float, burst: int = None):
+        """
+        设置微信进程的发送速率
+        :param rate: 每秒发送的消息数
+        :param burst: 最多连续发送的消息数，空闲后最多可立即发送`burst`条
+        """
+        if not isinstance(rate, (int, float)) or isinstance(rate, bool):
+            return InvalidParams("rate必须为数字")
+        if burst is not None and (
+            not isinstance(burst, int) or isinstance(burst, bool)
+        ):
+            return InvalidParams("burst必须为整数")
+        if rate <= 0 or (burst is not None and burst <= 0):
+            return InvalidParams("rate和burst必须大于0")
+        bucket = self.get_bucket(int(wx_pid))
+        bucket.rate = rate
+        if burst is not None:
+            bucket.burst = burst
+        return Success(bucket.stats())
+
+    def get_rpc_methods(self) -> Dict[str, Callable]:
+        return {
+            method.__name__: method
+            for method in [
+                self.bulk_send,
+                self.cancel_bulk_send,
+                self.get_bulk_send_job,
+                self.list_bulk_send_jobs,
+                self.set_send_rate,
+            ]
+        }
+
+
+default_bulk_sender = BulkSender()
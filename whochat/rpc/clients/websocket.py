@@ -1,9 +1,11 @@
 import asyncio
+import dataclasses
 import json
 import logging
-from collections import defaultdict
+import time
+from collections import OrderedDict, deque
 from functools import partial
-from typing import Any, Dict
+from typing import Any, Dict, Tuple
 
 import websockets
 import websockets.client
@@ -14,41 +16,183 @@ from whochat.rpc.handlers import make_rpc_methods
 logger = logging.getLogger("whochat")
 
 unset = object()
+_missing = object()
 
 
 class Timeout(Exception):
     pass
 
 
+class ResultStore:
+    """
+    有界的结果缓存，超出`maxsize`时淘汰最久未访问的项，访问时刷新过期时间。
+    由于过期时间随访问刷新，访问顺序即过期顺序，只需检查队首即可清理过期项。
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        assert maxsize > 0 and ttl > 0
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (expire_at, value)
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        self._purge(time.monotonic())
+        return key in self._data
+
+    def _purge(self, now):
+        while self._data:
+            key, (expire_at, _) = next(iter(self._data.items()))
+            if expire_at > now:
+                break
+            del self._data[key]
+            self.expirations += 1
+
+    def purge_expired(self):
+        self._purge(time.monotonic())
+
+    def set(self, key, value):
+        now = time.monotonic()
+        self._purge(now)
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        self._purge(now)
+        try:
+            _, value = self._data[key]
+        except KeyError:
+            return default
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        return value
+
+    def pop(self, key, default=None):
+        self._purge(time.monotonic())
+        try:
+            return self._data.pop(key)[1]
+        except KeyError:
+            return default
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+@dataclasses.dataclass
+class SendStats:
+    sent: int = 0
+    bursts: int = 0
+    max_burst: int = 0
+    # 发送队列已满时等待的次数
+    backpressure_waits: int = 0
+    queue_high_water: int = 0
+
+    def as_dict(self):
+        return dataclasses.asdict(self)
+
+
 class BotWebsocketRPCClient:
-    def __init__(self, ws_uri):
+    def __init__(
+        self,
+        ws_uri,
+        send_window: int = 100,
+        max_queued: int = 0,
+        result_maxsize: int = 1024,
+        result_ttl: float = 300,
+    ):
+        """
+        :param ws_uri: RPC服务地址
+        :param send_window: 每次连续发送的最大请求数
+        :param max_queued: 发送队列长度，0为不限制，队列满时调用方等待
+        :param result_maxsize: 最多保存的不等待(timeout<0)调用结果数
+        :param result_ttl: 调用结果保存时间，秒
+        """
+        assert send_window > 0
         self.ws_uri = ws_uri
-        self.send_queue: asyncio.Queue[Dict[str, Any]] = asyncio.Queue(maxsize=1)
+        self.send_window = send_window
+        self.send_queue: asyncio.Queue[Dict[str, Any]] = asyncio.Queue(
+            maxsize=max_queued
+        )
+        self.send_stats = SendStats()
+        # 已取出但因连接断开未发送的请求，重连后优先发送
+        self._unsent: deque = deque()
         self._rpc_methods = make_rpc_methods()
-        self._results = defaultdict(lambda: unset)
+        # request id -> result of calls made with timeout<0
+        self._results = ResultStore(result_maxsize, result_ttl)
+        # request id -> expire_at, calls made with timeout<0 that have not received a response.
+        # 不放入`_results`，避免大量调用时未收到响应的项被淘汰
+        self._fire_and_forget: "OrderedDict[Any, float]" = OrderedDict()
+        # request id -> future waiting for the response
+        self._pending: Dict[Any, asyncio.Future] = {}
+        # first request id -> ids of a batch request waiting for responses
+        self._pending_batches: "OrderedDict[Any, list]" = OrderedDict()
+        # ids of requests that timed out or were cancelled
+        self._abandoned = ResultStore(result_maxsize, result_ttl)
+        self.late_responses = 0
+        self.orphaned_responses = 0
         self._current_request_id = None
+        # method -> 服务端推送的通知的回调，如批量发送进度`bulk_send_progress`
+        self._notification_handlers: Dict[str, list] = {}
 
-    async def start_result_cleaner(self):
+    def on_notification(self, method: str, callback):
+        """注册服务端通知的回调: `callback(params)`"""
+        self._notification_handlers.setdefault(method, []).append(callback)
+
+    def _handle_notification(self, notification):
+        for callback in self._notification_handlers.get(notification["method"], []):
+            try:
+                callback(notification.get("params"))
+            except Exception as e:
+                logger.exception(e)
+
+    async def start_result_cleaner(self, interval: float = 60):
         logger.info("Starting result cleaner")
-        while removable := len(self._results) - 100 > 0:
-            logger.info(
-                f"Current size of results: {len(self._results)}, will remove {removable} items"
-            )
-            for k in list(self._results.keys())[:removable]:
-                self._results.pop(k, None)
-            await asyncio.sleep(1)
+        while True:
+            self._results.purge_expired()
+            self._purge_fire_and_forget()
+            self._abandoned.purge_expired()
+            await asyncio.sleep(interval)
 
     async def start_sender(
         self, websocket: "websockets.client.WebSocketClientProtocol"
     ):
         while not websocket.closed:
-            request_dict = await self.send_queue.get()
-            logger.debug(f"SEND: {request_dict}")
-            try:
+            if not self._unsent:
+                self._unsent.append(await self.send_queue.get())
+            while len(self._unsent) < self.send_window and not self.send_queue.empty():
+                self._unsent.append(self.send_queue.get_nowait())
+
+            burst = len(self._unsent)
+            self.send_stats.bursts += 1
+            self.send_stats.max_burst = max(self.send_stats.max_burst, burst)
+            # 缓冲区未满时send不会让出事件循环，整批请求连续写出
+            while self._unsent:
+                request_dict = self._unsent[0]
+                logger.debug(f"SEND: {request_dict}")
                 await websocket.send(json.dumps(request_dict))
-            except websockets.ConnectionClosedError:
-                await self.send_queue.put(request_dict)
-                raise
+                self._unsent.popleft()
+                self.send_stats.sent += 1
+
+    async def _enqueue(self, request):
+        if self.send_queue.full():
+            self.send_stats.backpressure_waits += 1
+        await self.send_queue.put(request)
+        self.send_stats.queue_high_water = max(
+            self.send_stats.queue_high_water, self.send_queue.qsize()
+        )
 
     async def start_receiver(
         self, websocket: "websockets.client.WebSocketClientProtocol"
@@ -56,14 +200,65 @@ class BotWebsocketRPCClient:
         async for message in websocket:
             logger.debug(f"RECV: {message}")
             try:
-                response_dict = json.loads(message)
-                if "result" in response_dict:
-                    self._results[response_dict["id"]] = response_dict["result"]
-                elif "error" in response_dict:
-                    self._results[response_dict["id"]] = response_dict["error"]
-                    logger.error(response_dict["error"])
+                response = json.loads(message)
             except json.JSONDecodeError:
                 continue
+            if (
+                isinstance(response, dict)
+                and "error" in response
+                and response.get("id") is None
+            ):
+                # 无法处理的批量请求(如格式错误)只返回一个错误对象
+                self._fail_batch(response["error"])
+                continue
+            # 批量请求的响应为列表
+            for response_dict in response if isinstance(response, list) else [response]:
+                if "method" in response_dict:
+                    self._handle_notification(response_dict)
+                elif "result" in response_dict:
+                    self._set_result(response_dict["id"], response_dict["result"])
+                elif "error" in response_dict:
+                    logger.error(response_dict["error"])
+                    self._set_result(response_dict["id"], response_dict["error"])
+
+    def _purge_fire_and_forget(self):
+        now = time.monotonic()
+        while self._fire_and_forget:
+            request_id, expire_at = next(iter(self._fire_and_forget.items()))
+            if expire_at > now:
+                break
+            del self._fire_and_forget[request_id]
+
+    def _fail_batch(self, error):
+        """错误对象没有id，无法对应到请求，作为最早发出且仍在等待的批量请求的结果"""
+        logger.error(error)
+        while self._pending_batches:
+            _, request_ids = self._pending_batches.popitem(last=False)
+            pending = [i for i in request_ids if i in self._pending]
+            if pending:
+                for request_id in pending:
+                    self._set_result(request_id, error)
+                return
+        self.orphaned_responses += 1
+        logger.warning("Orphaned error response without id")
+
+    def _set_result(self, request_id, result):
+        future = self._pending.pop(request_id, None)
+        if future is not None:
+            if not future.done():
+                future.set_result(result)
+        elif self._fire_and_forget.pop(request_id, None) is not None:
+            self._results.set(request_id, result)
+        elif self._abandoned.pop(request_id, _missing) is not _missing:
+            self.late_responses += 1
+            logger.debug(f"Late response for request {request_id}")
+        else:
+            self.orphaned_responses += 1
+            logger.warning(f"Orphaned response for request {request_id}")
+
+    def get_result(self, request_id, default=None):
+        """获取timeout<0调用的结果，未收到或已过期时返回`default`"""
+        return self._results.get(request_id, default)
 
     async def start_consumer(self):
         logger.info("Starting rpc client consumer")
@@ -92,28 +287,69 @@ class BotWebsocketRPCClient:
         asyncio.create_task(self.start_result_cleaner())
 
     async def _send_and_recv(self, request):
-        await self.send_queue.put(request)
-        request_id = request["id"]
-        while True:
-            if self._results[request_id] is unset:
-                await asyncio.sleep(0.1)
-            else:
-                return self._results[request_id]
+        """`request`为列表时作为批量请求发送，按顺序返回结果列表"""
+        is_batch = isinstance(request, list)
+        request_ids = [r["id"] for r in request] if is_batch else [request["id"]]
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in request_ids]
+        self._pending.update(zip(request_ids, futures))
+        if is_batch:
+            self._pending_batches[request_ids[0]] = request_ids
+        try:
+            await self._enqueue(request)
+            results = await asyncio.gather(*futures)
+        finally:
+            if is_batch:
+                self._pending_batches.pop(request_ids[0], None)
+            # 超时或取消时记录，用于区分迟到的响应
+            for request_id in request_ids:
+                if self._pending.pop(request_id, None) is not None:
+                    self._abandoned.set(request_id, None)
+        return results if is_batch else results[0]
 
-    async def rpc_call(self, name: str, params, timeout):
-        request = req(name, params)
-        request_id = request["id"]
-        self._current_request_id = request_id
+    async def _call(self, request, timeout, description):
         if timeout < 0:
-            asyncio.create_task(self.send_queue.put(request))
-            return request_id
+            is_batch = isinstance(request, list)
+            request_ids = [r["id"] for r in request] if is_batch else [request["id"]]
+            expire_at = time.monotonic() + self._results.ttl
+            for request_id in request_ids:
+                self._fire_and_forget[request_id] = expire_at
+            await self._enqueue(request)
+            return request_ids if is_batch else request_ids[0]
         if timeout == 0:
             return await self._send_and_recv(request)
         else:
             try:
                 return await asyncio.wait_for(self._send_and_recv(request), timeout)
             except asyncio.TimeoutError:
-                raise Timeout(f"Timeout: rpc call timeout: {name}, params {params}")
+                raise Timeout(f"Timeout: rpc call timeout: {description}")
+
+    async def rpc_call(self, name: str, params, timeout):
+        request = req(name, params)
+        self._current_request_id = request["id"]
+        return await self._call(request, timeout, f"{name}, params {params}")
+
+    def batch(self, timeout=5) -> "RPCBatch":
+        """
+        批量调用，所有请求作为一个JSON-RPC批量请求发送
+
+        async with client.batch() as batch:
+            batch.send_text(wx_pid, "filehelper", "hello")
+            batch.send_text(wx_pid, "filehelper", "world")
+        print(batch.results)
+        """
+        return RPCBatch(self, timeout=timeout)
+
+    def stats(self):
+        return {
+            "queued": self.send_queue.qsize() + len(self._unsent),
+            "in_flight": len(self._pending),
+            **self.send_stats.as_dict(),
+            "results": self._results.stats(),
+            "awaiting_results": len(self._fire_and_forget),
+            "late_responses": self.late_responses,
+            "orphaned_responses": self.orphaned_responses,
+        }
 
     def __getattr__(self, item):
         def remote_func(*params, timeout=5):
@@ -126,6 +362,48 @@ class BotWebsocketRPCClient:
         return remote_func
 
 
+class RPCBatch:
+    def __init__(self, rpc_client: "BotWebsocketRPCClient", timeout=5):
+        """
+        :param timeout: 超时时间，同`BotWebsocketRPCClient.rpc_call`
+        """
+        self.rpc_client = rpc_client
+        self.timeout = timeout
+        self.requests = []
+        self.results = None
+
+    def add(self, name: str, *params):
+        request = req(name, params)
+        self.requests.append(request)
+        return request["id"]
+
+    async def execute(self, timeout=None):
+        """
+        发送所有已添加的请求
+
+        :return: 按添加顺序排列的结果列表，timeout<0时为请求id列表
+        """
+        timeout = self.timeout if timeout is None else timeout
+        requests, self.requests = self.requests, []
+        if not requests:
+            self.results = []
+        else:
+            self.results = await self.rpc_client._call(
+                requests, timeout, f"batch of {len(requests)} requests"
+            )
+        return self.results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.execute()
+
+    def __getattr__(self, item):
+        return partial(self.add, item)
+
+
 class OneBotWebsocketRPCClient:
     """For convenience"""
 
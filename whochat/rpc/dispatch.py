@@ -0,0 +1,104 @@
+"""
+JSON-RPC请求分发，支持批量请求
+
+批量请求中同一微信进程(wx_pid)的调用在同一COM线程中依次执行，其余调用并发执行
+"""
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from jsonrpcserver import (
+    async_dispatch,
+    async_dispatch_to_serializable,
+    dispatch_to_serializable,
+)
+from jsonrpcserver.codes import ERROR_INTERNAL_ERROR
+from jsonrpcserver.response import ErrorResponse, serialize_error
+
+from whochat.errors import WhochatError
+from whochat.rpc.handlers import BotRpcHelper, bot_executors
+
+logger = logging.getLogger("whochat")
+
+
+def _identity(x):
+    return x
+
+
+def _get_wx_pid(item) -> Optional[int]:
+    if not isinstance(item, dict) or not BotRpcHelper.is_bot_method(item.get("method")):
+        return None
+    params = item.get("params")
+    if isinstance(params, list) and params:
+        wx_pid = params[0]
+    elif isinstance(params, dict):
+        wx_pid = params.get("wx_pid")
+    else:
+        return None
+    try:
+        return int(wx_pid)
+    except (TypeError, ValueError):
+        return None
+
+
+def _dispatch_in_order(items: List[Dict[str, Any]]) -> List[Optional[dict]]:
+    methods = BotRpcHelper.make_rpc_methods()
+    return [
+        dispatch_to_serializable(item, methods=methods, deserializer=_identity)
+        for item in items
+    ]
+
+
+async def _dispatch_one(item) -> List[Optional[dict]]:
+    return [await async_dispatch_to_serializable(item, deserializer=_identity)]
+
+
+def _internal_errors(items, exc: BaseException) -> List[Optional[dict]]:
+    """一组调用执行失败(如COM线程初始化失败)时，其中的请求均返回内部错误，通知不返回"""
+    if isinstance(exc, WhochatError):
+        code, message, data = exc.code, exc.message, exc.data
+    else:
+        code, message, data = ERROR_INTERNAL_ERROR, "Internal error", repr(exc)
+    return [
+        serialize_error(ErrorResponse(code, message, data, item["id"]))
+        if isinstance(item, dict) and "id" in item
+        else None
+        for item in items
+    ]
+
+
+async def dispatch(request: str) -> str:
+    """与`jsonrpcserver.async_dispatch`相同，额外处理批量请求"""
+    try:
+        deserialized = json.loads(request)
+    except (json.JSONDecodeError, TypeError):
+        deserialized = None
+    if not isinstance(deserialized, list) or not deserialized:
+        return await async_dispatch(request)
+
+    # wx_pid -> [(index, item)]
+    groups = defaultdict(list)
+    tasks = {}
+    for index, item in enumerate(deserialized):
+        wx_pid = _get_wx_pid(item)
+        if wx_pid is None:
+            tasks[(index,)] = _dispatch_one(item)
+        else:
+            groups[wx_pid].append((index, item))
+    for wx_pid, indexed_items in groups.items():
+        indexes, items = zip(*indexed_items)
+        tasks[indexes] = bot_executors.run(wx_pid, _dispatch_in_order, list(items))
+
+    responses: List[Optional[dict]] = [None] * len(deserialized)
+    gathered = await asyncio.gather(*tasks.values(), return_exceptions=True)
+    for indexes, results in zip(tasks.keys(), gathered):
+        if isinstance(results, BaseException):
+            logger.error(f"批量请求执行失败: {results!r}")
+            results = _internal_errors([deserialized[i] for i in indexes], results)
+        for index, response in zip(indexes, results):
+            responses[index] = response
+
+    responses = [response for response in responses if response is not None]
+    return json.dumps(responses) if responses else ""
@@ -1,43 +1,15 @@
-import inspect
-from collections import OrderedDict
+import json
 
-from whochat.rpc.handlers import make_rpc_methods
-
-_docs = []
+from whochat.rpc.registry import rpc_registry
 
 
 def make_docs():
-    if _docs:
-        return _docs
-    rpc_methods = make_rpc_methods()
-
-    for name, rpc_method in OrderedDict(
-        {key: rpc_methods[key] for key in sorted(rpc_methods.keys())}
-    ).items():
-        s = inspect.signature(rpc_method)
-        description = rpc_method.__doc__
-        params = []
-        if rpc_method.__qualname__.split(".", maxsplit=1)[0] == "WechatBot":
-            params.append(
-                {
-                    "name": "wx_pid",
-                    "default": None,
-                    "required": True,
-                }
-            )
-        for param in s.parameters.values():
-            if param.name == "self":
-                continue
-            params.append(
-                {
-                    "name": param.name,
-                    "default": None if param.default is param.empty else param.default,
-                    "required": param.default is param.empty,
-                }
-            )
-        _docs.append({"name": name, "description": description, "params": params})
+    """RPC接口文档，参数包含JSON-Schema类型描述(`schema`)，结果类型为`result`"""
+    return rpc_registry.docs()
+
 
-    return _docs
+def _schema_repr(schema: dict) -> str:
+    return json.dumps(schema, ensure_ascii=False) if schema else "any"
 
 
 def pretty_docs():
@@ -49,12 +21,14 @@ def pretty_docs():
         s += "Params: \n\t"
         for param in item["params"]:
             s += f"Name: `{param['name']}`\n\t"
+            s += f"Type: `{_schema_repr(param['schema'])}`\n\t"
             s += f"Required: `{str(param['required']).lower()}`\n\t"
             s += (
                 f"Default: `{param['default']}`\n"
                 if param["default"] is not None
                 else "\n\t"
             )
+        s += f"Result: `{_schema_repr(item['result'])}`\n"
 
         s += "\n-----------------------------------------------------\n"
     return s
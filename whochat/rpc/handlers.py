@@ -1,17 +1,17 @@
 import asyncio
-import dataclasses
 import functools
 import logging
-import time
-from concurrent.futures import ThreadPoolExecutor
-from typing import Callable, Dict, List
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict
 
-import schedule
-from jsonrpcserver import InvalidParams, Success
+from jsonrpcserver import Error, InvalidParams, Success
 
 from whochat import _comtypes as comtypes
-from whochat.bot import WechatBot, WechatBotFactory
-from whochat.signals import Signal
+from whochat.bot import ServiceState, WechatBot, WechatBotFactory
+from whochat.errors import WechatNotFoundError, WhochatError
+from whochat.processes import wechat_process_registry
+from whochat.rpc.registry import rpc_registry
 
 logger = logging.getLogger("whochat")
 
@@ -22,6 +22,138 @@ bot_executor = ThreadPoolExecutor(
 )
 
 
+class BotExecutors:
+    """
+    每个微信进程使用独立的COM(STA)线程及任务队列，
+    同一微信进程的调用总在相同线程中执行，COM对象只创建一次，且不同微信进程之间互不阻塞
+    """
+
+    def __init__(self, max_workers_per_bot: int = 1):
+        self.max_workers_per_bot = max_workers_per_bot
+        self._executors: Dict[int, ThreadPoolExecutor] = {}
+        # wx_pid -> 已提交未完成的任务数
+        self._pending: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, wx_pid) -> ThreadPoolExecutor:
+        wx_pid = int(wx_pid)
+        executor = self._executors.get(wx_pid)
+        if executor is None:
+            # 不为不存在的pid创建线程，进程退出后由`on_wechat_processes_change`释放
+            if wechat_process_registry.get(wx_pid) is None:
+                raise WechatNotFoundError(f"微信进程{wx_pid}不存在", wx_pid)
+            with self._lock:
+                executor = self._executors.get(wx_pid)
+                if executor is None:
+                    executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers_per_bot,
+                        thread_name_prefix=f"bot-{wx_pid}",
+                        initializer=comtypes.CoInitializeEx,
+                        initargs=(comtypes.COINIT_APARTMENTTHREADED,),
+                    )
+                    self._executors[wx_pid] = executor
+                    self._pending[wx_pid] = 0
+        return executor
+
+    def submit(self, wx_pid, fn, *args, **kwargs) -> Future:
+        wx_pid = int(wx_pid)
+        executor = self.get(wx_pid)
+        with self._lock:
+            self._pending[wx_pid] += 1
+        future = executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda _: self._task_done(wx_pid))
+        return future
+
+    async def run(self, wx_pid, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(wx_pid, fn, *args, **kwargs))
+
+    def _task_done(self, wx_pid):
+        with self._lock:
+            if wx_pid in self._pending:
+                self._pending[wx_pid] -= 1
+
+    def remove(self, wx_pid, wait=False):
+        """微信进程退出后释放其线程"""
+        wx_pid = int(wx_pid)
+        with self._lock:
+            executor = self._executors.pop(wx_pid, None)
+            self._pending.pop(wx_pid, None)
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def shutdown(self, wait=False):
+        for wx_pid in list(self._executors):
+            self.remove(wx_pid, wait=wait)
+
+    def on_wechat_processes_change(self, started, exited):
+        for process in exited:
+            if process.pid in self._executors:
+                logger.info(f"微信进程{process.pid}已退出，释放其COM线程")
+                self.remove(process.pid)
+
+    def stats(self) -> Dict[int, int]:
+        """各微信进程排队及执行中的任务数"""
+        with self._lock:
+            return dict(self._pending)
+
+
+bot_executors = BotExecutors()
+wechat_process_registry.on_change(bot_executors.on_wechat_processes_change)
+
+
+class BotHealthMonitor:
+    """
+    后台定期在各微信进程的COM线程中通过`is_wx_login`检查已启动的机器人服务，
+    不可用时标记为失败，下次调用时重新启动，调用方法时不再每次检查
+    """
+
+    def __init__(self, interval: float = 30):
+        self.interval = interval
+        # wx_pid -> 正在进行的检查
+        self._probing: Dict[int, Future] = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def probe_all(self):
+        for bot in WechatBotFactory.bots():
+            if bot.state is not ServiceState.STARTED:
+                continue
+            future = self._probing.get(bot.wx_pid)
+            # COM线程繁忙时上次检查可能还未执行
+            if future is not None and not future.done():
+                continue
+            try:
+                self._probing[bot.wx_pid] = bot_executors.submit(bot.wx_pid, bot.probe)
+            except WhochatError as e:
+                logger.warning(f"检查微信进程{bot.wx_pid}失败: {e}")
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.probe_all()
+            except Exception as e:
+                logger.exception(e)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="bot-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+bot_health_monitor = BotHealthMonitor()
+
+
+def rpc_error(e: WhochatError):
+    """`WhochatError`转换为对应错误码的JSON-RPC错误"""
+    logger.warning(f"{e.message}: {e}")
+    return Error(e.code, e.message, e.data)
+
+
 class BotRpcHelper:
     bot_methods = {
         method.__name__: method
@@ -36,22 +168,27 @@ class BotRpcHelper:
             WechatBot.get_chat_room_member_ids,
             WechatBot.get_chat_room_member_nickname,
             WechatBot.get_chat_room_members,
+            WechatBot.get_contact,
             WechatBot.get_db_handles,
             WechatBot.get_friend_list,
             WechatBot.get_history_public_msg,
             WechatBot.get_msg_cdn,
             WechatBot.get_qrcode_image,
             WechatBot.get_self_info,
+            WechatBot.get_service_state,
             WechatBot.get_transfer,
             WechatBot.get_wechat_ver,
             WechatBot.get_wx_user_info,
             WechatBot.hook_image_msg,
             WechatBot.hook_voice_msg,
+            WechatBot.invalidate_chat_room_members,
+            WechatBot.invalidate_contacts,
             WechatBot.is_wx_login,
             WechatBot.logout,
             WechatBot.open_browser,
             WechatBot.prevent_revoke,
             WechatBot.search_contact_by_net,
+            WechatBot.search_contacts,
             WechatBot.send_app_msg,
             WechatBot.send_article,
             WechatBot.send_at_text,
@@ -76,9 +213,20 @@ class BotRpcHelper:
             WechatBotFactory.start_wechat,
         ]
     }
+    # 需要`wx_pid`作为第一个参数的`WechatBot`方法，按是否为`WechatBot`的属性判断，不依赖`__qualname__`
+    bot_self_methods = frozenset(
+        name
+        for name, method in bot_methods.items()
+        if vars(WechatBot).get(name) is method
+    )
     rpc_methods = {}
     async_rpc_methods = {}
 
+    @classmethod
+    def is_bot_method(cls, name) -> bool:
+        """是否为需要`wx_pid`作为第一个参数的`WechatBot`方法"""
+        return name in cls.bot_self_methods
+
     @classmethod
     def make_rpc_methods(cls):
         if cls.rpc_methods:
@@ -86,24 +234,35 @@ class BotRpcHelper:
 
         from whochat.bot import WechatBotFactory
 
-        def factory(func):
+        def factory(name, func):
             @functools.wraps(func)
             def bot_self_func(wx_pid, *args, **kwargs):
-                bot = WechatBotFactory.get(wx_pid)
-                _func = functools.partial(func, bot, *args, **kwargs)
-                return Success(_func())
+                error = rpc_registry.validate(name, (wx_pid, *args), kwargs)
+                if error is not None:
+                    return InvalidParams(error)
+                try:
+                    bot = WechatBotFactory.get(wx_pid)
+                    return Success(func(bot, *args, **kwargs))
+                except WhochatError as e:
+                    return rpc_error(e)
 
             @functools.wraps(func)
             def normal_func(*args, **kwargs):
+                error = rpc_registry.validate(name, args, kwargs)
+                if error is not None:
+                    return InvalidParams(error)
                 _func = functools.partial(func, *args, **kwargs)
-                return Success(_func())
+                try:
+                    return Success(_func())
+                except WhochatError as e:
+                    return rpc_error(e)
 
-            if func.__qualname__.split(".", maxsplit=1)[0] == "WechatBot":
+            if cls.is_bot_method(name):
                 return bot_self_func
             return normal_func
 
         for name, function in cls.bot_methods.items():
-            cls.rpc_methods[name] = factory(function)
+            cls.rpc_methods[name] = factory(name, function)
         return cls.rpc_methods
 
     @classmethod
@@ -113,218 +272,66 @@ class BotRpcHelper:
 
         from whochat.bot import WechatBotFactory
 
-        def factory(func):
+        def factory(name, func):
             @functools.wraps(func)
             async def bot_self_func(wx_pid, *args, **kwargs):
+                error = rpc_registry.validate(name, (wx_pid, *args), kwargs)
+                if error is not None:
+                    return InvalidParams(error)
                 try:
                     bot = WechatBotFactory.get(wx_pid)
-                    loop = asyncio.get_running_loop()
-                    result = await loop.run_in_executor(
-                        bot_executor,
-                        functools.partial(func, bot, *args, **kwargs),
+                    result = await bot_executors.run(
+                        bot.wx_pid, functools.partial(func, bot, *args, **kwargs)
                     )
                     return Success(result)
+                except WhochatError as e:
+                    return rpc_error(e)
                 except Exception as e:
                     logger.exception(e)
                     raise
 
             @functools.wraps(func)
             async def normal_func(*args, **kwargs):
+                error = rpc_registry.validate(name, args, kwargs)
+                if error is not None:
+                    return InvalidParams(error)
                 try:
                     _func = functools.partial(func, *args, **kwargs)
                     loop = asyncio.get_running_loop()
                     result = await loop.run_in_executor(bot_executor, _func)
                     return Success(result)
+                except WhochatError as e:
+                    return rpc_error(e)
                 except Exception as e:
                     logger.exception(e)
                     raise
 
-            if func.__qualname__.split(".", maxsplit=1)[0] == "WechatBot":
+            if cls.is_bot_method(name):
                 return bot_self_func
             return normal_func
 
         for name, function in cls.bot_methods.items():
-            cls.async_rpc_methods[name] = factory(function)
+            cls.async_rpc_methods[name] = factory(name, function)
         return cls.async_rpc_methods
 
 
-@dataclasses.dataclass
-class BotJob:
-    """
-
-    {
-        "name": "",
-        "unit": "days",
-        "every": 1,
-        "at": "12:00:00",
-        "do": {
-            "func": "",
-            "args": []
-        },
-        "description": "",
-        "tags": ""
-    }
-    """
-
-    name: str
-    unit: str
-    every: int
-    at: str
-    do: dict
-    description: str = None
-    tags: List[str] = dataclasses.field(default_factory=list)
-    _job_func: Callable = dataclasses.field(init=False, default=None)
-
-    def __post_init__(self):
-        func_name, func_args = self.do["func"], self.do["args"]
-        self._job_func = functools.partial(
-            BotRpcHelper.make_rpc_methods()[func_name], *func_args
-        )
-
-    @property
-    def job_func(self):
-        return self._job_func
-
-    def as_dict(self):
-        return {
-            "name": self.name,
-            "unit": self.unit,
-            "every": self.every,
-            "at": self.at,
-            "do": self.do,
-            "description": self.description,
-            "tags": self.tags,
-        }
-
-
-scheduler_executor = ThreadPoolExecutor(
-    max_workers=2,
-    initializer=comtypes.CoInitializeEx,
-    initargs=(comtypes.COINIT_APARTMENTTHREADED,),
-)
-
-
-class BotScheduler:
-    def __init__(self, loop=None):
-        self.jobs: Dict[str, "BotJob"] = {}
-        self._loop = loop
-        self.executor = scheduler_executor
-        self.scheduler = schedule.default_scheduler
-        self.scheduled = False
-        self.__shutdown = False
-
-    @property
-    def loop(self):
-        if self._loop is None:
-            self._loop = asyncio.get_running_loop()
-        return self._loop
-
-    def run(self):
-        logger.info("开始运行任务消费线程")
-        while not self.__shutdown:
-            self.scheduler.run_pending()
-            time.sleep(0.3)
-        logger.info("任务消费线程已停止")
-
-    def schedule(self):
-        if self.scheduled:
-            return
-        self.scheduled = True
-        Signal.register_sigint(self.shutdown)
-        self.executor.submit(self.run)
-
-    def shutdown(self):
-        logger.info("正在取消所有任务...")
-        self.__shutdown = True
-        self._cancel_jobs()
-        self.executor.shutdown(wait=False)
-
-    async def schedule_a_job(
-        self,
-        name: str,
-        unit: str,
-        every: int,
-        at: str,
-        do: dict,
-        description=None,
-        tags=None,
-    ):
-        """
-        {
-            "name": "Greet",
-            "unit": "days",
-            "every": 1,
-            "at": "08:00:00",
-            "do": {
-                "func": "send_text",
-                "args": [12314, "wxid_foo", "Morning!"]
-            },
-            "description": "",
-            "tags": ["tian"]
-        }
-        参见 https://schedule.readthedocs.io/en/stable/examples.html
-        :param name: 任务名
-        :param unit: 单位，seconds, minutes, hours, days, weeks, monday, tuesday, wednesday, thursday, friday, saturday, sunday
-        :param every: 每<unit>
-        :param at:  For daily jobs -> HH:MM:SS or HH:MM
-                    For hourly jobs -> MM:SS or :MM
-                    For minute jobs -> :SS
-        :param do: 执行的方法，func: 方法名, args: 参数列表
-        :param description: 描述
-        :param tags: 标签，总会添加任务名作为标签
-        """
-        self.schedule()
-        try:
-            job = BotJob(name, unit, every, at, do, description, tags or [])
-            assert job.name not in self.jobs
-            self.jobs[job.name] = job
-            schedule_job = self.scheduler.every(job.every)
-            schedule_job.unit = job.unit
-            schedule_job.at(job.at).do(job.job_func).tag(*job.tags, job.name)
-        except AssertionError:
-            return InvalidParams(f"任务<{name}>已存在")
-        except Exception as e:
-            return InvalidParams(f"参数错误: {str(e)}")
-        return Success()
-
-    def _cancel_jobs(self, tag=None):
-        if tag is None:
-            self.jobs.clear()
-        self.jobs.pop(tag, None)
-        self.scheduler.clear(tag=tag)
-        return Success()
-
-    async def cancel_jobs(self, tag=None):
-        """
-        取消任务
-        :param tag: 标签名
-        """
-        await self.loop.run_in_executor(
-            self.executor, functools.partial(self._cancel_jobs, tag=tag)
-        )
-        return Success()
-
-    async def list_jobs(self):
-        """列出所有任务"""
-        return Success({name: job.as_dict() for name, job in self.jobs.items()})
-
-    def get_rpc_methods(self) -> Dict[str, Callable]:
-        return {
-            method.__name__: method
-            for method in [self.schedule_a_job, self.cancel_jobs, self.list_jobs]
-        }
-
-
-default_bot_scheduler = BotScheduler()
-
-
 def make_rpc_methods():
+    from whochat.rpc.bulk import default_bulk_sender
+    from whochat.rpc.scheduler import default_bot_scheduler
+
     rpc_methods = BotRpcHelper.make_async_rpc_methods()
     rpc_methods.update(default_bot_scheduler.get_rpc_methods())
+    rpc_methods.update(default_bulk_sender.get_rpc_methods())
     return rpc_methods
 
 
 def register_rpc_methods():
     from jsonrpcserver.methods import global_methods
 
+    from whochat.rpc.scheduler import default_bot_scheduler
+
     global_methods.update(make_rpc_methods())
+    # 及时发现退出的微信进程，释放其bot及COM线程
+    wechat_process_registry.watch()
+    bot_health_monitor.start()
+    default_bot_scheduler.start()
@@ -0,0 +1,365 @@
+"""
+RPC接口描述
+
+`RpcRegistry`为每个RPC方法生成一次JSON-Schema描述：参数名、默认值及类型。
+`WechatBot`方法的类型取自`bot.py`中的`@overload`签名(实现大多没有类型注解)，
+结果按whochat版本缓存到磁盘(`~/.whochat/rpc-schema-<version>.json`)，并记录定义这些方法的源码摘要，
+源码(签名或类型注解)变化后重新生成。
+接口文档和调用前的参数检查都使用该描述，参数错误的调用不会进入COM线程池
+"""
+import ast
+import dataclasses
+import hashlib
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import typing
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+
+from whochat import __version__
+from whochat.settings import settings
+
+logger = logging.getLogger("whochat")
+
+# 描述格式变化时修改，使旧的缓存失效
+SCHEMA_FORMAT = 1
+
+WX_PID_SCHEMA = {"type": ["integer", "string"]}
+
+_TYPE_SCHEMAS = {
+    str: {"type": "string"},
+    bytes: {"type": "string"},
+    int: {"type": "integer"},
+    float: {"type": "number"},
+    bool: {"type": "boolean"},
+    dict: {"type": "object"},
+    list: {"type": "array"},
+    tuple: {"type": "array"},
+    type(None): {"type": "null"},
+}
+
+_JSON_TYPES = {
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "object": dict,
+    "array": list,
+    "null": type(None),
+}
+
+
+def annotation_schema(annotation) -> dict:
+    """类型注解转换为JSON-Schema，无法表示的类型不限制"""
+    if annotation is inspect.Parameter.empty or annotation is Any:
+        return {}
+    schema = _TYPE_SCHEMAS.get(annotation)
+    if schema is not None:
+        return dict(schema)
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+    if origin is Union:
+        return {"anyOf": [annotation_schema(arg) for arg in args]}
+    if origin in (list, tuple):
+        schema = {"type": "array"}
+        if origin is list and args:
+            schema["items"] = annotation_schema(args[0])
+        return schema
+    if origin is dict:
+        return {"type": "object"}
+    return {}
+
+
+def _allows_null(schema: dict) -> bool:
+    if not schema:
+        return True
+    if "anyOf" in schema:
+        return any(_allows_null(item) for item in schema["anyOf"])
+    types = schema.get("type")
+    return types == "null" or (isinstance(types, list) and "null" in types)
+
+
+def check(schema: dict, value) -> bool:
+    """检查值是否符合由`annotation_schema`生成的JSON-Schema"""
+    if "anyOf" in schema:
+        return any(check(item, value) for item in schema["anyOf"])
+    types = schema.get("type")
+    if types is None:
+        return True
+    for type_ in types if isinstance(types, list) else [types]:
+        python_type = _JSON_TYPES[type_]
+        # bool是int的子类
+        if isinstance(value, bool) and type_ in ("integer", "number"):
+            continue
+        if isinstance(value, python_type):
+            items = schema.get("items")
+            if type_ == "array" and items:
+                return all(check(items, item) for item in value)
+            return True
+    return False
+
+
+def overload_annotations(cls) -> Dict[str, Dict[str, Any]]:
+    """
+    解析类源码中`@overload`方法的类型注解: {方法名: {参数名: 注解, "return": 注解}}
+    Python 3.11之前运行时无法获取`@overload`签名，因此解析源码
+    """
+    module = sys.modules[cls.__module__]
+    try:
+        source = inspect.getsource(module)
+    except (OSError, TypeError):
+        return {}
+    namespace = vars(module)
+
+    def evaluate(node):
+        if node is None:
+            return inspect.Parameter.empty
+        try:
+            return eval(ast.get_source_segment(source, node), namespace)
+        except Exception:
+            return inspect.Parameter.empty
+
+    results = {}
+    for node in ast.walk(ast.parse(source)):
+        if not (isinstance(node, ast.ClassDef) and node.name == cls.__name__):
+            continue
+        for item in node.body:
+            if not isinstance(item, ast.FunctionDef) or not any(
+                isinstance(decorator, ast.Name) and decorator.id == "overload"
+                for decorator in item.decorator_list
+            ):
+                continue
+            annotations = {
+                arg.arg: evaluate(arg.annotation)
+                for arg in item.args.args + item.args.kwonlyargs
+            }
+            annotations["return"] = evaluate(item.returns)
+            results[item.name] = annotations
+    return results
+
+
+def source_digest(functions: Iterable[Callable]) -> str:
+    """定义这些函数的源文件(及本模块)内容的摘要"""
+    paths = {__file__}
+    for func in functions:
+        try:
+            paths.add(inspect.getfile(func))
+        except TypeError:
+            continue
+    digest = hashlib.sha1(str(SCHEMA_FORMAT).encode())
+    for path in sorted(paths):
+        try:
+            digest.update(Path(path).read_bytes())
+        except OSError:
+            digest.update(path.encode())
+    return digest.hexdigest()
+
+
+@dataclasses.dataclass
+class RpcMethodSpec:
+    name: str
+    description: Optional[str]
+    # [{"name", "required", "default", "schema"}]
+    params: List[dict]
+    result: dict
+    # 参数是否包含*args或**kwargs，包含时不检查参数
+    variadic: bool = False
+    _index: Dict[str, int] = dataclasses.field(init=False, repr=False, default=None)
+
+    def __post_init__(self):
+        self._index = {param["name"]: i for i, param in enumerate(self.params)}
+
+    @classmethod
+    def from_function(
+        cls, name: str, func: Callable, bot_method: bool, overloads: Dict[str, Any]
+    ) -> "RpcMethodSpec":
+        signature = inspect.signature(func)
+        params = []
+        variadic = False
+        if bot_method:
+            params.append(
+                {
+                    "name": "wx_pid",
+                    "required": True,
+                    "default": None,
+                    "schema": WX_PID_SCHEMA,
+                }
+            )
+        for param in signature.parameters.values():
+            if param.name == "self":
+                continue
+            if param.kind in (param.VAR_POSITIONAL, param.VAR_KEYWORD):
+                variadic = True
+                continue
+            annotation = overloads.get(param.name, inspect.Parameter.empty)
+            if annotation is inspect.Parameter.empty:
+                annotation = param.annotation
+            schema = annotation_schema(annotation)
+            required = param.default is param.empty
+            default = None if required else param.default
+            if not required and default is None and not _allows_null(schema):
+                schema = {"anyOf": [schema, {"type": "null"}]}
+            params.append(
+                {
+                    "name": param.name,
+                    "required": required,
+                    "default": default,
+                    "schema": schema,
+                }
+            )
+        result = overloads.get("return", inspect.Parameter.empty)
+        if result is inspect.Parameter.empty:
+            result = signature.return_annotation
+        return cls(
+            name=name,
+            description=inspect.getdoc(func),
+            params=params,
+            result=annotation_schema(result),
+            variadic=variadic,
+        )
+
+    def validate(self, args, kwargs) -> Optional[str]:
+        """返回参数错误的描述，参数正确时返回None"""
+        if self.variadic:
+            return None
+        params = self.params
+        if len(args) > len(params):
+            return f"{self.name}最多接受{len(params)}个参数，传入了{len(args)}个"
+        for param, value in zip(params, args):
+            if not check(param["schema"], value):
+                return f"参数{param['name']}类型错误: {value!r}"
+        for key, value in kwargs.items():
+            i = self._index.get(key)
+            if i is None:
+                return f"{self.name}没有参数{key}"
+            if i < len(args):
+                return f"参数{key}重复"
+            if not check(params[i]["schema"], value):
+                return f"参数{key}类型错误: {value!r}"
+        for param in params[len(args) :]:
+            if param["required"] and param["name"] not in kwargs:
+                return f"缺少参数{param['name']}"
+        return None
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "description": self.description,
+            "params": self.params,
+            "result": self.result,
+            "variadic": self.variadic,
+        }
+
+
+class RpcRegistry:
+    def __init__(self, cache_file: Union[str, Path] = None):
+        self.cache_file = Path(
+            cache_file or settings.CACHE_DIR.joinpath(f"rpc-schema-{__version__}.json")
+        )
+        self._specs: Dict[str, RpcMethodSpec] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _functions() -> Dict[str, Callable]:
+        """RPC方法名 -> 生成描述所用的函数，`WechatBot`方法使用未包装的原方法"""
+        from whochat.rpc.handlers import BotRpcHelper, make_rpc_methods
+
+        return {
+            name: BotRpcHelper.bot_methods.get(name, rpc_method)
+            for name, rpc_method in make_rpc_methods().items()
+        }
+
+    def _load_cache(self, names, digest: str) -> Optional[Dict[str, RpcMethodSpec]]:
+        try:
+            data = json.loads(self.cache_file.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取RPC接口描述缓存失败: {e!r}")
+            return None
+        if (
+            data.get("format") != SCHEMA_FORMAT
+            or data.get("digest") != digest
+            or set(data.get("methods", {})) != set(names)
+        ):
+            return None
+        return {name: RpcMethodSpec(**spec) for name, spec in data["methods"].items()}
+
+    def _save_cache(self, digest: str):
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.cache_file.with_suffix(".tmp")
+            tmp_file.write_text(
+                json.dumps(
+                    {
+                        "format": SCHEMA_FORMAT,
+                        "digest": digest,
+                        "methods": {
+                            name: spec.as_dict() for name, spec in self._specs.items()
+                        },
+                    },
+                    ensure_ascii=False,
+                ),
+                encoding="utf-8",
+            )
+            os.replace(tmp_file, self.cache_file)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"写入RPC接口描述缓存失败: {e!r}")
+
+    def build(self, functions: Dict[str, Callable] = None) -> Dict[str, RpcMethodSpec]:
+        from whochat.bot import WechatBot
+        from whochat.rpc.handlers import BotRpcHelper
+
+        overloads = overload_annotations(WechatBot)
+        specs = {}
+        for name, func in (functions or self._functions()).items():
+            specs[name] = RpcMethodSpec.from_function(
+                name,
+                func,
+                BotRpcHelper.is_bot_method(name),
+                overloads.get(name, {}) if BotRpcHelper.is_bot_method(name) else {},
+            )
+        return specs
+
+    @property
+    def specs(self) -> Dict[str, RpcMethodSpec]:
+        if not self._specs:
+            with self._lock:
+                if not self._specs:
+                    functions = self._functions()
+                    # 版本号不变时签名或类型注解也可能变化
+                    digest = source_digest(functions.values())
+                    specs = self._load_cache(functions, digest)
+                    if specs is None:
+                        self._specs = self.build(functions)
+                        self._save_cache(digest)
+                    else:
+                        self._specs = specs
+        return self._specs
+
+    def get(self, name: str) -> Optional[RpcMethodSpec]:
+        return self.specs.get(name)
+
+    def validate(self, name: str, args=(), kwargs=None) -> Optional[str]:
+        spec = self.specs.get(name)
+        if spec is None:
+            return None
+        return spec.validate(args, kwargs or {})
+
+    def docs(self) -> List[dict]:
+        return [
+            {
+                "name": spec.name,
+                "description": spec.description,
+                "params": spec.params,
+                "result": spec.result,
+            }
+            for name, spec in sorted(self.specs.items())
+        ]
+
+
+rpc_registry = RpcRegistry()
@@ -0,0 +1,712 @@
+"""
+定时任务
+
+`BotScheduler`按下次执行时间维护一个最小堆，调度线程睡眠到最近的任务到期(添加或取消任务时唤醒)，
+到期的任务交给对应微信进程的COM线程(`bot_executors`)执行，调度线程本身不执行任务，
+耗时的任务不会推迟其他任务。
+
+任务保存在本地文件中(默认`~/.whochat/jobs.json`)，启动时重新加载。
+到期时间已过去超过`misfire_grace_time`秒的执行(如服务停止期间)记为错过(misfire)并跳过，
+每次执行记录实际执行时间与计划时间的延迟(lateness)
+"""
+import dataclasses
+import functools
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+
+from jsonrpcserver import InvalidParams, Success
+
+from whochat.bot import WechatBotFactory
+from whochat.rpc.handlers import BotRpcHelper, bot_executor, bot_executors
+from whochat.rpc.registry import rpc_registry
+from whochat.settings import settings
+from whochat.signals import Signal
+
+logger = logging.getLogger("whochat")
+
+WEEKDAYS = [
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+]
+UNITS = ["seconds", "minutes", "hours", "days", "weeks"] + WEEKDAYS
+
+# unit -> at的格式
+AT_PATTERNS = {
+    "days": re.compile(r"^(\d{1,2}):(\d{2})(?::(\d{2}))?$"),
+    "hours": re.compile(r"^(\d{2})?:(\d{2})$"),
+    "minutes": re.compile(r"^:(\d{2})$"),
+}
+for _weekday in WEEKDAYS:
+    AT_PATTERNS[_weekday] = AT_PATTERNS["days"]
+
+
+def _parse_at(unit: str, at: str) -> Tuple[int, int, int]:
+    pattern = AT_PATTERNS.get(unit)
+    if pattern is None:
+        raise ValueError(f"{unit}任务不支持指定at")
+    m = pattern.match(at)
+    if not m:
+        raise ValueError(f"at格式错误: {at}")
+    values = [int(v) if v else 0 for v in m.groups()]
+    if unit == "hours":
+        # MM:SS 或 :MM
+        hour = 0
+        minute, second = values if m.group(1) else (values[1], 0)
+    elif unit == "minutes":
+        hour, minute, second = 0, 0, values[0]
+    else:
+        hour, minute, second = values
+    if hour > 23 or minute > 59 or second > 59:
+        raise ValueError(f"at格式错误: {at}")
+    return hour, minute, second
+
+
+class IntervalTrigger:
+    """与schedule库相同的`every(<every>).<unit>.at(<at>)`规则，计算下次执行时间"""
+
+    def __init__(self, unit: str, every: int = 1, at: str = None):
+        if unit not in UNITS:
+            raise ValueError(f"不支持的单位: {unit}")
+        if int(every) < 1:
+            raise ValueError("every必须大于0")
+        if unit in WEEKDAYS and int(every) != 1:
+            raise ValueError("按星期执行的任务every只能为1")
+        self.unit = unit
+        self.every = int(every)
+        self.at = _parse_at(unit, at) if at else None
+        if unit in WEEKDAYS:
+            self.period = timedelta(weeks=1)
+        else:
+            self.period = timedelta(**{unit: self.every})
+
+    def first_run(self, now: datetime) -> datetime:
+        if self.unit in WEEKDAYS:
+            hour, minute, second = self.at or (0, 0, 0)
+            days = (WEEKDAYS.index(self.unit) - now.weekday()) % 7
+            candidate = now.replace(
+                hour=hour, minute=minute, second=second, microsecond=0
+            ) + timedelta(days=days)
+        elif self.at is None:
+            return now + self.period
+        else:
+            hour, minute, second = self.at
+            if self.unit == "days":
+                candidate = now.replace(
+                    hour=hour, minute=minute, second=second, microsecond=0
+                )
+            elif self.unit == "hours":
+                candidate = now.replace(minute=minute, second=second, microsecond=0)
+            else:
+                candidate = now.replace(second=second, microsecond=0)
+        while candidate <= now:
+            candidate += self.period if self.unit in WEEKDAYS else self._unit_step()
+        return candidate
+
+    def _unit_step(self) -> timedelta:
+        return timedelta(**{self.unit: 1})
+
+    def next_run(self, previous: Optional[datetime], now: datetime) -> datetime:
+        """
+        :param previous: 上次的计划执行时间，为None时计算首次执行时间
+        :return: 晚于`now`的下次执行时间，错过的执行被合并
+        """
+        if previous is None:
+            return self.first_run(now)
+        candidate = previous + self.period
+        if candidate <= now:
+            candidate += self.period * ((now - candidate) // self.period + 1)
+        return candidate
+
+
+class DateTrigger:
+    """在`run_at`执行一次"""
+
+    def __init__(self, run_at: Union[str, float, int]):
+        if isinstance(run_at, (int, float)):
+            self.run_at = datetime.fromtimestamp(run_at)
+        else:
+            self.run_at = datetime.fromisoformat(run_at)
+
+    def next_run(self, previous: Optional[datetime], now: datetime):
+        return self.run_at if previous is None else None
+
+
+# 字段名, 最小值, 最大值
+CRON_FIELDS = [
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 7),
+]
+
+
+def _parse_cron_field(expr: str, minimum: int, maximum: int) -> Set[int]:
+    values = set()
+    for part in expr.split(","):
+        value_range, _, step = part.partition("/")
+        if value_range == "*":
+            start, end = minimum, maximum
+        elif "-" in value_range:
+            start, end = map(int, value_range.split("-", 1))
+        else:
+            start = end = int(value_range)
+            if step:
+                end = maximum
+        step = int(step) if step else 1
+        if start < minimum or end > maximum or start > end or step < 1:
+            raise ValueError(f"cron字段超出范围: {part}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronTrigger:
+    """
+    cron表达式: 分 时 日 月 星期，支持`*`、`a-b`、`*/n`、`a-b/n`及逗号分隔的列表，
+    星期0和7均为周日。日和星期都不为`*`时满足其一即可，与crontab相同
+    """
+
+    # 最多向后查找的年数，避免2月30日这样的表达式无限查找
+    max_years = 8
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron表达式应为5个字段: {expr}")
+        self.expr = expr
+        (self.minutes, self.hours, self.days, self.months, weekdays,) = (
+            _parse_cron_field(field, minimum, maximum)
+            for field, (_, minimum, maximum) in zip(fields, CRON_FIELDS)
+        )
+        # cron中0为周日，datetime.weekday()中0为周一
+        self.weekdays = {(weekday - 1) % 7 for weekday in weekdays}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+        if self.next_run(None, datetime.now()) is None:
+            raise ValueError(f"cron表达式不会被触发: {expr}")
+
+    def _day_matches(self, t: datetime) -> bool:
+        day = t.day in self.days
+        weekday = t.weekday() in self.weekdays
+        if self._any_day or self._any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_run(self, previous: Optional[datetime], now: datetime):
+        t = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        end_year = t.year + self.max_years
+        while t.year <= end_year:
+            if t.month not in self.months:
+                t = (t.replace(day=1) + timedelta(days=32)).replace(
+                    day=1, hour=0, minute=0
+                )
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        return None
+
+
+@dataclasses.dataclass
+class BotJob:
+    """
+
+    {
+        "name": "",
+        "unit": "days",
+        "every": 1,
+        "at": "12:00:00",
+        "do": {
+            "func": "",
+            "args": []
+        },
+        "description": "",
+        "tags": ""
+    }
+    `unit`、`run_at`、`cron`三者只能指定一个
+    """
+
+    name: str
+    unit: str = None
+    every: int = 1
+    at: str = None
+    do: dict = None
+    description: str = None
+    tags: List[str] = dataclasses.field(default_factory=list)
+    run_at: Union[str, float] = None
+    cron: str = None
+    # 每次执行随机推迟0至jitter秒
+    jitter: float = 0
+    # 不含随机推迟的计划执行时间，时间戳
+    due: Optional[float] = None
+    # 计划执行时间，时间戳
+    next_run: Optional[float] = None
+    last_run: Optional[float] = None
+    runs: int = 0
+    misfires: int = 0
+    failures: int = 0
+    # 最近一次执行相对计划时间的延迟，秒
+    lateness: Optional[float] = None
+    _trigger: Union[IntervalTrigger, DateTrigger, CronTrigger] = dataclasses.field(
+        init=False, default=None
+    )
+
+    def __post_init__(self):
+        if not isinstance(self.do, dict) or "func" not in self.do:
+            raise ValueError("do必须包含func")
+        func_name, func_args = self.do["func"], self.do.get("args", [])
+        if func_name not in BotRpcHelper.bot_methods:
+            raise ValueError(f"方法不存在: {func_name}")
+        if not isinstance(func_args, list):
+            raise ValueError("args必须为列表")
+        # 创建任务时检查参数，而不是到执行时才在COM线程中出错
+        error = rpc_registry.validate(func_name, func_args)
+        if error is not None:
+            raise ValueError(error)
+        if BotRpcHelper.is_bot_method(func_name):
+            if not func_args:
+                raise ValueError(f"{func_name}的第一个参数必须为wx_pid")
+            func_args[0] = int(func_args[0])
+        self.do = {"func": func_name, "args": func_args}
+        if self.name not in self.tags:
+            self.tags = [*self.tags, self.name]
+        if self.jitter < 0:
+            raise ValueError("jitter不能小于0")
+        self._trigger = self._make_trigger()
+
+    def _make_trigger(self):
+        if [self.unit, self.run_at, self.cron].count(None) != 2:
+            raise ValueError("unit、run_at、cron必须且只能指定一个")
+        if self.run_at is not None:
+            return DateTrigger(self.run_at)
+        if self.cron is not None:
+            return CronTrigger(self.cron)
+        return IntervalTrigger(self.unit, self.every, self.at)
+
+    def schedule_next(self, now: float) -> Optional[float]:
+        """计算下次执行时间，没有下次执行时返回None"""
+        previous = datetime.fromtimestamp(self.due) if self.due is not None else None
+        due = self._trigger.next_run(previous, datetime.fromtimestamp(now))
+        if due is None:
+            self.due = self.next_run = None
+            return None
+        self.due = due.timestamp()
+        self.next_run = self.due + (
+            random.uniform(0, self.jitter) if self.jitter else 0
+        )
+        return self.next_run
+
+    def submit(self) -> Future:
+        """提交到执行器：`WechatBot`方法在对应微信进程的COM线程中执行"""
+        func_name, func_args = self.do["func"], self.do["args"]
+        method = BotRpcHelper.bot_methods[func_name]
+        if BotRpcHelper.is_bot_method(func_name):
+            wx_pid, *args = func_args
+            bot = WechatBotFactory.get(wx_pid)
+            return bot_executors.submit(wx_pid, functools.partial(method, bot, *args))
+        return bot_executor.submit(functools.partial(method, *func_args))
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "unit": self.unit,
+            "every": self.every,
+            "at": self.at,
+            "do": self.do,
+            "description": self.description,
+            "tags": self.tags,
+            "run_at": self.run_at,
+            "cron": self.cron,
+            "jitter": self.jitter,
+            "due": self.due,
+            "next_run": self.next_run,
+            "last_run": self.last_run,
+            "runs": self.runs,
+            "misfires": self.misfires,
+            "failures": self.failures,
+            "lateness": self.lateness,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BotJob":
+        fields = {field.name for field in dataclasses.fields(cls) if field.init}
+        return cls(**{key: value for key, value in data.items() if key in fields})
+
+
+class JobStore:
+    """任务保存为一个JSON文件，写入临时文件后替换"""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+
+    def load(self) -> List[dict]:
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))["jobs"]
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"读取定时任务失败: {e!r}")
+            return []
+
+    def save(self, jobs: List[str]):
+        """
+        :param jobs: 已序列化的任务
+        """
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(".tmp")
+            tmp_path.write_text(
+                '{"jobs": [' + ",\n".join(jobs) + "]}", encoding="utf-8"
+            )
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"保存定时任务失败: {e!r}")
+
+
+class BotScheduler:
+    def __init__(
+        self,
+        store_path: Union[str, Path] = None,
+        misfire_grace_time: float = 60,
+        save_interval: float = 1,
+    ):
+        """
+        :param store_path: 任务保存路径，默认为`~/.whochat/jobs.json`
+        :param misfire_grace_time: 到期时间已过去超过该秒数时不再执行，记为错过
+        :param save_interval: 任务变化后最多延迟该秒数写入文件
+        """
+        self.jobs: Dict[str, BotJob] = {}
+        # 标签 -> {任务名: None}，按添加顺序
+        self._tags: Dict[str, Dict[str, None]] = {}
+        self.store = JobStore(store_path or settings.CACHE_DIR.joinpath("jobs.json"))
+        self.misfire_grace_time = misfire_grace_time
+        self.save_interval = save_interval
+        # [(next_run, seq, job)]，任务被取消或重新计划后旧的项在出堆时丢弃
+        self._heap: List[Tuple[float, int, BotJob]] = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._shutdown = False
+        self._dirty = False
+        self._saved_at = 0.0
+        # 任务名 -> 序列化后的任务，保存时只重新序列化有变化的任务
+        self._serialized: Dict[str, str] = {}
+        self._changed: Set[str] = set()
+
+        self.runs = 0
+        self.misfires = 0
+        self.failures = 0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    def _push(self, job: BotJob):
+        heapq.heappush(self._heap, (job.next_run, next(self._seq), job))
+
+    def _compact(self):
+        """取消的任务较多时重建堆，去掉已失效的项"""
+        if len(self._heap) > 2 * len(self.jobs) + 64:
+            self._heap = [
+                (job.next_run, next(self._seq), job) for job in self.jobs.values()
+            ]
+            heapq.heapify(self._heap)
+
+    def _add(self, job: BotJob, now: float) -> bool:
+        if job.next_run is None:
+            job.schedule_next(now)
+        if job.next_run is not None and job.next_run < now - self.misfire_grace_time:
+            # 服务停止期间错过的执行，或一次性任务的时间已过去
+            job.misfires += 1
+            self.misfires += 1
+            logger.warning(
+                f"任务<{job.name}>错过了计划于{datetime.fromtimestamp(job.next_run)}的执行"
+            )
+            job.schedule_next(now)
+        if job.next_run is None:
+            return False
+        self.jobs[job.name] = job
+        for tag in job.tags:
+            self._tags.setdefault(tag, {})[job.name] = None
+        self._push(job)
+        self._mark_changed(job.name)
+        return True
+
+    def _mark_changed(self, name: str):
+        self._changed.add(name)
+        self._dirty = True
+
+    def _remove(self, name: str):
+        job = self.jobs.pop(name)
+        for tag in job.tags:
+            names = self._tags.get(tag)
+            if names is not None:
+                names.pop(name, None)
+                if not names:
+                    del self._tags[tag]
+        self._serialized.pop(name, None)
+        self._changed.discard(name)
+        self._dirty = True
+
+    def load(self):
+        now = time.time()
+        with self._cond:
+            for data in self.store.load():
+                try:
+                    job = BotJob.from_dict(data)
+                except Exception as e:
+                    logger.warning(f"加载定时任务{data.get('name')}失败: {e!r}")
+                    continue
+                self._add(job, now)
+            self._cond.notify()
+        logger.info(f"加载了{len(self.jobs)}个定时任务")
+
+    def _on_done(self, job: BotJob, future: Future):
+        """在COM线程中回调，计数需持有锁；任务已完成时在调度线程中同步回调，`_cond`为可重入锁"""
+        e = future.exception()
+        if e is not None:
+            with self._cond:
+                job.failures += 1
+                self.failures += 1
+            logger.error(f"任务<{job.name}>执行失败: {e!r}")
+
+    def _run_job(self, job: BotJob, now: float):
+        lateness = now - job.next_run
+        if lateness > self.misfire_grace_time:
+            job.misfires += 1
+            self.misfires += 1
+            logger.warning(f"任务<{job.name}>延迟{lateness:.1f}秒，跳过本次执行")
+        else:
+            job.lateness = lateness
+            job.last_run = now
+            job.runs += 1
+            self.runs += 1
+            self.total_lateness += lateness
+            self.max_lateness = max(self.max_lateness, lateness)
+            try:
+                job.submit().add_done_callback(functools.partial(self._on_done, job))
+            except Exception as e:
+                job.failures += 1
+                self.failures += 1
+                logger.error(f"任务<{job.name}>提交失败: {e!r}")
+        if job.schedule_next(now) is None:
+            # 一次性任务执行后删除
+            self._remove(job.name)
+        else:
+            self._push(job)
+            self._mark_changed(job.name)
+
+    def _save(self):
+        """在持有锁时调用，写入文件时释放锁"""
+        for name in self._changed:
+            self._serialized[name] = json.dumps(
+                self.jobs[name].as_dict(), ensure_ascii=False
+            )
+        self._changed.clear()
+        jobs = list(self._serialized.values())
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._cond.release()
+        try:
+            self.store.save(jobs)
+        finally:
+            self._cond.acquire()
+
+    def run(self):
+        logger.info("开始运行定时任务线程")
+        with self._cond:
+            while not self._shutdown:
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    next_run, _, job = heapq.heappop(self._heap)
+                    # 已取消或已重新计划
+                    if self.jobs.get(job.name) is not job or job.next_run != next_run:
+                        continue
+                    self._run_job(job, now)
+                timeout = self._heap[0][0] - now if self._heap else None
+                if self._dirty:
+                    save_in = self._saved_at + self.save_interval - time.monotonic()
+                    if save_in <= 0:
+                        self._save()
+                    else:
+                        timeout = save_in if timeout is None else min(timeout, save_in)
+                self._cond.wait(timeout)
+            if self._dirty:
+                self._save()
+        logger.info("定时任务线程已停止")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.load()
+        Signal.register_sigint(self.shutdown)
+        self._thread = threading.Thread(
+            target=self.run, name="bot-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def shutdown(self):
+        logger.info("正在停止定时任务...")
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    async def schedule_a_job(
+        self,
+        name: str,
+        unit: str = None,
+        every: int = 1,
+        at: str = None,
+        do: dict = None,
+        description=None,
+        tags=None,
+        run_at: Union[str, float] = None,
+        cron: str = None,
+        jitter: float = 0,
+    ):
+        """
+        {
+            "name": "Greet",
+            "unit": "days",
+            "every": 1,
+            "at": "08:00:00",
+            "do": {
+                "func": "send_text",
+                "args": [12314, "wxid_foo", "Morning!"]
+            },
+            "description": "",
+            "tags": ["tian"]
+        }
+        参见 https://schedule.readthedocs.io/en/stable/examples.html
+        `unit`、`run_at`、`cron`三者只能指定一个
+        :param name: 任务名
+        :param unit: 单位，seconds, minutes, hours, days, weeks, monday, tuesday, wednesday, thursday, friday, saturday, sunday
+        :param every: 每<unit>
+        :param at:  For daily jobs -> HH:MM:SS or HH:MM
+                    For hourly jobs -> MM:SS or :MM
+                    For minute jobs -> :SS
+        :param do: 执行的方法，func: 方法名, args: 参数列表
+        :param description: 描述
+        :param tags: 标签，总会添加任务名作为标签
+        :param run_at: 只执行一次的时间，如"2023-01-01 08:00:00"或时间戳，执行后删除任务
+        :param cron: cron表达式: 分 时 日 月 星期，如"0 8 * * 1-5"
+        :param jitter: 每次执行随机推迟0至jitter秒
+        """
+        self.start()
+        try:
+            job = BotJob(
+                name,
+                unit,
+                every,
+                at,
+                do,
+                description,
+                list(tags or []),
+                run_at=run_at,
+                cron=cron,
+                jitter=jitter,
+            )
+        except Exception as e:
+            return InvalidParams(f"参数错误: {str(e)}")
+        with self._cond:
+            if job.name in self.jobs:
+                return InvalidParams(f"任务<{name}>已存在")
+            if not self._add(job, time.time()):
+                return InvalidParams(f"任务<{name}>的执行时间已过去")
+            self._cond.notify()
+        return Success(job.next_run)
+
+    def _cancel_jobs(self, tag=None) -> int:
+        with self._cond:
+            names = list(self.jobs if tag is None else self._tags.get(tag, ()))
+            for name in names:
+                self._remove(name)
+            if names:
+                self._compact()
+                self._cond.notify()
+        return len(names)
+
+    async def cancel_jobs(self, tag=None):
+        """
+        取消任务
+        :param tag: 标签名(任务名总是其标签)，为空时取消所有任务
+        :return: 取消的任务数
+        """
+        return Success(self._cancel_jobs(tag))
+
+    async def list_jobs(
+        self, tag: str = None, func: str = None, offset: int = 0, limit: int = 100
+    ):
+        """
+        按添加顺序分页列出任务
+        :param tag: 只列出有该标签的任务
+        :param func: 只列出执行该方法的任务
+        :param offset: 跳过的任务数
+        :param limit: 最多返回的任务数
+        :return: {"total": 符合条件的任务数, "jobs": [任务]}
+        """
+        if offset < 0 or limit < 0:
+            return InvalidParams("offset和limit不能小于0")
+        with self._cond:
+            names = self.jobs if tag is None else self._tags.get(tag, {})
+            jobs = (self.jobs[name] for name in names)
+            if func is not None:
+                jobs = [job for job in jobs if job.do["func"] == func]
+                total = len(jobs)
+            else:
+                total = len(names)
+            page = [
+                job.as_dict() for job in itertools.islice(jobs, offset, offset + limit)
+            ]
+        return Success({"total": total, "jobs": page})
+
+    def stats(self):
+        with self._cond:
+            return {
+                "jobs": len(self.jobs),
+                "tags": len(self._tags),
+                "heap": len(self._heap),
+                "runs": self.runs,
+                "misfires": self.misfires,
+                "failures": self.failures,
+                "max_lateness": self.max_lateness,
+                "avg_lateness": (self.total_lateness / self.runs if self.runs else 0.0),
+            }
+
+    async def scheduler_stats(self):
+        """定时任务统计：执行次数、错过次数、失败次数及延迟(秒)"""
+        return Success(self.stats())
+
+    def get_rpc_methods(self) -> Dict[str, Callable]:
+        return {
+            method.__name__: method
+            for method in [
+                self.schedule_a_job,
+                self.cancel_jobs,
+                self.list_jobs,
+                self.scheduler_stats,
+            ]
+        }
+
+
+default_bot_scheduler = BotScheduler()
@@ -2,9 +2,11 @@ import json
 
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import RedirectResponse
-from jsonrpcserver import async_dispatch
 
+from whochat.processes import wechat_process_registry
+from whochat.rpc.dispatch import dispatch
 from whochat.rpc.docs import make_docs
+from whochat.rpc.handlers import bot_executors
 
 app = FastAPI(title="微信机器人RPC接口文档", description="HTTP和Websocket均使用JSON-RPC2.0进行函数调用")
 
@@ -18,6 +20,12 @@ async def index():
     return RedirectResponse("/docs")
 
 
+@app.on_event("shutdown")
+def shutdown():
+    wechat_process_registry.stop_watching()
+    bot_executors.shutdown()
+
+
 @app.get("/rpc_api_docs")
 async def rpc_docs():
     return make_docs()
@@ -30,5 +38,5 @@ async def rpc_docs():
 )
 async def rpc(request: Request):
     data = await request.body()
-    result = await async_dispatch(data)
+    result = await dispatch(data)
     return Response(result)
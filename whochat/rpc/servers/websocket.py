@@ -2,20 +2,23 @@ import asyncio
 import logging
 
 import websockets.server
-from jsonrpcserver import async_dispatch
 
+from whochat.rpc.bulk import current_websocket
+from whochat.rpc.dispatch import dispatch
 from whochat.signals import Signal
 
 logger = logging.getLogger("whochat")
 
 
 async def dispatch_in_task(websocket, request):
-    res = await async_dispatch(request)
+    res = await dispatch(request)
     await websocket.send(res)
 
 
 async def handler(websocket: "websockets.server.WebSocketServerProtocol"):
     logger.info(f"Accept connection from {websocket.remote_address}")
+    # 批量发送任务通过该连接推送进度
+    current_websocket.set(websocket)
     while not websocket.closed:
         request = await websocket.recv()
         asyncio.create_task(dispatch_in_task(websocket, request))
@@ -30,8 +33,12 @@ async def run(host, port):
         logger.info("正在停止微信机器人RPC websocket服务...")
         stop_event.set()
         from whochat.bot import WechatBotFactory
+        from whochat.processes import wechat_process_registry
+        from whochat.rpc.handlers import bot_executors
 
+        wechat_process_registry.stop_watching()
         WechatBotFactory.exit()
+        bot_executors.shutdown()
 
     Signal.register_sigint(shutdown)
     async with websockets.server.serve(handler, host, port):
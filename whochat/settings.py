@@ -8,6 +8,7 @@ class Settings(BaseSettings):
     ROOT_DIR = Path(__file__).parent.parent.absolute()
     DEV_LOG_DIR = ROOT_DIR.joinpath("logs")
     DEFAULT_LOG_LEVEL = "INFO"
+    CACHE_DIR = Path.home().joinpath(".whochat")
 
     class Config:
         env_file = ".env"
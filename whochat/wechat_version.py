@@ -0,0 +1,164 @@
+"""
+获取微信最新版本号
+
+`WechatVersionResolver.resolve`不访问网络，立即返回以下第一个可用的版本号:
+
+1. 环境变量`WHOCHAT_WECHAT_VERSION`
+2. 缓存文件中的版本号
+3. `whochat.ComWeChatRobot.__wechat_version__`
+
+缓存不存在或已过期时在后台线程中从微信官网获取并写入缓存文件
+"""
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Union
+from urllib import request
+
+from whochat.ComWeChatRobot import __wechat_version__
+from whochat.logger import logger
+from whochat.settings import settings
+
+VERSION_URL = "https://pc.weixin.qq.com/?lang=zh_CN"
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36"
+
+
+def fetch_latest_wechat_version(timeout: float = 5) -> Optional[str]:
+    """从微信官网获取最新版本号，失败时返回None"""
+    try:
+        with request.urlopen(
+            request.Request(
+                VERSION_URL,
+                headers={"User-Agent": USER_AGENT},
+                method="GET",
+            ),
+            timeout=timeout,
+        ) as fp:
+            html = fp.read().decode()
+    except (OSError, ValueError) as e:
+        logger.warning(f"获取微信最新版本号失败: {e!r}")
+        return None
+    m = re.search(r"download-version\">(.*?)</span>", html)
+    if not m:
+        logger.warning("获取微信最新版本号异常")
+        return None
+    return m.group(1)
+
+
+class WechatVersionResolver:
+    def __init__(
+        self,
+        cache_file: Union[str, Path] = None,
+        max_age: float = 24 * 3600,
+        timeout: float = 5,
+        fill: str = ".99",
+        retry_interval: float = 300,
+    ):
+        """
+        :param cache_file: 缓存文件路径
+        :param max_age: 缓存有效时间，秒，过期后在后台刷新
+        :param timeout: 访问微信官网的超时时间，秒
+        :param fill: 追加在官网版本号后的版本号
+        :param retry_interval: 获取失败后的重试间隔，秒
+        """
+        self.cache_file = Path(
+            cache_file or settings.CACHE_DIR.joinpath("wechat_version.json")
+        )
+        self.max_age = max_age
+        self.timeout = timeout
+        self.fill = fill
+        self.retry_interval = retry_interval
+        self._version: Optional[str] = None
+        self._fetched_at = 0.0
+        self._loaded = False
+        self._refreshing = False
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable[[str], None]] = []
+
+    def _load_cache(self):
+        self._loaded = True
+        try:
+            data = json.loads(self.cache_file.read_text(encoding="utf-8"))
+            self._version = data["version"]
+            self._fetched_at = float(data["fetched_at"])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"读取微信版本号缓存失败: {e!r}")
+
+    def _save_cache(self):
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.cache_file.with_suffix(".tmp")
+            tmp_file.write_text(
+                json.dumps({"version": self._version, "fetched_at": self._fetched_at}),
+                encoding="utf-8",
+            )
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            logger.warning(f"写入微信版本号缓存失败: {e!r}")
+
+    @property
+    def is_stale(self) -> bool:
+        return time.time() - self._fetched_at >= self.max_age
+
+    def on_refresh(self, callback: Callable[[str], None]):
+        """注册获取到新版本号后的回调"""
+        self._callbacks.append(callback)
+
+    def refresh(self) -> Optional[str]:
+        """同步获取最新版本号并写入缓存，失败时返回None"""
+        version = fetch_latest_wechat_version(self.timeout)
+        if version is None:
+            return None
+        if self.fill:
+            version = version + self.fill
+        with self._lock:
+            changed = version != self._version
+            self._version = version
+            self._fetched_at = time.time()
+            self._save_cache()
+        logger.info(f"微信最新版本号：{version}")
+        if changed:
+            for callback in self._callbacks:
+                try:
+                    callback(version)
+                except Exception as e:
+                    logger.exception(e)
+        return version
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                if self.refresh() is None:
+                    self._retry_at = time.time() + self.retry_interval
+            finally:
+                self._refreshing = False
+
+        self._retry_at = 0.0
+
+        threading.Thread(target=run, name="wechat-version", daemon=True).start()
+
+    def resolve(self) -> str:
+        """立即返回版本号，不访问网络"""
+        env_version = os.environ.get("WHOCHAT_WECHAT_VERSION")
+        if env_version:
+            return env_version
+        with self._lock:
+            if not self._loaded:
+                self._load_cache()
+        if self.is_stale and time.time() >= self._retry_at:
+            self.refresh_in_background()
+        return self._version or __wechat_version__
+
+
+wechat_version_resolver = WechatVersionResolver()